@@ -0,0 +1,68 @@
+# Import packages
+
+import sys
+import os
+import time
+import numpy as np
+import galsim
+
+from cosmos_params import *
+from images_utils import get_cosmos_catalog, draw_images, full_image
+
+# The script is used as, eg,
+# >> python benchmark_draw.py 20 64
+# to compare, for blends of 1 to 6 galaxies drawn in 64x64 stamps and averaged over 20 blends, the time needed to draw all
+# the bands with each galaxy drawn on the full stamp (shifted profiles) and with each galaxy drawn on a stamp limited to its
+# extent (draw_images with shifts). The maximum difference of the noiseless images is given in units of the sky noise.
+
+max_dx = 3.2 # Shifts drawn uniformly in [-max_dx, max_dx] arcsec as in main_generation_cosmos.py
+
+def draw_bands(galaxies, shift, fwhm_lsst, img_size, bounds_limited):
+    '''
+    Return the noiseless images of the galaxies in all bands (array [band, galaxy, img_size, img_size])
+
+    Parameters:
+    ----------
+    galaxies: galaxies centered on (0,0)
+    shift: shifts of the galaxies in arcsec
+    fwhm_lsst: FWHM of the LSST PSF
+    img_size: size of the stamps
+    bounds_limited: draw each galaxy on a stamp limited to its extent
+    '''
+    PSF = [PSF_euclid_nir]*3 + [PSF_euclid_vis] + [galsim.Kolmogorov(fwhm=fwhm_lsst)]*6
+    if not bounds_limited:
+        galaxies = [gal.shift(x, y) for gal, (x, y) in zip(galaxies, shift)]
+    out = np.zeros((10, len(galaxies), img_size, img_size))
+    for i, filter_name in enumerate(filter_names_all):
+        galaxies_psf = [galsim.Convolve([gal*coeff_exp[i], PSF[i]]) for gal in galaxies]
+        images, _ = draw_images(galaxies_psf, i, img_size, filter_name, sky_level_pixel[i], shifts=shift if bounds_limited else None)
+        out[i] = [full_image(image, img_size) for image in images]
+    return out
+
+
+if __name__ == '__main__':
+    n_blends = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    img_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    cosmos_cat = get_cosmos_catalog(os.path.join(data_dir, 'COSMOS_25.2_training_sample'))
+    np.random.seed(0)
+    _, fwhm_lsst = psf_lsst(psf_lsst_fixed=True)
+    sky_noise = np.sqrt(np.array(sky_level_pixel))[:, np.newaxis, np.newaxis, np.newaxis]
+
+    print('{0:>6} {1:>12} {2:>12} {3:>10} {4:>16}'.format('n_gal', 'full (s)', 'bounds (s)', 'speed-up', 'max diff (sky)'))
+    for nb_blended_gal in range(1, 7):
+        t_full, t_bounds, diff = 0., 0., 0.
+        for _ in range(n_blends):
+            idx = np.random.randint(cosmos_cat.nobjects, size=nb_blended_gal)
+            galaxies = [cosmos_cat.makeGalaxy(k, gal_type='parametric', chromatic=True, noise_pad_size=0) for k in idx]
+            shift = np.random.uniform(-max_dx, max_dx, size=(nb_blended_gal, 2))
+            t0 = time.perf_counter()
+            full = draw_bands(galaxies, shift, fwhm_lsst, img_size, bounds_limited=False)
+            t1 = time.perf_counter()
+            bounds = draw_bands(galaxies, shift, fwhm_lsst, img_size, bounds_limited=True)
+            t2 = time.perf_counter()
+            t_full += t1-t0
+            t_bounds += t2-t1
+            diff = max(diff, np.max(np.abs(full-bounds)/sky_noise))
+        print('{0:>6} {1:>12.3f} {2:>12.3f} {3:>10.2f} {4:>16.2e}'.format(nb_blended_gal, t_full/n_blends, t_bounds/n_blends, t_full/t_bounds, diff))
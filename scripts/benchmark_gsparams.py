@@ -0,0 +1,67 @@
+# Import packages
+
+import sys
+import os
+import time
+import numpy as np
+
+from cosmos_params import sky_level_pixel, gsparams_profiles
+from images_generator import image_generator_sim
+from images_utils import get_cosmos_catalog
+
+# The script is used as, eg,
+# >> python benchmark_gsparams.py 50 training
+# to generate the same 50 blends (seeds 0 to 49) of the training part of the catalog with each GSParams profile and report
+# the number of images generated per second and the deviation from the 'precise' profile: maximum pixel difference of
+# the noiseless images (in units of the sky noise), relative difference of the SNR and difference of the KSB shapes.
+# The peak detection is not done so that the scenes do not depend on the profile.
+
+# Parameters of the generation, as in main_generation_cosmos.py
+nmax_blend = (1,5)
+max_try = 100
+mag_cut = 27.5
+max_stamp_size = 64
+
+def generate(profile, seeds, training_or_test):
+    '''
+    Return the noiseless images, SNR and KSB shapes (e1, e2) of the central galaxy of the blends generated with the profile, and the time needed
+
+    Parameters:
+    ----------
+    profile: name of the GSParams profile
+    seeds: seeds of the blends
+    training_or_test: part of the catalog used
+    '''
+    used_idx = np.arange(5000) if training_or_test == 'test' else np.arange(5000, get_cosmos_catalog(cosmos_cat_dir).nobjects)
+    images, snr, shapes = [], [], []
+    t0 = time.perf_counter()
+    for seed in seeds:
+        galaxy_noiseless, _, data, _ = image_generator_sim(cosmos_cat_dir, training_or_test, 'blended', used_idx, nmax_blend, max_try, mag_cut,
+                                                           'uniform', 'uniform', 3.2, 2., False, False, max_stamp_size, False,
+                                                           accuracy=profile, seed=seed)
+        images.append(galaxy_noiseless)
+        snr.append(data['SNR'])
+        shapes.append([data['e1_ksb_0'], data['e2_ksb_0']])
+    return np.array(images), np.array(snr), np.array(shapes), time.perf_counter()-t0
+
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    training_or_test = str(sys.argv[2]) if len(sys.argv) > 2 else 'training'
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    cosmos_cat_dir = os.path.join(data_dir, 'COSMOS_25.2_training_sample')
+    seeds = range(n_images)
+    sky_noise = np.sqrt(np.array(sky_level_pixel))[:, np.newaxis, np.newaxis]
+
+    # Warm up the caches of the process (catalog, fit table) before timing
+    generate('default', [n_images], training_or_test)
+    results = {profile: generate(profile, seeds, training_or_test) for profile in gsparams_profiles}
+    ref_images, ref_snr, ref_shapes, _ = results['precise']
+
+    print('{0:<10} {1:>10} {2:>16} {3:>14} {4:>14}'.format('profile', 'images/s', 'max diff (sky)', 'SNR rel diff', 'KSB e diff'))
+    for profile in gsparams_profiles:
+        images, snr, shapes, t = results[profile]
+        pixel_diff = np.max(np.abs(images - ref_images) / sky_noise)
+        snr_diff = np.max(np.abs(snr/ref_snr - 1.))
+        shape_diff = np.nanmax(np.abs(shapes - ref_shapes)) if np.any(np.isfinite(shapes - ref_shapes)) else np.nan
+        print('{0:<10} {1:>10.2f} {2:>16.2e} {3:>14.2e} {4:>14.2e}'.format(profile, n_images/t, pixel_diff, snr_diff, shape_diff))
@@ -0,0 +1,41 @@
+# Import packages
+
+import sys
+import os
+import subprocess
+import tempfile
+import numpy as np
+
+# The script is used as, eg,
+# >> python benchmark_import.py 5
+# to measure, in fresh interpreters (as a pool worker started with the spawn method), the time needed to import
+# the generation modules with an empty filters cache (cold) and with the cache already built (warm).
+
+modules = ['cosmos_params', 'images_utils', 'images_generator']
+
+def import_time(module, cache_dir):
+    '''
+    Return the time (in s) needed to import the module in a new python interpreter
+
+    Parameters:
+    ----------
+    module: name of the module to import
+    cache_dir: directory used for the filters cache (IMGEN_CACHE)
+    '''
+    code = 'import time; t0 = time.perf_counter(); import {0}; print(time.perf_counter() - t0)'.format(module)
+    env = dict(os.environ, IMGEN_CACHE=cache_dir)
+    out = subprocess.run([sys.executable, '-c', code], env=env, cwd=os.path.dirname(os.path.realpath(__file__)),
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return float(out.stdout.split()[-1])
+
+
+if __name__ == '__main__':
+    n_repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{0:<20} {1:>12} {2:>12}'.format('module', 'cold (s)', 'warm (s)'))
+    for module in modules:
+        cold, warm = [], []
+        for _ in range(n_repeat):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                cold.append(import_time(module, cache_dir))
+                warm.append(import_time(module, cache_dir))
+        print('{0:<20} {1:>12.3f} {2:>12.3f}'.format(module, np.median(cold), np.median(warm)))
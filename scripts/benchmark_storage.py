@@ -0,0 +1,87 @@
+# Import packages
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from cosmos_params import sky_level_pixel
+from images_generator import image_generator_sim
+from images_utils import get_cosmos_catalog
+from dataset_io import save_chunked, ChunkedArray
+
+# The script is used as, eg,
+# >> python benchmark_storage.py 200 training
+# to generate 200 blends (seeds 0 to 199) of the training part of the catalog, save them with np.save and in compressed
+# chunks (dataset_io.save_chunked) with each codec available, with and without quantization, and report the write and
+# read throughputs (MB/s of uncompressed images), the size on disk and the maximum error in units of the sky noise.
+
+# Parameters of the generation, as in main_generation_cosmos.py
+nmax_blend = (1,5)
+max_try = 100
+mag_cut = 27.5
+max_stamp_size = 64
+# Storage configurations: (codec, quantization step in units of the sky noise)
+configurations = [('zlib', None), ('zlib', 0.1), ('zstd', None), ('zstd', 0.1)]
+
+def dir_size(path):
+    '''
+    Return the size (in bytes) of a file or of the files of a directory
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    training_or_test = str(sys.argv[2]) if len(sys.argv) > 2 else 'training'
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    cosmos_cat_dir = os.path.join(data_dir, 'COSMOS_25.2_training_sample')
+    used_idx = np.arange(5000) if training_or_test == 'test' else np.arange(5000, get_cosmos_catalog(cosmos_cat_dir).nobjects)
+
+    # Images with the layout of the _images.npy files
+    galaxies = []
+    for seed in range(n_images):
+        gal_noiseless, blend_noisy, _, _ = image_generator_sim(cosmos_cat_dir, training_or_test, 'blended', used_idx, nmax_blend, max_try, mag_cut,
+                                                               'uniform', 'uniform', 3.2, 2., False, False, max_stamp_size, False,
+                                                               do_shape_measurement=False, seed=seed)
+        if training_or_test == 'test':
+            galaxies.append(np.append(gal_noiseless, np.expand_dims(blend_noisy, axis=0), axis = 0))
+        else:
+            galaxies.append((gal_noiseless, blend_noisy))
+    galaxies = np.array(galaxies)
+    size_mb = galaxies.nbytes / 1024**2
+    sky_noise = np.sqrt(np.array(sky_level_pixel))[:, np.newaxis, np.newaxis]
+
+    tmp_dir = tempfile.mkdtemp()
+    print('{0:<16} {1:>12} {2:>12} {3:>12} {4:>10} {5:>14}'.format('storage', 'write MB/s', 'read MB/s', 'size (MB)', 'ratio', 'max err (sky)'))
+    try:
+        path = os.path.join(tmp_dir, 'images.npy')
+        t0 = time.perf_counter()
+        np.save(path, galaxies)
+        t1 = time.perf_counter()
+        np.load(path)
+        t2 = time.perf_counter()
+        size_npy = dir_size(path)
+        print('{0:<16} {1:>12.1f} {2:>12.1f} {3:>12.2f} {4:>10.2f} {5:>14.2e}'.format('np.save', size_mb/(t1-t0), size_mb/(t2-t1), size_npy/1024**2, 1., 0.))
+
+        for codec, quantization in configurations:
+            if codec == 'zstd':
+                try:
+                    import zstandard
+                except ImportError:
+                    continue
+            path = os.path.join(tmp_dir, '{0}_{1}'.format(codec, quantization))
+            t0 = time.perf_counter()
+            save_chunked(path, galaxies, codec=codec, quantization=quantization, sky_level_pixel=sky_level_pixel)
+            t1 = time.perf_counter()
+            images = ChunkedArray(path)[:]
+            t2 = time.perf_counter()
+            error = np.max(np.abs(images - galaxies) / sky_noise)
+            name = codec + ('' if quantization is None else ' q={0}'.format(quantization))
+            print('{0:<16} {1:>12.1f} {2:>12.1f} {3:>12.2f} {4:>10.2f} {5:>14.2e}'.format(name, size_mb/(t1-t0), size_mb/(t2-t1), dir_size(path)/1024**2, size_npy/dir_size(path), error))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -2,9 +2,9 @@
 
 import numpy as np
 import os
+import pickle
+import hashlib
 import galsim
-from scipy import integrate
-from scipy import stats
 
 ############# SIZE OF STAMPS ################
 # The stamp size of NIR instrument is taken equal to the one of LSST to have a nb of pixels which is 
@@ -16,43 +16,117 @@ pixel_scale_euclid_nir = 0.3 # arcseconds # Euclid Science book
 pixel_scale_euclid_vis = 0.1 # arcseconds # Euclid Science book
 pixel_scale = [pixel_scale_euclid_nir]*3 + [pixel_scale_euclid_vis] + [pixel_scale_lsst]*6
 
+# Native stamps (native_stamps option of image_generator_sim): each instrument has its own stamp size, covering the
+# footprint of the LSST stamps (max_stamp_size*pixel_scale_lsst), and its images are stored in separate arrays.
+# For max_stamp_size=64 (12.8"): 44 pixels in NIR (13.2"), 128 pixels in VIS and 64 pixels in LSST bands.
+instrument_bands = {'nir': [0, 1, 2], 'vis': [3], 'lsst': [4, 5, 6, 7, 8, 9]}
+
+def native_stamp_sizes(max_stamp_size):
+    '''
+    Return the stamp size of each band covering the footprint of the LSST stamps, rounded up to an even number of pixels
+
+    Parameters:
+    ----------
+    max_stamp_size: size of the LSST stamps
+    '''
+    footprint = max_stamp_size*pixel_scale_lsst
+    return [int(2*np.ceil(np.round(footprint/scale/2., 6))) for scale in pixel_scale]
+
 #################### FILTERS ###################
-filters = {}
+# Thinning the bandpasses takes most of the import time of this module, so the thinned filters are cached on disk
+# (in IMGEN_CACHE, ../data/cache by default). The cache is rebuilt if the filter files, the GalSim version or
+# filters_cache_version change.
+filters_cache_version = 1
 euclid_filters_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/EUCLID_Filters/')
 lsst_filters_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/share_galsim/bandpasses')
+hst_filters_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/share_galsim/')
+cache_dir = os.environ.get('IMGEN_CACHE', os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/cache'))
 
-# read in the Euclid NIR filters
 filter_names_euclid_nir = 'HJY'
 filter_names_euclid_vis = 'V'
-
-for filter_name in filter_names_euclid_nir:
-    filter_filename = os.path.join(euclid_filters_dir, 'Euclid_NISP0.{0}.dat'.format(filter_name))
-    filters[filter_name] = galsim.Bandpass(filter_filename, wave_type='Angstrom')
-    filters[filter_name] = filters[filter_name].thin(rel_err=1e-4)
-
-filter_filename = os.path.join(euclid_filters_dir, 'Euclid_VIS.dat')
-filters['V'] = galsim.Bandpass(filter_filename, wave_type='Angstrom')
-filters['V'] = filters[filter_name].thin(rel_err=1e-4)
-
-# read in the LSST filters
 filter_names_lsst = 'ugrizy'
-for filter_name in filter_names_lsst:
-    filter_filename = os.path.join(lsst_filters_dir, 'LSST_{0}.dat'.format(filter_name))
-    filters[filter_name] = galsim.Bandpass(filter_filename, wave_type='nm')
-    filters[filter_name] = filters[filter_name].thin(rel_err=1e-4)
-
 filter_names_all = 'HJYVugrizy'
 
+def _filter_files():
+    return ([os.path.join(euclid_filters_dir, 'Euclid_NISP0.{0}.dat'.format(filter_name)) for filter_name in filter_names_euclid_nir]
+            + [os.path.join(euclid_filters_dir, 'Euclid_VIS.dat')]
+            + [os.path.join(lsst_filters_dir, 'LSST_{0}.dat'.format(filter_name)) for filter_name in filter_names_lsst]
+            + [os.path.join(hst_filters_dir, 'wfc_F814W.dat.gz')])
+
+def _load_filters():
+    '''
+    Return the thinned filters of the Euclid and LSST bands and the HST F814W filter of the COSMOS images
+    '''
+    filters = {}
+    # read in the Euclid NIR filters
+    for filter_name in filter_names_euclid_nir:
+        filter_filename = os.path.join(euclid_filters_dir, 'Euclid_NISP0.{0}.dat'.format(filter_name))
+        filters[filter_name] = galsim.Bandpass(filter_filename, wave_type='Angstrom')
+        filters[filter_name] = filters[filter_name].thin(rel_err=1e-4)
+
+    filter_filename = os.path.join(euclid_filters_dir, 'Euclid_VIS.dat')
+    filters['V'] = galsim.Bandpass(filter_filename, wave_type='Angstrom')
+    filters['V'] = filters[filter_name].thin(rel_err=1e-4)
+
+    # read in the LSST filters
+    for filter_name in filter_names_lsst:
+        filter_filename = os.path.join(lsst_filters_dir, 'LSST_{0}.dat'.format(filter_name))
+        filters[filter_name] = galsim.Bandpass(filter_filename, wave_type='nm')
+        filters[filter_name] = filters[filter_name].thin(rel_err=1e-4)
+
+    # HST F814W filter of the COSMOS images
+    filter_hst_f814w = galsim.Bandpass(os.path.join(hst_filters_dir, 'wfc_F814W.dat.gz'), wave_type='ang').thin().withZeropoint(25.94)
+    return filters, filter_hst_f814w
+
+def _load_filters_cached():
+    '''
+    Return the filters from the on-disk cache, computing and saving them if the cache is missing or outdated
+    '''
+    files_hash = hashlib.sha1()
+    for filter_filename in _filter_files():
+        with open(filter_filename, 'rb') as f:
+            files_hash.update(f.read())
+    key = (filters_cache_version, galsim.__version__, files_hash.hexdigest())
+    cache_file = os.path.join(cache_dir, 'filters_v{0}.pkl'.format(filters_cache_version))
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] == key:
+            return cached['filters'], cached['filter_hst_f814w']
+    except Exception:
+        # Missing, corrupted or incompatible cache: recompute it
+        pass
+
+    filters, filter_hst_f814w = _load_filters()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so that concurrent processes never read a partial file
+        tmp_file = cache_file+'.{0}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'key': key, 'filters': filters, 'filter_hst_f814w': filter_hst_f814w}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return filters, filter_hst_f814w
+
+filters, filter_hst_f814w = _load_filters_cached()
+
 # Number of exposures
 ## Choose between the full surveys or only one single exposure of each
-full_or_single = 'full' # Here I choose the full survey, for one single exposure change to 'single'
+full_or_single = 'full' # Here I choose the full survey, for one single exposure change to 'single' (or use set_exposures)
+
+def number_of_exposures(full_or_single):
+    if full_or_single == 'full': 
+        N_exposures_lsst = [56, 80, 184, 184, 160, 160] #Over the ten years (https://arxiv.org/pdf/0805.2366.pdf)
+        N_exposures_euclid = 4
+    elif full_or_single == 'single':
+        N_exposures_lsst = [1, 1, 1, 1, 1, 1] #Over the ten years (https://arxiv.org/pdf/0805.2366.pdf)
+        N_exposures_euclid = 1
+    else:
+        raise NotImplementedError
+    return N_exposures_lsst, N_exposures_euclid
 
-if full_or_single == 'full': 
-    N_exposures_lsst = [56, 80, 184, 184, 160, 160] #Over the ten years (https://arxiv.org/pdf/0805.2366.pdf)
-    N_exposures_euclid = 4
-elif full_or_single == 'single':
-    N_exposures_lsst = [1, 1, 1, 1, 1, 1] #Over the ten years (https://arxiv.org/pdf/0805.2366.pdf)
-    N_exposures_euclid = 1
+N_exposures_lsst, N_exposures_euclid = number_of_exposures(full_or_single)
 
 #################### NOISE ###################
 # Poissonian noise according to sky_level
@@ -89,34 +163,31 @@ sky_level_pixel_vis = sky_level_vis * 450. * pixel_scale_euclid_vis**2 # in e-/p
 
 sky_level_pixel = sky_level_pixel_nir + [sky_level_pixel_vis] + sky_level_pixel_lsst
 
+#################### ACCURACY OF THE RENDERING ###################
+# GSParams applied to the galaxies, the PSFs and their convolutions. Training samples tolerate looser thresholds
+# (larger aliasing and truncation of the profiles in Fourier space, i.e. smaller FFTs) than test samples.
+gsparams_profiles = {'fast': galsim.GSParams(folding_threshold=2.e-2, maxk_threshold=5.e-3, kvalue_accuracy=1.e-4, xvalue_accuracy=1.e-4),
+                     'default': galsim.GSParams(),
+                     'precise': galsim.GSParams(folding_threshold=1.e-3, maxk_threshold=2.e-4, kvalue_accuracy=1.e-6, xvalue_accuracy=1.e-6)}
+
+#################### PSF ###################
 # LSST
 # The PSF is fixed since we stack here 100 exposures
-def psf_lsst(psf_lsst_fixed=False):
+def psf_lsst(psf_lsst_fixed=False, gsparams=None):
+    from scipy import stats
     if psf_lsst_fixed:
         fwhm_lsst = 0.65 ## Fixed at median value : Fig 1 : https://arxiv.org/pdf/0805.2366.pdf
-        PSF_lsst = galsim.Kolmogorov(fwhm=fwhm_lsst)
+        PSF_lsst = galsim.Kolmogorov(fwhm=fwhm_lsst, gsparams=gsparams)
     else:
         def lsst_PSF():
             #Fig 1 : https://arxiv.org/pdf/0805.2366.pdf
             mu = -0.43058681997903414 # np.log(0.65)
             sigma = 0.3404334041976153  # Fixed to have corresponding percentils as in paper
-            p_unnormed = lambda x : (np.exp(-(np.log(x) - mu)**2 / (2 * sigma**2))
-                            / (x * sigma * np.sqrt(2 * np.pi)))
-            p_normalization = integrate.quad(p_unnormed, 0., np.inf)[0]
-            p = lambda z : p_unnormed(z) / p_normalization
-
-            class PSF_distribution(stats.rv_continuous):
-                def __init__(self):
-                    super(PSF_distribution, self).__init__()
-                    self.a = 0.
-                    self.b = 10.
-                def _pdf(self, x):
-                    return p(x)
-
-            pdf = PSF_distribution()
-            return pdf.rvs()
+            # Log-normal distribution (truncated at 10", i.e. 8 sigma): inverse of its cumulative distribution function
+            # applied to a uniform draw, as scipy.stats.rv_continuous.rvs does numerically (same draws for the same seed)
+            return np.exp(mu + sigma * stats.norm.ppf(np.random.uniform()))
         fwhm_lsst = lsst_PSF()
-        PSF_lsst = galsim.Kolmogorov(fwhm=fwhm_lsst)
+        PSF_lsst = galsim.Kolmogorov(fwhm=fwhm_lsst, gsparams=gsparams)
     return PSF_lsst, fwhm_lsst
 
 # Euclid
@@ -126,6 +197,9 @@ beta = 2.5
 PSF_euclid_nir = galsim.Moffat(fwhm=fwhm_euclid_nir, beta=beta)
 PSF_euclid_vis = galsim.Moffat(fwhm=fwhm_euclid_vis, beta=beta)
 
+def psf_euclid(gsparams=None):
+    return PSF_euclid_nir.withGSParams(gsparams), PSF_euclid_vis.withGSParams(gsparams)
+
 #PSF = [PSF_euclid_nir]*3 + [PSF_euclid_vis] + [PSF_lsst]*6
 
 #################### EXPOSURE AND LUMISOITY ###################
@@ -133,3 +207,20 @@ PSF_euclid_vis = galsim.Moffat(fwhm=fwhm_euclid_vis, beta=beta)
 coeff_exp_euclid =  (450. * ((1.25)**2 - (0.37)**2)/((2.4**2)*(1.-0.33**2)))
 coeff_exp_lsst =  (15. * (6.68**2)/((2.4**2)*(1.-0.33**2))) 
 coeff_exp = [coeff_exp_euclid*N_exposures_euclid]*4 + [coeff_exp_lsst* N_exposures_lsst[0]]+ [coeff_exp_lsst* N_exposures_lsst[1]]+[coeff_exp_lsst* N_exposures_lsst[2]]+[coeff_exp_lsst* N_exposures_lsst[3]]+[coeff_exp_lsst* N_exposures_lsst[4]]+[coeff_exp_lsst* N_exposures_lsst[5]]
+
+def set_exposures(full_or_single_new):
+    '''
+    Change the number of exposures of the surveys ('full' or 'single'). The sky levels and the exposure coefficients,
+    proportional to the number of exposures of each band, are updated in place so that the modules which imported them
+    (from cosmos_params import *) and the workers forked afterwards use the new values
+
+    Parameters:
+    ----------
+    full_or_single_new: 'full' for the full surveys, 'single' for a single exposure
+    '''
+    global full_or_single, N_exposures_lsst, N_exposures_euclid
+    N_exposures_lsst_new, N_exposures_euclid_new = number_of_exposures(full_or_single_new)
+    ratio = np.array([N_exposures_euclid_new/N_exposures_euclid]*4 + list(np.array(N_exposures_lsst_new)/np.array(N_exposures_lsst)))
+    sky_level_pixel[:] = list(np.array(sky_level_pixel) * ratio)
+    coeff_exp[:] = list(np.array(coeff_exp) * ratio)
+    full_or_single, N_exposures_lsst, N_exposures_euclid = full_or_single_new, N_exposures_lsst_new, N_exposures_euclid_new
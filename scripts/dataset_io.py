@@ -0,0 +1,518 @@
+# Import packages
+
+import numpy as np
+import os
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+########## COMPACT STORAGE OF THE TEST SAMPLES
+# In the test sample, the images of a file are saved with np.save as an array [N, nmax_blend+1, 10, S, S]: the noiseless
+# images of the galaxies, padded with empty slots up to nmax_blend, and the noisy blend in the last slot.
+# The compact layout only keeps the galaxies actually drawn, each one cropped to its bounding box (common to all bands),
+# in a CSR-like structure saved in a directory root_i+'_images_compact/':
+#   - pixels.npy: pixels of all the cropped galaxies, flattened and concatenated
+#   - pixel_offsets.npy: start of each galaxy in pixels (n_galaxies+1)
+#   - bbox.npy: bounding box [ymin, ymax, xmin, xmax] (python slice convention) of each galaxy in the stamp
+#   - galaxy_offsets.npy: index of the first galaxy of each image (N+1)
+#   - blends.npy: noisy blends [N, 10, S, S]
+#   - shape.npy: [nmax_blend, number of bands, S]
+# The arrays are saved separately so that the reader can memory-map them and only load the images it is asked for.
+
+def bounding_box(image):
+    '''
+    Return the bounding box [ymin, ymax, xmin, xmax] of the non-zero pixels of an image in all bands ([0, 0, 0, 0] if empty)
+
+    Parameters:
+    ----------
+    image: noiseless image of a galaxy [band, S, S]
+    '''
+    nonzero = np.any(image != 0, axis=0)
+    if not np.any(nonzero):
+        return np.zeros(4, dtype=np.int32)
+    rows = np.where(np.any(nonzero, axis=1))[0]
+    cols = np.where(np.any(nonzero, axis=0))[0]
+    return np.array([rows[0], rows[-1]+1, cols[0], cols[-1]+1], dtype=np.int32)
+
+
+def save_compact_test(path, galaxies_noiseless, blends, nb_blended_gal, crop=True):
+    '''
+    Save the images of a test file in the compact layout
+
+    Parameters:
+    ----------
+    path: directory in which the arrays are saved (e.g. save_dir/root_i+'_images_compact')
+    galaxies_noiseless: noiseless images of the galaxies of each image [N, nmax_blend, 10, S, S] (or list of [nmax_blend, 10, S, S])
+    blends: noisy blended images [N, 10, S, S]
+    nb_blended_gal: number of galaxies drawn in each image
+    crop: crop each galaxy to its bounding box (otherwise the full stamps are kept)
+    '''
+    if not os.path.exists(path):
+        os.mkdir(path)
+    nmax_blend, n_bands, stamp_size = np.shape(galaxies_noiseless[0])[:3]
+    galaxy_offsets = np.concatenate([[0], np.cumsum(nb_blended_gal)]).astype(np.int64)
+    bbox = np.zeros((galaxy_offsets[-1], 4), dtype=np.int32)
+    pixels = []
+    for i, n in enumerate(nb_blended_gal):
+        for m in range(n):
+            gal = galaxies_noiseless[i][m]
+            k = galaxy_offsets[i]+m
+            bbox[k] = bounding_box(gal) if crop else [0, stamp_size, 0, stamp_size]
+            pixels.append(gal[:, bbox[k,0]:bbox[k,1], bbox[k,2]:bbox[k,3]].ravel())
+    pixel_offsets = np.concatenate([[0], np.cumsum([len(p) for p in pixels])]).astype(np.int64)
+    pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.asarray(blends).dtype)
+
+    np.save(os.path.join(path, 'pixels.npy'), pixels)
+    np.save(os.path.join(path, 'pixel_offsets.npy'), pixel_offsets)
+    np.save(os.path.join(path, 'bbox.npy'), bbox)
+    np.save(os.path.join(path, 'galaxy_offsets.npy'), galaxy_offsets)
+    np.save(os.path.join(path, 'blends.npy'), np.asarray(blends))
+    np.save(os.path.join(path, 'shape.npy'), np.array([nmax_blend, n_bands, stamp_size]))
+
+
+class CompactTestImages(object):
+    '''
+    Lazy reader of a test file saved in the compact layout. images[i] returns the dense array [nmax_blend+1, 10, S, S]
+    of the image i (same layout as the _images.npy files: noiseless galaxies, empty slots and noisy blend in the last slot)
+
+    Parameters:
+    ----------
+    path: directory of the compact layout (e.g. save_dir/root_i+'_images_compact')
+    '''
+    def __init__(self, path):
+        self.pixels = np.load(os.path.join(path, 'pixels.npy'), mmap_mode='r')
+        self.pixel_offsets = np.load(os.path.join(path, 'pixel_offsets.npy'))
+        self.bbox = np.load(os.path.join(path, 'bbox.npy'))
+        self.galaxy_offsets = np.load(os.path.join(path, 'galaxy_offsets.npy'))
+        self.blends = np.load(os.path.join(path, 'blends.npy'), mmap_mode='r')
+        self.nmax_blend, self.n_bands, self.stamp_size = np.load(os.path.join(path, 'shape.npy'))
+        self.shape = (len(self.blends), self.nmax_blend+1, self.n_bands, self.stamp_size, self.stamp_size)
+
+    def __len__(self):
+        return len(self.blends)
+
+    def nb_blended_gal(self, i):
+        '''
+        Return the number of galaxies of the image i
+        '''
+        return self.galaxy_offsets[i+1] - self.galaxy_offsets[i]
+
+    def galaxy(self, i, m):
+        '''
+        Return the noiseless image [10, S, S] of the galaxy m of the image i
+        '''
+        k = self.galaxy_offsets[i]+m
+        ymin, ymax, xmin, xmax = self.bbox[k]
+        image = np.zeros((self.n_bands, self.stamp_size, self.stamp_size), dtype=self.pixels.dtype)
+        image[:, ymin:ymax, xmin:xmax] = self.pixels[self.pixel_offsets[k]:self.pixel_offsets[k+1]].reshape(self.n_bands, ymax-ymin, xmax-xmin)
+        return image
+
+    def galaxies(self, i):
+        '''
+        Return the noiseless images [nb_blended_gal, 10, S, S] of the galaxies of the image i (without the empty slots)
+        '''
+        return np.array([self.galaxy(i, m) for m in range(self.nb_blended_gal(i))]).reshape(-1, self.n_bands, self.stamp_size, self.stamp_size)
+
+    def blend(self, i):
+        '''
+        Return the noisy blended image [10, S, S] of the image i
+        '''
+        return np.array(self.blends[i])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return np.array([self[j] for j in range(*i.indices(len(self)))])
+        image = np.zeros(self.shape[1:], dtype=self.blends.dtype)
+        n = self.nb_blended_gal(i)
+        image[:n] = self.galaxies(i)
+        image[-1] = self.blends[i]
+        return image
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+########## CHUNKED COMPRESSED STORAGE
+# The stamps are mostly sky background, so the arrays of images compress well. An array [N, ...] is saved in a directory
+# in chunks of chunk_size images along the first axis, each one compressed independently:
+#   - meta.json: shape, dtype, chunk_size, codec and quantization step of each band (or null)
+#   - chunk_00000.bin, chunk_00001.bin, ...: compressed chunks
+# The bytes of the values are shuffled before the compression (all the first bytes, then all the second bytes, ...),
+# which groups the exponents of the floats together and compresses much better.
+# Lossless codecs: 'zlib' (standard library) or 'zstd' (needs the zstandard package, faster).
+# Optional lossy quantization: the values are rounded to a step equal to quantization times the sky noise of their band
+# (sqrt(sky_level_pixel)) and saved as integers. quantization=0.1 adds an error of 0.03 sigma of the sky noise (rms).
+# Reads decompress the chunks in threads (zlib and zstandard release the GIL).
+
+def _compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        raise NotImplementedError(codec)
+
+
+def _decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise NotImplementedError(codec)
+
+
+def _shuffle(array):
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, shape):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+def save_chunked(path, array, chunk_size=64, codec='zlib', level=1, quantization=None, sky_level_pixel=None, band_axis=2):
+    '''
+    Save an array of images [N, ...] in compressed chunks of chunk_size images
+
+    Parameters:
+    ----------
+    path: directory in which the chunks are saved (e.g. save_dir/root_i+'_images_chunked')
+    array: array to save (or list of arrays of the same shape, possibly empty)
+    chunk_size: number of images per chunk
+    codec: lossless compression codec, 'zlib' or 'zstd'
+    level: compression level of the codec
+    quantization: quantization step in units of the sky noise of each band (lossless if None)
+    sky_level_pixel: sky level per pixel of each band (needed for the quantization)
+    band_axis: axis of the bands in array (2 for the _images.npy arrays [N, 2 or nmax_blend+1, 10, S, S])
+    '''
+    array = np.asarray(array)
+    if not os.path.exists(path):
+        os.mkdir(path)
+    if quantization is not None:
+        step = quantization * np.sqrt(np.asarray(sky_level_pixel, dtype=np.float64))
+        # An empty list of images has no band axis (and no chunk to quantize)
+        if array.ndim > band_axis:
+            step_shape = [1]*array.ndim
+            step_shape[band_axis] = len(step)
+            step_array = step.reshape(step_shape)
+        step = step.tolist()
+    else:
+        step = None
+
+    for k, start in enumerate(range(0, len(array), chunk_size)):
+        chunk = array[start:start+chunk_size]
+        if step is not None:
+            chunk = np.round(chunk / step_array).astype(np.int32)
+        with open(os.path.join(path, 'chunk_{0:05d}.bin'.format(k)), 'wb') as f:
+            f.write(_compress(_shuffle(chunk), codec, level))
+
+    meta = {'shape': list(array.shape), 'dtype': array.dtype.str, 'chunk_size': chunk_size, 'codec': codec, 'quantization_step': step, 'band_axis': band_axis}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class ChunkedArray(object):
+    '''
+    Reader of an array saved with save_chunked. Indexing along the first axis (integer, slice or tuple starting with one of them)
+    only decompresses the chunks needed, in threads
+
+    Parameters:
+    ----------
+    path: directory of the chunks
+    threads: number of threads used to decompress the chunks
+    '''
+    def __init__(self, path, threads=4):
+        self.path = path
+        self.threads = threads
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunk_size = meta['chunk_size']
+        self.codec = meta['codec']
+        self.n_chunks = (self.shape[0] + self.chunk_size - 1) // self.chunk_size
+        if meta['quantization_step'] is not None and len(self.shape) > meta['band_axis']:
+            step_shape = [1]*len(self.shape)
+            step_shape[meta['band_axis']] = len(meta['quantization_step'])
+            self.step = np.array(meta['quantization_step']).reshape(step_shape)
+        else:
+            self.step = None
+        # Last chunk read, for sequential accesses to the images one by one
+        self._last_chunk = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_chunk(self, k):
+        '''
+        Return the decompressed chunk k
+        '''
+        n = min(self.chunk_size, self.shape[0] - k*self.chunk_size)
+        with open(os.path.join(self.path, 'chunk_{0:05d}.bin'.format(k)), 'rb') as f:
+            data = _decompress(f.read(), self.codec)
+        if self.step is not None:
+            return (_unshuffle(data, np.int32, (n,)+self.shape[1:]) * self.step).astype(self.dtype)
+        return _unshuffle(data, self.dtype, (n,)+self.shape[1:])
+
+    def _read(self, indices):
+        if len(indices) == 0:
+            return np.empty((0,)+self.shape[1:], dtype=self.dtype)
+        chunks = np.unique(indices // self.chunk_size)
+        if len(chunks) == 1 and self._last_chunk[0] == chunks[0]:
+            data = {chunks[0]: self._last_chunk[1]}
+        elif len(chunks) > 1 and self.threads > 1:
+            with ThreadPoolExecutor(self.threads) as executor:
+                data = dict(zip(chunks, executor.map(self.read_chunk, chunks)))
+        else:
+            data = {k: self.read_chunk(k) for k in chunks}
+        self._last_chunk = (chunks[-1], data[chunks[-1]])
+        out = np.empty((len(indices),)+self.shape[1:], dtype=self.dtype)
+        for j, i in enumerate(indices):
+            out[j] = data[i // self.chunk_size][i % self.chunk_size]
+        return out
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        if isinstance(index, slice):
+            out = self._read(np.arange(len(self))[index])
+            return out[(slice(None),)+rest]
+        i = int(index)
+        if i < 0:
+            i += len(self)
+        return self._read(np.array([i]))[0][rest]
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+
+########## INCREMENTAL DATASETS
+# The files of a dataset (root_0, root_1, ... in save_dir) are listed in the manifest save_dir/root+'manifest.json':
+#   - files: name, number of images, block of seeds (first seed and number of seeds) and configuration of the run of
+#     each file, in the order of the rows of the dataset
+#   - n_images: total number of images
+#   - next_seed: first seed of the block of the next file
+# In append mode (see main_generation_cosmos.py), new files are added after the existing ones with a block of seeds
+# after all the recorded blocks, so that the new images never repeat existing ones, and the existing files are never
+# rewritten. Files written without manifest are listed with seed_block None: their images were seeded from the entropy
+# of the system (np.random.seed()), not from blocks, and the blocks of the new files start at 0. The manifest is
+# replaced atomically once a new file is completely written: a reader opening the dataset (Dataset) sees either all
+# the rows of the new file or none of them.
+
+def _has_images(save_dir, root_i):
+    return any(os.path.exists(os.path.join(save_dir, root_i+suffix)) for suffix in ['_images_compact', '_images_chunked', '_images.npy'])
+
+
+def open_images(save_dir, root_i):
+    '''
+    Return the images of a file whatever its layout: compact (CompactTestImages), chunked (ChunkedArray), _images.npy
+    (memory-mapped) or native stamps of each instrument (NativeStampImages, resampled to a uniform cube)
+
+    Parameters:
+    ----------
+    save_dir: directory of the files
+    root_i: name of the file (e.g. galaxies_blended_20191024_0)
+    '''
+    if os.path.exists(os.path.join(save_dir, root_i+'_images_compact')):
+        return CompactTestImages(os.path.join(save_dir, root_i+'_images_compact'))
+    elif os.path.exists(os.path.join(save_dir, root_i+'_images_chunked')):
+        return ChunkedArray(os.path.join(save_dir, root_i+'_images_chunked'))
+    elif not os.path.exists(os.path.join(save_dir, root_i+'_images.npy')) and _has_images(save_dir, root_i+'_lsst'):
+        return NativeStampImages(save_dir, root_i)
+    return np.load(os.path.join(save_dir, root_i+'_images.npy'), mmap_mode='r')
+
+
+def _index_existing_files(save_dir, root):
+    '''
+    Return the manifest of the files root_i of save_dir written without manifest (seed_block None: seeded from the entropy of the system)
+    '''
+    indices = sorted(int(f[len(root):-len('_data.csv')]) for f in os.listdir(save_dir)
+                     if f.startswith(root) and f.endswith('_data.csv') and f[len(root):-len('_data.csv')].isdigit())
+    files = []
+    for i in indices:
+        with open(os.path.join(save_dir, root+str(i)+'_data.csv')) as f:
+            n_images = sum(1 for line in f) - 1
+        files.append({'name': root+str(i), 'n_images': n_images, 'seed_block': None})
+    return {'files': files, 'n_images': sum(f['n_images'] for f in files), 'next_seed': None}
+
+
+def read_manifest(save_dir, root, index_existing=False):
+    '''
+    Return the manifest of the dataset (None if there is none)
+
+    Parameters:
+    ----------
+    save_dir: directory of the files
+    root: root of the names of the files (e.g. galaxies_blended_20191024_)
+    index_existing: if there is no manifest, return the manifest of the files already in save_dir instead of None
+    '''
+    try:
+        with open(os.path.join(save_dir, root+'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        if index_existing and os.path.isdir(save_dir):
+            return _index_existing_files(save_dir, root)
+        return None
+
+
+def write_manifest(save_dir, root, manifest):
+    '''
+    Replace the manifest of the dataset atomically
+
+    Parameters:
+    ----------
+    save_dir: directory of the files
+    root: root of the names of the files
+    manifest: manifest (see read_manifest)
+    '''
+    manifest_file = os.path.join(save_dir, root+'manifest.json')
+    # Write then rename so that readers never see a partial manifest
+    tmp_file = manifest_file+'.{0}.tmp'.format(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+class Dataset(object):
+    '''
+    Reader of the files of a dataset listed in its manifest, as they were when the dataset was opened. dataset[i]
+    returns the images of the row i of the dataset (rows numbered across the files in the order of the manifest)
+
+    Parameters:
+    ----------
+    save_dir: directory of the files
+    root: root of the names of the files (e.g. galaxies_blended_20191024_)
+    '''
+    def __init__(self, save_dir, root):
+        self.save_dir = save_dir
+        self.manifest = read_manifest(save_dir, root, index_existing=True)
+        self.files = [f['name'] for f in self.manifest['files']]
+        self.offsets = np.cumsum([0]+[f['n_images'] for f in self.manifest['files']])
+        self._images = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, i):
+        '''
+        Return the name of the file of the row i and the index of the image in this file
+        '''
+        k = np.searchsorted(self.offsets, i, side='right') - 1
+        return self.files[k], int(i - self.offsets[k])
+
+    def images(self, name):
+        '''
+        Return the images of the file name (see open_images)
+        '''
+        if name not in self._images:
+            self._images[name] = open_images(self.save_dir, name)
+        return self._images[name]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        name, j = self.locate(i)
+        return self.images(name)[j]
+
+    def data(self):
+        '''
+        Return the data of all the rows (concatenation of the _data.csv files)
+        '''
+        import pandas as pd
+        return pd.concat([pd.read_csv(os.path.join(self.save_dir, name+'_data.csv')) for name in self.files], ignore_index=True)
+
+    def shifts(self):
+        '''
+        Return the shifts of all the rows (concatenation of the _shifts.npy files)
+        '''
+        return np.concatenate([np.load(os.path.join(self.save_dir, name+'_shifts.npy')) for name in self.files])
+
+
+########## NATIVE STAMPS OF EACH INSTRUMENT
+# With the native_stamps option of the generation, the images of each instrument cover the same footprint at the pixel
+# scale of the instrument (see cosmos_params.native_stamp_sizes) and are saved in separate files root_i_nir, root_i_vis
+# and root_i_lsst (in any of the layouts above). NativeStampImages resamples them to a uniform cube for the consumers
+# which need the same grid in all bands (the LSST grid by default).
+
+def resample_stamps(images, scale_in, scale_out, size_out, order=1):
+    '''
+    Return the images [..., S_in, S_in] resampled to stamps [..., size_out, size_out] of pixel scale scale_out with the
+    same center, conserving the flux. Integer down-sampling factors are done by summing blocks of pixels (exact), others
+    by interpolation of order `order`
+
+    Parameters:
+    ----------
+    images: images to resample, the last two axes are the pixels
+    scale_in: pixel scale of the images
+    scale_out: pixel scale of the resampled stamps
+    size_out: size of the resampled stamps
+    order: order of the spline interpolation
+    '''
+    images = np.asarray(images)
+    size_in = images.shape[-1]
+    if scale_in == scale_out and size_in == size_out:
+        return images
+    factor = scale_out / scale_in
+    if np.isclose(factor, np.round(factor)) and size_in == int(np.round(factor))*size_out:
+        k = int(np.round(factor))
+        return images.reshape(images.shape[:-2]+(size_out, k, size_out, k)).sum(axis=(-3, -1))
+    from scipy import ndimage
+    # Pixel j of size S is at (j - (S-1)/2)*scale of the center
+    coords = (np.arange(size_out) - (size_out-1)/2.) * factor + (size_in-1)/2.
+    y, x = np.meshgrid(coords, coords, indexing='ij')
+    flat = images.reshape((-1, size_in, size_in))
+    out = np.array([ndimage.map_coordinates(image, [y, x], order=order, mode='constant') for image in flat]) * factor**2
+    return out.reshape(images.shape[:-2]+(size_out, size_out))
+
+
+class NativeStampImages(object):
+    '''
+    Reader of a file saved with native stamps. native(i) returns the images of the image i of each instrument, images[i]
+    the uniform cube [..., 10, stamp_size, stamp_size] of all the bands resampled to the pixel scale pixel_scale_out
+
+    Parameters:
+    ----------
+    save_dir: directory of the files
+    root_i: name of the file (e.g. galaxies_blended_20191024_0)
+    pixel_scale_out: pixel scale of the uniform cube (LSST pixel scale by default)
+    stamp_size: size of the uniform cube (size of the LSST stamps by default)
+    '''
+    def __init__(self, save_dir, root_i, pixel_scale_out=None, stamp_size=None):
+        from cosmos_params import instrument_bands, pixel_scale
+        self.instrument_bands = instrument_bands
+        self.pixel_scale = pixel_scale
+        self.images = {instrument: open_images(save_dir, root_i+'_'+instrument) for instrument in instrument_bands}
+        self.pixel_scale_out = pixel_scale_out or pixel_scale[instrument_bands['lsst'][0]]
+        self.stamp_size = stamp_size or self.images['lsst'].shape[-1]
+        shape = self.images['lsst'].shape
+        self.shape = shape[:-3] + (len(pixel_scale), self.stamp_size, self.stamp_size)
+
+    def __len__(self):
+        return len(self.images['lsst'])
+
+    def native(self, i):
+        '''
+        Return the images of the image i of each instrument {instrument: [..., number of bands of the instrument, S, S]}
+        '''
+        return {instrument: np.asarray(images[i]) for instrument, images in self.images.items()}
+
+    def __getitem__(self, i):
+        if isinstance(i, tuple):
+            return self[i[0]][(slice(None),)+i[1:]] if isinstance(i[0], slice) else self[i[0]][i[1:]]
+        if isinstance(i, slice):
+            return np.array([self[j] for j in range(*i.indices(len(self)))])
+        native = self.native(i)
+        cube = np.zeros(native['lsst'].shape[:-3] + (len(self.pixel_scale), self.stamp_size, self.stamp_size), dtype=native['lsst'].dtype)
+        for instrument, bands in self.instrument_bands.items():
+            cube[..., bands, :, :] = resample_stamps(native[instrument], self.pixel_scale[bands[0]], self.pixel_scale_out, self.stamp_size)
+        return cube
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,184 @@
+# Import packages
+
+import numpy as np
+import os
+import galsim
+
+from cosmos_params import *
+
+from images_utils import get_cosmos_catalog, draw_galaxy_stamp, good_stamp_size
+
+########## LARGE FIELD GENERATION
+# A field of field_size x field_size arcsec is divided in tiles of tile_size x tile_size arcsec drawn independently.
+# Each galaxy is only drawn in a stamp limited to its extent and added to all the tiles its stamp overlaps (in any band),
+# so the cost scales with the number of galaxies rather than with the area of the field times the number of galaxies,
+# and the galaxies crossing the edge of a tile are drawn on both sides of the edge.
+# The tile size must be a multiple of 0.6 arcsec so that the tiles fall on the pixel grid of all the bands.
+
+def place_galaxies(n_gal, field_size, used_idx):
+    '''
+    Return the catalog indexes, positions (in arcsec from the lower left corner of the field) and rotation angles (in degrees) of galaxies placed uniformly in the field
+
+    Parameters:
+    ----------
+    n_gal: number of galaxies to place (before the magnitude cut)
+    field_size: size of the field in arcsec
+    used_idx: indexes to use in the catalog
+    '''
+    idx = np.random.choice(used_idx, size=n_gal)
+    positions = np.random.uniform(0., field_size, size=(n_gal, 2))
+    rotations = np.random.uniform(0., 360., size=n_gal)
+    return idx, positions, rotations
+
+
+def field_psfs(fwhm_lsst):
+    '''
+    Return the PSF of each band for the FWHM of the LSST PSF of the field
+    '''
+    return [PSF_euclid_nir]*3 + [PSF_euclid_vis] + [galsim.Kolmogorov(fwhm=fwhm_lsst)]*6
+
+
+def galaxy_extent(cosmos_cat_dir, i, rotation, fwhm_lsst, mag_cut=27.5, bands=range(10)):
+    '''
+    Return the magnitude of a galaxy and the half size (in arcsec) of the largest stamp in which it is drawn in the bands
+    (0 if the galaxy is rejected by the magnitude cut)
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: COSMOS catalog directory
+    i: catalog index of the galaxy
+    rotation: rotation angle of the galaxy in degrees
+    fwhm_lsst: FWHM of the LSST PSF of the field
+    mag_cut: cut in magnitude to select galaxies below this magnitude
+    bands: filter numbers in which the field is drawn
+    '''
+    gal = get_cosmos_catalog(cosmos_cat_dir).makeGalaxy(i, gal_type='parametric', chromatic=True, noise_pad_size=0)
+    mag = gal.calculateMagnitude(filters['r'].withZeropoint(28.13))
+    if not mag < mag_cut:
+        return mag, 0.
+    gal = gal.rotate(rotation * galsim.degrees)
+    PSF = field_psfs(fwhm_lsst)
+    # The stamp of size S drawn by draw_galaxy_stamp extends up to S//2 pixels (plus the rounding of the center) from the center
+    extent = max((good_stamp_size(galsim.Convolve([gal*coeff_exp[band], PSF[band]]), pixel_scale[band], filters[filter_names_all[band]])//2 + 1) * pixel_scale[band]
+                 for band in bands)
+    return mag, extent
+
+
+def _galaxy_extent(args):
+    return galaxy_extent(*args)
+
+
+def tile_galaxies(positions, extents, field_size, tile_size):
+    '''
+    Return, for each tile, the list of the galaxies whose stamp overlaps the tile
+
+    Parameters:
+    ----------
+    positions: positions of the galaxies in arcsec
+    extents: half size (in arcsec) of the stamp of each galaxy (see galaxy_extent), galaxies with extent 0 are not drawn
+    field_size: size of the field in arcsec
+    tile_size: size of the tiles in arcsec
+    '''
+    n_tiles = int(round(field_size/tile_size))
+    drawn = extents > 0
+    tiles = []
+    for ty in range(n_tiles):
+        for tx in range(n_tiles):
+            x0, y0 = tx*tile_size, ty*tile_size
+            inside = (drawn & (positions[:,0]+extents > x0) & (positions[:,0]-extents < x0+tile_size) &
+                      (positions[:,1]+extents > y0) & (positions[:,1]-extents < y0+tile_size))
+            tiles.append((tx, ty, np.where(inside)[0]))
+    return tiles
+
+
+def tile_bounds(tx, ty, tile_size, band):
+    '''
+    Return the bounds (galsim.BoundsI) of the tile in the pixel grid of the band covering the whole field
+    '''
+    n_pix = int(round(tile_size/pixel_scale[band]))
+    return galsim.BoundsI(tx*n_pix+1, (tx+1)*n_pix, ty*n_pix+1, (ty+1)*n_pix)
+
+
+def draw_tile(cosmos_cat_dir, tx, ty, tile_size, idx, positions, rotations, fwhm_lsst, bands=range(10), seed=None):
+    '''
+    Return the noisy images of a tile in each band
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: COSMOS catalog directory
+    tx, ty: coordinates of the tile in the field
+    tile_size: size of the tile in arcsec
+    idx: catalog indexes of the galaxies to draw in the tile (passing the magnitude cut)
+    positions: positions of these galaxies in arcsec from the lower left corner of the field
+    rotations: rotation angles of these galaxies in degrees
+    fwhm_lsst: FWHM of the LSST PSF of the field
+    bands: filter numbers in which the tile is drawn
+    seed: seed of the noise realization
+    '''
+    cosmos_cat = get_cosmos_catalog(cosmos_cat_dir)
+    PSF = field_psfs(fwhm_lsst)
+    noise_rng = galsim.BaseDeviate(seed)
+
+    galaxies = [cosmos_cat.makeGalaxy(i, gal_type='parametric', chromatic=True, noise_pad_size=0).rotate(rotation * galsim.degrees)
+                for i, rotation in zip(idx, rotations)]
+
+    images = {}
+    for band in bands:
+        image = galsim.ImageF(tile_bounds(tx, ty, tile_size, band), scale=pixel_scale[band])
+        for gal, (x, y) in zip(galaxies, positions):
+            gal_psf = galsim.Convolve([gal*coeff_exp[band], PSF[band]])
+            draw_galaxy_stamp(gal_psf, image, galsim.PositionD(x/pixel_scale[band]+0.5, y/pixel_scale[band]+0.5), filters[filter_names_all[band]])
+        image.addNoise(galsim.PoissonNoise(noise_rng, sky_level=sky_level_pixel[band]))
+        images[band] = image.array
+    return images
+
+
+def _draw_tile(args):
+    return draw_tile(*args)
+
+
+def image_generator_field(cosmos_cat_dir, field_size, n_gal, tile_size=60., used_idx=None, mag_cut=27.5, psf_lsst_fixed=False, bands=range(10), pool=None, seed=None):
+    '''
+    Return the noisy images of a field in each band (dictionary band number: array) and the catalog of its galaxies
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: COSMOS catalog directory
+    field_size: size of the field in arcsec (multiple of tile_size)
+    n_gal: number of galaxies placed in the field before the magnitude cut
+    tile_size: size of the tiles in arcsec (multiple of 0.6)
+    used_idx: indexes to use in the catalog
+    mag_cut: cut in magnitude to select galaxies below this magnitude
+    psf_lsst_fixed: choice to have a fixed LSST PSF for the field
+    bands: filter numbers in which the field is drawn
+    pool: multiprocessing pool used to draw the tiles (tiles are drawn sequentially if None)
+    seed: seed of the random generation
+    '''
+    assert abs(tile_size/0.6 - round(tile_size/0.6)) < 1e-9, 'tile_size must be a multiple of 0.6 arcsec'
+    assert abs(field_size/tile_size - round(field_size/tile_size)) < 1e-9, 'field_size must be a multiple of tile_size'
+    np.random.seed(seed)
+    if used_idx is None:
+        used_idx = np.arange(get_cosmos_catalog(cosmos_cat_dir).nobjects)
+    _, fwhm_lsst = psf_lsst(psf_lsst_fixed=psf_lsst_fixed)
+    idx, positions, rotations = place_galaxies(n_gal, field_size, used_idx)
+
+    # Magnitude and extent of the stamp of each galaxy, computed once whatever the number of tiles it overlaps
+    tasks = [(cosmos_cat_dir, i, rotation, fwhm_lsst, mag_cut, list(bands)) for i, rotation in zip(idx, rotations)]
+    extents = pool.map(_galaxy_extent, tasks, chunksize=max(1, len(tasks)//(4*os.cpu_count()))) if pool is not None else list(map(_galaxy_extent, tasks))
+    mags, extents = np.array(extents, dtype=float).reshape(-1, 2).T
+
+    tiles = tile_galaxies(positions, extents, field_size, tile_size)
+    tile_seeds = np.random.randint(1, 2**31-1, size=len(tiles))
+    tasks = [(cosmos_cat_dir, tx, ty, tile_size, idx[in_tile], positions[in_tile], rotations[in_tile], fwhm_lsst, list(bands), int(tile_seed))
+             for (tx, ty, in_tile), tile_seed in zip(tiles, tile_seeds)]
+    results = pool.imap(_draw_tile, tasks) if pool is not None else map(_draw_tile, tasks)
+
+    fields = {band: np.zeros((int(round(field_size/pixel_scale[band])),)*2, dtype=np.float32) for band in bands}
+    for (tx, ty, in_tile), images in zip(tiles, results):
+        for band in bands:
+            b = tile_bounds(tx, ty, tile_size, band)
+            fields[band][b.ymin-1:b.ymax, b.xmin-1:b.xmax] = images[band]
+
+    keep = mags < mag_cut
+    catalog = {'idx': idx[keep], 'x': positions[keep,0], 'y': positions[keep,1], 'rotation': rotations[keep], 'mag': mags[keep], 'fwhm_lsst': np.full(np.sum(keep), fwhm_lsst)}
+    return fields, catalog
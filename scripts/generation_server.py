@@ -0,0 +1,321 @@
+# Import packages
+
+import numpy as np
+import sys
+import os
+import json
+import time
+import asyncio
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# The server is started as, eg,
+# >> python generation_server.py /tmp/imgen.sock 16
+# to keep 16 warm workers (catalog, fit table and filters loaded once) generating images for the clients connected to
+# the Unix socket /tmp/imgen.sock. A training job then gets batches with
+# >> client = GenerationClient('/tmp/imgen.sock', 'job_1')
+# >> galaxy_noiseless, blend_noisy, data, shifts = client.generate('sim', {'training_or_test': 'training', 'isolated_or_blended': 'blended'}, 0, 256)
+# The images of a batch are written by the workers in a shared memory block which the client copies, instead of being
+# pickled from the workers to the server and from the server to the client.
+#
+# Protocol: one json per line on the socket.
+#   {"op": "generate", "client": name, "generator": "sim" or "real", "config": {...}, "seeds": [start, stop]}
+#       config: keyword arguments of image_generator_sim/image_generator_real (cosmos_cat_dir and used_idx are set by the server)
+#       (native_stamps is not supported: the stamps of the instruments have different sizes)
+#       answer: {"shm": name, "n": number of images, "galaxy_shape": [...], "blend_shape": [...], "data": [...], "shifts": [...], "failed": [seeds]}
+#       The client must send {"op": "release", "shm": name} once it has copied the images. The blocks not released by a
+#       client are released when its connection is closed.
+#   {"op": "stats"}: number of batches and images, throughput and latency of each client
+# Backpressure: a connection is not read while its batch is generated, at most max_pending images are generated at the
+# same time for all clients and the memory of the blocks not yet released by the clients is limited to max_shm_memory MB.
+
+max_pending_factor = 2 # max_pending = max_pending_factor * number of workers
+max_shm_memory = 4096 # in MB
+
+############ WORKERS
+def _init_worker(cosmos_cat_dir):
+    # Load the catalog and the fit table once per worker
+    from images_utils import get_cosmos_catalog, get_fit_table
+    get_cosmos_catalog(cosmos_cat_dir)
+    get_fit_table(cosmos_cat_dir)
+
+
+def _attach(name, untrack=False):
+    '''
+    Return the shared memory block name
+
+    Parameters:
+    ----------
+    name: name of the block
+    untrack: unregister the block from the resource tracker of the process, so that it is not unlinked at the exit of a
+        process which does not own it (the workers share the resource tracker of the server and must not unregister it)
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    if not untrack:
+        return shm
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def _generate_into(generator, kwargs, seed, shm_name, k, n, galaxy_shape, blend_shape):
+    '''
+    Generate the image of the seed and write it at the index k of the arrays of the shared memory block. Return its data and shifts
+    '''
+    import images_generator
+    func = {'sim': images_generator.image_generator_sim, 'real': images_generator.image_generator_real}[generator]
+    galaxy_noiseless, blend_noisy, data, shift = func(**dict(kwargs, seed=seed))
+    shm = _attach(shm_name)
+    try:
+        galaxies, blends = _views(shm, n, galaxy_shape, blend_shape)
+        galaxies[k] = galaxy_noiseless
+        blends[k] = blend_noisy
+        del galaxies, blends
+    finally:
+        shm.close()
+    return {key: (value.tolist() if isinstance(value, (np.generic, np.ndarray)) else value) for key, value in data.items()}, np.asarray(shift).tolist()
+
+
+def _views(shm, n, galaxy_shape, blend_shape):
+    '''
+    Return the arrays of noiseless galaxies [n, *galaxy_shape] and noisy blends [n, *blend_shape] of a shared memory block
+    '''
+    n_galaxies = n * int(np.prod(galaxy_shape))
+    galaxies = np.ndarray((n,)+tuple(galaxy_shape), dtype=np.float64, buffer=shm.buf)
+    blends = np.ndarray((n,)+tuple(blend_shape), dtype=np.float64, buffer=shm.buf, offset=8*n_galaxies)
+    return galaxies, blends
+
+
+def _batch_shapes(generator, config):
+    '''
+    Return the shapes of a noiseless galaxy image and of a blend generated with the config
+    '''
+    stamp_size = config.get('max_stamp_size', 64)
+    nmax_blend = config.get('nmax_blend', 4)
+    nmax_blend = nmax_blend if np.shape(nmax_blend) == () else nmax_blend[1]
+    if config['training_or_test'] == 'test':
+        return [nmax_blend, 10, stamp_size, stamp_size], [10, stamp_size, stamp_size]
+    return [10, stamp_size, stamp_size], [10, stamp_size, stamp_size]
+
+
+############ SERVER
+class GenerationServer(object):
+    '''
+    Asyncio server generating images for the clients of a Unix socket with a pool of warm workers
+
+    Parameters:
+    ----------
+    socket_path: path of the Unix socket
+    cosmos_cat_dir: COSMOS catalog directory
+    processes: number of workers
+    '''
+    def __init__(self, socket_path, cosmos_cat_dir, processes=None):
+        from images_utils import get_cosmos_catalog, get_fit_table
+        self.socket_path = socket_path
+        self.cosmos_cat_dir = cosmos_cat_dir
+        self.processes = processes or os.cpu_count()
+        # Loaded before the workers are forked so that they inherit them
+        self.nobjects = get_cosmos_catalog(cosmos_cat_dir).nobjects
+        get_fit_table(cosmos_cat_dir)
+        self.executor = ProcessPoolExecutor(self.processes, initializer=_init_worker, initargs=(cosmos_cat_dir,))
+        self.blocks = {}
+        self.shm_bytes = 0
+        self.stats = defaultdict(lambda: {'batches': 0, 'images': 0, 'failed': 0, 'first': None, 'last': None, 'latencies': deque(maxlen=1000)})
+
+    async def start(self):
+        self.pending = asyncio.Semaphore(max_pending_factor * self.processes)
+        self.shm_released = asyncio.Condition()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle(self, reader, writer):
+        # Blocks generated for this connection and not released yet: they are released if the client disconnects or crashes
+        owned = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                try:
+                    if request['op'] == 'generate':
+                        answer = await self.generate(request)
+                        owned.add(answer['shm'])
+                    elif request['op'] == 'release':
+                        answer = await self.release(request['shm'])
+                        owned.discard(request['shm'])
+                    elif request['op'] == 'stats':
+                        answer = self.get_stats()
+                    else:
+                        raise NotImplementedError(request['op'])
+                except Exception as e:
+                    answer = {'error': repr(e)}
+                writer.write((json.dumps(answer)+'\n').encode())
+                await writer.drain()
+        finally:
+            for name in owned:
+                if name in self.blocks:
+                    await self.release(name)
+            writer.close()
+
+    def generator_kwargs(self, config):
+        '''
+        Return the keyword arguments of the generator: config completed with the catalog directory and the part of the catalog used
+        '''
+        kwargs = dict(config, cosmos_cat_dir=self.cosmos_cat_dir)
+        if 'used_idx' not in kwargs:
+            # Same split of the catalog as main_generation_cosmos.py
+            kwargs['used_idx'] = np.arange(5000) if config['training_or_test'] == 'test' else np.arange(5000, self.nobjects)
+        return kwargs
+
+    async def generate(self, request):
+        start = time.monotonic()
+        generator, config = request['generator'], request['config']
+        if generator not in ['sim', 'real']:
+            raise ValueError('generator must be sim or real')
+        if config.get('native_stamps', False):
+            # The images of each instrument have their own stamp size: a batch would need one block per instrument
+            raise NotImplementedError('native_stamps batches are not supported by the server, use main_generation_cosmos.py')
+        seeds = list(range(*request['seeds']))
+        n = len(seeds)
+        galaxy_shape, blend_shape = _batch_shapes(generator, config)
+        nbytes = 8 * n * (int(np.prod(galaxy_shape)) + int(np.prod(blend_shape)))
+
+        # Wait for the clients to release blocks if the memory limit is reached
+        async with self.shm_released:
+            await self.shm_released.wait_for(lambda: self.shm_bytes == 0 or self.shm_bytes + nbytes <= max_shm_memory * 1024**2)
+            self.shm_bytes += nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.blocks[shm.name] = (shm, nbytes)
+        galaxies, blends = _views(shm, n, galaxy_shape, blend_shape)
+        galaxies[:] = 0.
+        blends[:] = 0.
+        del galaxies, blends
+
+        kwargs = self.generator_kwargs(config)
+        loop = asyncio.get_running_loop()
+
+        async def run(k, seed):
+            async with self.pending:
+                return await loop.run_in_executor(self.executor, _generate_into, generator, kwargs, seed, shm.name, k, n, galaxy_shape, blend_shape)
+
+        results = await asyncio.gather(*[run(k, seed) for k, seed in enumerate(seeds)], return_exceptions=True)
+        failed = [seed for seed, res in zip(seeds, results) if isinstance(res, BaseException)]
+        data = [res[0] if not isinstance(res, BaseException) else None for res in results]
+        shifts = [res[1] if not isinstance(res, BaseException) else None for res in results]
+
+        stats = self.stats[request.get('client', 'default')]
+        end = time.monotonic()
+        stats['batches'] += 1
+        stats['images'] += n - len(failed)
+        stats['failed'] += len(failed)
+        stats['first'] = start if stats['first'] is None else stats['first']
+        stats['last'] = end
+        stats['latencies'].append(end - start)
+        return {'shm': shm.name, 'n': n, 'galaxy_shape': galaxy_shape, 'blend_shape': blend_shape, 'data': data, 'shifts': shifts, 'failed': failed}
+
+    async def release(self, name):
+        shm, nbytes = self.blocks.pop(name)
+        shm.close()
+        shm.unlink()
+        async with self.shm_released:
+            self.shm_bytes -= nbytes
+            self.shm_released.notify_all()
+        return {'released': name}
+
+    def get_stats(self):
+        '''
+        Return, for each client, the number of batches, images and failures, the throughput (images/s since its first request)
+        and the mean, median and 95th percentile of the latency of its last batches (in s)
+        '''
+        out = {}
+        for client, stats in self.stats.items():
+            latencies = np.array(stats['latencies'])
+            out[client] = {'batches': stats['batches'], 'images': stats['images'], 'failed': stats['failed'],
+                           'throughput': stats['images'] / max(stats['last'] - stats['first'], 1e-9),
+                           'latency_mean': float(np.mean(latencies)), 'latency_p50': float(np.percentile(latencies, 50)),
+                           'latency_p95': float(np.percentile(latencies, 95))}
+        return out
+
+    def close(self):
+        for shm, _ in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+############ CLIENT
+class GenerationClient(object):
+    '''
+    Client of a GenerationServer (blocking)
+
+    Parameters:
+    ----------
+    socket_path: path of the Unix socket of the server
+    name: name of the client in the statistics of the server
+    '''
+    def __init__(self, socket_path, name='default'):
+        import socket
+        self.name = name
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, request):
+        self.file.write((json.dumps(request)+'\n').encode())
+        self.file.flush()
+        answer = json.loads(self.file.readline())
+        if 'error' in answer:
+            raise RuntimeError(answer['error'])
+        return answer
+
+    def generate(self, generator, config, seed_start, seed_stop):
+        '''
+        Return the noiseless galaxies, noisy blends, data and shifts of the images of the seeds seed_start to seed_stop-1
+        (the images which failed are left empty and their data is None)
+
+        Parameters:
+        ----------
+        generator: 'sim' or 'real'
+        config: keyword arguments of the generator (at least training_or_test and isolated_or_blended)
+        seed_start, seed_stop: range of seeds of the images
+        '''
+        answer = self.request({'op': 'generate', 'client': self.name, 'generator': generator, 'config': config, 'seeds': [seed_start, seed_stop]})
+        shm = _attach(answer['shm'], untrack=True)
+        try:
+            galaxies, blends = _views(shm, answer['n'], answer['galaxy_shape'], answer['blend_shape'])
+            galaxies, blends = galaxies.copy(), blends.copy()
+        finally:
+            shm.close()
+            self.request({'op': 'release', 'shm': answer['shm']})
+        return galaxies, blends, answer['data'], answer['shifts']
+
+    def stats(self):
+        '''
+        Return the statistics of the clients of the server
+        '''
+        return self.request({'op': 'stats'})
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    socket_path = str(sys.argv[1])
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    server = GenerationServer(socket_path, os.path.join(data_dir, 'COSMOS_25.2_training_sample'), processes)
+    try:
+        asyncio.run(server.start())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,165 @@
+# Import packages
+
+import sys
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from cosmos_params import sky_level_pixel
+from images_generator import image_generator_sim
+from images_utils import get_cosmos_catalog, get_fit_table, get_used_idx
+
+# The script is used as, eg,
+# >> python golden_outputs.py record golden/ 100
+# to render the reference path (parameters below) on 100 seeded scenes (seeds 0 to 99) of the test sample and save the
+# images, data and rendering time in golden/, then, after a change of the code or to try a faster option,
+# >> python golden_outputs.py compare golden/ current accuracy_fast draw_auto
+# to render the same scenes with each candidate and print, in one table, its speed-up and its deviations from the
+# golden outputs with the tolerances below. 'current' is the reference path with the current code, the other
+# candidates are the reference path with the parameters of `candidates` changed, or a json file of such parameters.
+# The reference parameters can be changed with a json file given as last argument of record (e.g. {"peak_detection_method": "fast"}).
+# Rendering times are only comparable on the same machine.
+
+# Scenes: parameters of the generation, as in main_generation_cosmos.py
+reference = {'training_or_test': 'test', 'isolated_or_blended': 'blended', 'nmax_blend': (1,6), 'max_try': 100, 'mag_cut': 27.5,
+             'method_first_shift': 'uniform', 'method_others_shift': 'uniform', 'max_dx': 3.2, 'max_r': 2.,
+             'do_peak_detection': True, 'center_brightest': False, 'max_stamp_size': 64, 'psf_lsst_fixed': False,
+             'peak_detection_method': 'photutils', 'do_shape_measurement': True, 'accuracy': 'default', 'draw_method': 'fft'}
+
+# Candidate fast paths: parameters changed from the reference
+candidates = {'current': {},
+              'accuracy_fast': {'accuracy': 'fast'},
+              'draw_auto': {'draw_method': 'auto'},
+              'peaks_fast': {'peak_detection_method': 'fast'}}
+
+# Tolerances: maximum deviation from the golden outputs
+tolerances = {'pixels': 0.1, # maximum difference of the noiseless images, in units of the sky noise of the band
+              'SNR': 1.e-2, # maximum relative difference of the SNR of the central galaxy
+              'e_ksb': 1.e-2, # maximum difference of the KSB shapes (e1, e2) of the central galaxy
+              'mag': 1.e-2, # maximum difference of the magnitudes of the galaxies
+              'idx_closest_to_peak': 0., # fraction of scenes where the galaxy identified as the detected one changes
+              'ks_pvalue': 0.05} # minimum p-value of the KS tests of the distributions of SNR and blendedness
+
+def render(cosmos_cat_dir, parameters, seeds):
+    '''
+    Return the noiseless images, noisy blends, data and shifts of the scenes rendered with the parameters, and the rendering time
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: COSMOS catalog directory
+    parameters: keyword arguments of image_generator_sim (without cosmos_cat_dir and used_idx)
+    seeds: seeds of the scenes
+    '''
+    used_idx = get_used_idx(cosmos_cat_dir, parameters['training_or_test'])
+    galaxies, blends, data, shifts = [], [], [], []
+    t0 = time.perf_counter()
+    for seed in seeds:
+        galaxy_noiseless, blend_noisy, data_seed, shift = image_generator_sim(cosmos_cat_dir, used_idx=used_idx, seed=seed, **parameters)
+        galaxies.append(galaxy_noiseless)
+        blends.append(blend_noisy)
+        data.append(data_seed)
+        shifts.append(shift)
+    return np.array(galaxies), np.array(blends), pd.DataFrame(data), np.array(shifts), time.perf_counter()-t0
+
+
+def blendedness(galaxies, data):
+    '''
+    Return the blendedness (r band) of the central galaxy of each scene of the test sample (0 for isolated galaxies)
+    '''
+    import utils
+    out = []
+    for galaxy_noiseless, n in zip(galaxies, data['nb_blended_gal']):
+        out.append(utils.compute_blendedness_total(galaxy_noiseless[0,6], np.sum(galaxy_noiseless[1:n,6], axis=0)) if n > 1 else 0.)
+    return np.array(out)
+
+
+def central_shapes(data):
+    '''
+    Return the KSB shapes (e1, e2) of the central galaxy (first of the stack of noiseless images) of each scene: [scene, 2]
+    '''
+    # The shape columns are in the order of drawing: index of the central galaxy in this order
+    # (draw_idx_slot_0, or idx_closest_to_peak for data recorded before this column, when the brightest is not centered)
+    idx = data['draw_idx_slot_0'].values if 'draw_idx_slot_0' in data.columns else data['idx_closest_to_peak'].values
+    idx = idx.astype(int)
+    return np.array([[data['e1_ksb_'+str(k)].iloc[i], data['e2_ksb_'+str(k)].iloc[i]] for i, k in enumerate(idx)], dtype=np.float64)
+
+
+def deviations(golden, candidate):
+    '''
+    Return the deviations of the candidate outputs from the golden outputs (see tolerances)
+
+    Parameters:
+    ----------
+    golden, candidate: noiseless images, noisy blends and data of the scenes
+    '''
+    galaxies_ref, _, data_ref = golden
+    galaxies, _, data = candidate
+    sky_noise = np.sqrt(np.array(sky_level_pixel))[:, np.newaxis, np.newaxis]
+    mag_columns = [c for c in data_ref.columns if c.startswith('mag_')]
+    shapes_ref, shapes = central_shapes(data_ref), central_shapes(data)
+    out = {'pixels': np.max(np.abs(galaxies - galaxies_ref) / sky_noise),
+           'SNR': np.max(np.abs(data['SNR'] / data_ref['SNR'] - 1.)),
+           'e_ksb': np.nanmax(np.abs(shapes - shapes_ref)) if np.any(np.isfinite(shapes_ref)) else np.nan,
+           'mag': np.nanmax(np.abs(data[mag_columns].values - data_ref[mag_columns].values)),
+           'idx_closest_to_peak': np.mean(data['idx_closest_to_peak'].values != data_ref['idx_closest_to_peak'].values)}
+    blendedness_ref, blendedness_candidate = blendedness(galaxies_ref, data_ref), blendedness(galaxies, data)
+    out['ks_pvalue'] = min(stats.ks_2samp(data_ref['SNR'], data['SNR'])[1],
+                           stats.ks_2samp(blendedness_ref[blendedness_ref > 0], blendedness_candidate[blendedness_candidate > 0])[1] if np.any(blendedness_ref > 0) else 1.)
+    return out
+
+
+def passes(name, value):
+    if name == 'ks_pvalue':
+        return value >= tolerances[name]
+    return not (value > tolerances[name])
+
+
+if __name__ == '__main__':
+    mode = str(sys.argv[1])
+    golden_dir = str(sys.argv[2])
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    cosmos_cat_dir = os.path.join(data_dir, 'COSMOS_25.2_training_sample')
+    # Load the catalog and its tables before timing
+    get_cosmos_catalog(cosmos_cat_dir)
+    get_fit_table(cosmos_cat_dir)
+
+    if mode == 'record':
+        n_scenes = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        parameters = dict(reference)
+        if len(sys.argv) > 4:
+            with open(sys.argv[4]) as f:
+                parameters.update(json.load(f))
+        seeds = list(range(n_scenes))
+        galaxies, blends, data, shifts, t = render(cosmos_cat_dir, parameters, seeds)
+        os.makedirs(golden_dir, exist_ok=True)
+        np.savez_compressed(os.path.join(golden_dir, 'images.npz'), galaxies=galaxies, blends=blends, shifts=shifts)
+        data.to_csv(os.path.join(golden_dir, 'data.csv'), index=False)
+        with open(os.path.join(golden_dir, 'meta.json'), 'w') as f:
+            json.dump({'parameters': parameters, 'seeds': seeds, 'time': t}, f, indent=1)
+        print('{0} golden scenes saved in {1} ({2:.2f} scenes/s)'.format(n_scenes, golden_dir, n_scenes/t))
+
+    elif mode == 'compare':
+        with open(os.path.join(golden_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        images = np.load(os.path.join(golden_dir, 'images.npz'))
+        golden = (images['galaxies'], images['blends'], pd.read_csv(os.path.join(golden_dir, 'data.csv')))
+        names = sys.argv[3:] if len(sys.argv) > 3 else list(candidates)
+
+        print('{0:<16} {1:>9} '.format('candidate', 'speed-up') + ' '.join('{0:>20}'.format(name) for name in tolerances) + ' {0:>7}'.format('result'))
+        print('{0:<16} {1:>9} '.format('tolerance', '') + ' '.join('{0:>20}'.format(('>= ' if name == 'ks_pvalue' else '<= ')+'{0:.2g}'.format(tol)) for name, tol in tolerances.items()))
+        for name in names:
+            if name in candidates:
+                changes = candidates[name]
+            else:
+                with open(name) as f:
+                    changes = json.load(f)
+            galaxies, blends, data, _, t = render(cosmos_cat_dir, dict(meta['parameters'], **changes), meta['seeds'])
+            dev = deviations(golden, (galaxies, blends, data))
+            ok = all(passes(metric, value) for metric, value in dev.items())
+            cells = ['{0:>18.3g} {1}'.format(value, ' ' if passes(metric, value) else '!') for metric, value in dev.items()]
+            print('{0:<16} {1:>9.2f} '.format(os.path.basename(name), meta['time']/t) + ' '.join(cells) + ' {0:>7}'.format('PASS' if ok else 'FAIL'))
+    else:
+        raise NotImplementedError(mode)
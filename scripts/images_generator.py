@@ -7,13 +7,11 @@ import galsim
 
 from cosmos_params import *
 
-import photutils
-from photutils.centroids import centroid_com
-
 import utils
-from images_utils import get_fit_data, get_data, shift_gal, peak_detection, draw_images
+from images_utils import rng, get_fit_data, get_data, sample_shifts, peak_detection, draw_images, full_image, get_cosmos_catalog, get_real_galaxy, rescale_real_images
 
-rng = galsim.BaseDeviate(None)
+# Minimum distance (in arcsec) between the detected galaxy and its neighbours in the training and validation samples
+dist_cut = 0.65/2.
 
 ########## IMAGES NUMPY ARRAYS GENERATION
 # CASE OF PARAMETRIC IMAGES - SIMULATION
@@ -31,7 +29,15 @@ def image_generator_sim(cosmos_cat_dir,
                         do_peak_detection=True, 
                         center_brightest = True, 
                         max_stamp_size= 64,
-                        psf_lsst_fixed=True):
+                        psf_lsst_fixed=True,
+                        peak_detection_method='photutils',
+                        do_shape_measurement=True,
+                        accuracy='default',
+                        seed=None,
+                        draw_method='fft',
+                        native_stamps=False,
+                        separate_all_neighbours=False,
+                        max_sampling_try=100):
     """
     Return numpy arrays: noiseless and noisy image of single galaxy and of blended galaxies as well as the pandaframe including data about the image and the shifts in the test sample generation configuration
     
@@ -46,27 +52,47 @@ def image_generator_sim(cosmos_cat_dir,
     mag_cut: cut in magnitude to select function below this magnitude
     method_first_shift: chosen method for shifting the centered galaxy
     do_peak_detection: boolean to do the peak detection
+    peak_detection_method: peak finder used for the detection, 'photutils' or 'fast' (vectorized maximum filter)
+    do_shape_measurement: boolean to measure KSB shapes in r band during the generation (otherwise moment_sigma/e1_ksb/e2_ksb are left to NaN)
+    accuracy: GSParams profile used to render the galaxies and PSFs ('fast', 'default' or 'precise', see gsparams_profiles)
+    seed: seed of the random generation (drawn from the system if None)
+    draw_method: 'fft', 'phot' (photon shooting) or 'auto' (photon shooting for the faint galaxies, see draw_images). The saved noiseless
+        images are always drawn by FFT: photon shooting is only used for the galaxies which only contribute to the blend
+    native_stamps: draw each instrument on a stamp covering the footprint of the LSST stamps at its own pixel scale (see native_stamp_sizes).
+        The images are then returned as dictionaries {instrument: array [..., number of bands of the instrument, S, S]}
+    separate_all_neighbours: for training and validation with peak detection, place every galaxy further than dist_cut from all the others, drawn directly
+        from the allowed region (stricter than the cut of peak_detection, which only applies to the detected galaxy, see sample_shifts)
+    max_sampling_try: maximum number of draws of the positions of a blend before the image is tried again (see sample_shifts)
     """
+    np.random.seed(seed) # important for multiprocessing !
+    rng.seed(np.random.randint(1, 2**31-1) if seed is not None else 0)
     # Define PSF
-    PSF_lsst, fwhm_lsst = psf_lsst(psf_lsst_fixed=psf_lsst_fixed)
+    gsparams = gsparams_profiles[accuracy]
+    PSF_lsst, fwhm_lsst = psf_lsst(psf_lsst_fixed=psf_lsst_fixed, gsparams=gsparams)
+    PSF_euclid_nir, PSF_euclid_vis = psf_euclid(gsparams)
     PSF = [PSF_euclid_nir]*3 + [PSF_euclid_vis] + [PSF_lsst]*6
-    # Import the COSMOS catalog
-    cosmos_cat = galsim.COSMOSCatalog('real_galaxy_catalog_25.2.fits', dir=cosmos_cat_dir)
+    # Import the COSMOS catalog (once per process)
+    cosmos_cat = get_cosmos_catalog(cosmos_cat_dir)
     counter = 0
-    np.random.seed() # important for multiprocessing !
+    # Number of retries of the image: rejected by the peak detection (no peak or training cut) or for another error
+    # and number of blend positions drawn again by sample_shifts (no image rendered)
+    rejections = {'detection': 0, 'sampling': 0}
     
     assert training_or_test in ['training', 'validation', 'test']
     assert isolated_or_blended in ['blended', 'isolated']
+    nb_blended_range = nmax_blend
+    if np.shape(nmax_blend) != ():
+        nmax_blend = nmax_blend[1]
+    stamp_sizes = native_stamp_sizes(max_stamp_size) if native_stamps else [max_stamp_size]*len(filter_names_all)
     
     while counter < max_try:
         try:
-            ud = galsim.UniformDeviate()
+            ud = galsim.UniformDeviate(rng)
 
-            if np.shape(nmax_blend) == ():
-                nb_blended_gal = nmax_blend
+            if np.shape(nb_blended_range) == ():
+                nb_blended_gal = nb_blended_range
             else:    
-                nb_blended_gal = np.random.randint(nmax_blend[0], nmax_blend[1])
-                nmax_blend = nmax_blend[1]
+                nb_blended_gal = np.random.randint(nb_blended_range[0], nb_blended_range[1])
             data = {}
             galaxies = []
             mag=[]
@@ -79,7 +105,7 @@ def image_generator_sim(cosmos_cat_dir,
                 else:
                     idx = np.random.randint(cosmos_cat.nobject)
                 # Generate galaxy
-                gal = cosmos_cat.makeGalaxy(idx, gal_type='parametric', chromatic=True, noise_pad_size=0)
+                gal = cosmos_cat.makeGalaxy(idx, gal_type='parametric', chromatic=True, noise_pad_size=0, gsparams=gsparams)
                 # Get data from fit (parametric model)
                 data['e1_fit_'+str(j)], data['e2_fit_'+str(j)], data['weight_fit_'+str(j)] = get_fit_data(cosmos_cat_dir, idx)
                 # Compute the magnitude of the galaxy
@@ -96,92 +122,113 @@ def image_generator_sim(cosmos_cat_dir,
 
 
             # Compute ellipticities and magnitude for galaxies in r band before the shifting.
-            psf_image = PSF[6].drawImage(nx=max_stamp_size, ny=max_stamp_size, scale=pixel_scale[6])
-            images = []
-            galaxies_psf = [galsim.Convolve([gal*coeff_exp[6], PSF[6]]) for gal in galaxies]
-            for j, gal in enumerate(galaxies_psf):
-                temp_img = galsim.ImageF(max_stamp_size, max_stamp_size, scale=pixel_scale[6])
-
-                gal.drawImage(filters['r'], image=temp_img)
-                images.append(temp_img)
-
-            for z in range (nb_blended_gal):
-                data['redshift_'+str(z)], data['moment_sigma_'+str(z)], data['e1_ksb_'+str(z)], data['e2_ksb_'+str(z)], data['mag_'+str(z)] = get_data(galaxies[z], images[z], psf_image)
+            if do_shape_measurement:
+                psf_image = PSF[6].drawImage(nx=max_stamp_size, ny=max_stamp_size, scale=pixel_scale[6])
+                images = []
+                galaxies_psf = [galsim.Convolve([gal*coeff_exp[6], PSF[6]], gsparams=gsparams) for gal in galaxies]
+                for j, gal in enumerate(galaxies_psf):
+                    temp_img = galsim.ImageF(max_stamp_size, max_stamp_size, scale=pixel_scale[6])
+
+                    gal.drawImage(filters['r'], image=temp_img)
+                    images.append(temp_img)
+
+                for z in range (nb_blended_gal):
+                    data['redshift_'+str(z)], data['moment_sigma_'+str(z)], data['e1_ksb_'+str(z)], data['e2_ksb_'+str(z)], data['mag_'+str(z)] = get_data(galaxies[z], images[z], psf_image)
+            else:
+                # Shapes can be measured afterwards on the saved stamps (see measure_shapes.py)
+                for z in range (nb_blended_gal):
+                    data['redshift_'+str(z)], data['moment_sigma_'+str(z)], data['e1_ksb_'+str(z)], data['e2_ksb_'+str(z)], data['mag_'+str(z)] = galaxies[z].SED.redshift, np.nan, np.nan, np.nan, mag[z]
             if nb_blended_gal < nmax_blend:
                 for z in range (nb_blended_gal,nmax_blend):
                     data['redshift_'+str(z)], data['moment_sigma_'+str(z)], data['e1_ksb_'+str(z)], data['e2_ksb_'+str(z)], data['mag_'+str(z)] = 10., 10., 10., 10., 10.
 
 
             # Optionally, find the brightest and put it first in the list
+            # draw_order: index in the order of drawing (columns *_z of data) of each galaxy of the list
+            draw_order = list(range(nb_blended_gal))
             if center_brightest:
                 _idx = np.argmin(mag)
                 galaxies.insert(0, galaxies.pop(_idx))
                 mag.insert(0,mag.pop(_idx))
                 mag_ir.insert(0,mag_ir.pop(_idx))
+                draw_order.insert(0, draw_order.pop(_idx))
 
-            # Shifts galaxies
-            shift = np.zeros((nmax_blend,2))
-            if center_brightest == False:
-                # Shift the lowest magnitude galaxy
-                galaxies[0], shift[0] = shift_gal(galaxies[0], method=method_first_shift, max_dx=max_dx, max_r = max_r)
-            # Shift all the other galaxies
-            for j,gal in enumerate(galaxies[1:]): 
-                galaxies[j+1], shift[j+1] = shift_gal(gal, method=method_others_shift, max_dx=max_dx, max_r = max_r)
+            # Shifts galaxies. For training and validation, blends which cannot pass the separation cut are drawn again before rendering
+            shift, n_rejected = sample_shifts(nb_blended_gal, nmax_blend, method_first_shift, method_others_shift, center_first=center_brightest, max_dx=max_dx, max_r=max_r,
+                                              min_dist=dist_cut if (do_peak_detection and training_or_test != 'test') else 0., separate_all=separate_all_neighbours, max_try=max_sampling_try)
+            rejections['sampling'] += n_rejected
+            # Galaxies are kept centered on (0,0): draw_images places them at their shift in a stamp limited to their extent
             
             # Compute distances of the neighbour galaxies to the lowest magnitude galaxy
             if nb_blended_gal>1:
-                distances = [shift[j][0]**2+shift[j][1]**2 for j in range(1,nb_blended_gal)]
+                distances = np.sum(shift[1:nb_blended_gal]**2, axis=1)
                 idx_closest_to_peak_galaxy = np.argmin(distances)+1
             else:
                 idx_closest_to_peak_galaxy = 0
             
-            if training_or_test=='test':
-                galaxy_noiseless = np.zeros((nmax_blend, 10, max_stamp_size,max_stamp_size))
-            else:
-                galaxy_noiseless = np.zeros((10, max_stamp_size,max_stamp_size))
-            blend_noisy = np.zeros((10,max_stamp_size,max_stamp_size))
+            # Images of each band, stacked at the end
+            galaxy_noiseless_bands = []
+            blend_noisy_bands = []
 
             # Realize peak detection in r-band filter if asked
             if do_peak_detection:
                 band = 6
-                galaxies_psf = [galsim.Convolve([gal*coeff_exp[band], PSF[band]]) for gal in galaxies]
+                galaxies_psf = [galsim.Convolve([gal*coeff_exp[band], PSF[band]], gsparams=gsparams) for gal in galaxies]
 
-                images, blend_img = draw_images(galaxies_psf, band, max_stamp_size*2, 'r', sky_level_pixel[band])
+                # Only the blend is used by the detection
+                images, blend_img = draw_images(galaxies_psf, band, max_stamp_size*2, 'r', sky_level_pixel[band], shifts=shift, draw_method=draw_method, noiseless_idx=[])
                 blend_noisy_temp = blend_img.array.data
-                peak_detection_output = peak_detection(blend_noisy_temp, band, shift, max_stamp_size*2, 4,nb_blended_gal, training_or_test, dist_cut=0.65/2.)
+                peak_detection_output = peak_detection(blend_noisy_temp, band, shift, max_stamp_size*2, 4,nb_blended_gal, training_or_test, dist_cut=dist_cut, method=peak_detection_method)
                 if not peak_detection_output:
-                    print('No peak detected')
-                    raise RuntimeError
+                    rejections['detection'] += 1
+                    raise RuntimeError('No peak detected')
                 else:
                     idx_closest_to_peak, idx_closest_to_peak_galaxy, center_pix_x, center_pix_y, center_arc_x, center_arc_y, n_peak = peak_detection_output
 
-                # Modify galaxies and shift accordingly
-                galaxies = [gal.shift(-center_arc_x, -center_arc_y) for gal in galaxies]
+                # Center the image on the detected peak
                 shift[:nb_blended_gal] -= np.array([center_arc_x, center_arc_y])
             
+            if isolated_or_blended == 'isolated' or not do_peak_detection:
+                idx_closest_to_peak = 0
+                n_peak = 1
+            # The noiseless images of all the galaxies are saved in the test sample, only the one of the detected galaxy otherwise:
+            # the other galaxies can be drawn by photon shooting
+            noiseless_idx = None if training_or_test=='test' else [idx_closest_to_peak]
+
             # Now draw image in all filters
             for i, filter_name in enumerate(filter_names_all):
-                galaxies_psf = [galsim.Convolve([gal*coeff_exp[i], PSF[i]]) for gal in galaxies]
-                images, blend_img = draw_images(galaxies_psf, i, max_stamp_size, filter_name, sky_level_pixel[i])
-                if isolated_or_blended == 'isolated' or not do_peak_detection:
-                    idx_closest_to_peak = 0
-                    n_peak = 1
+                stamp_size = stamp_sizes[i]
+                galaxies_psf = [galsim.Convolve([gal*coeff_exp[i], PSF[i]], gsparams=gsparams) for gal in galaxies]
+                images, blend_img = draw_images(galaxies_psf, i, stamp_size, filter_name, sky_level_pixel[i], shifts=shift, draw_method=draw_method, noiseless_idx=noiseless_idx)
 
                 if training_or_test=='test':
-                    galaxy_noiseless[0][i] = images[idx_closest_to_peak].array.data
+                    galaxy_noiseless_band = np.zeros((nmax_blend, stamp_size, stamp_size))
+                    galaxy_noiseless_band[0] = full_image(images[idx_closest_to_peak], stamp_size)
                     if isolated_or_blended == 'blended':
                         for m in range (1,nb_blended_gal):
                             if m<=idx_closest_to_peak:
-                                galaxy_noiseless[m][i] = images[m-1].array.data
+                                galaxy_noiseless_band[m] = full_image(images[m-1], stamp_size)
                             elif m > idx_closest_to_peak:
-                                galaxy_noiseless[m][i] = images[m].array.data
+                                galaxy_noiseless_band[m] = full_image(images[m], stamp_size)
                 else:
-                    galaxy_noiseless[i] = images[idx_closest_to_peak].array.data
-                blend_noisy[i] = blend_img.array.data
+                    galaxy_noiseless_band = np.array(full_image(images[idx_closest_to_peak], stamp_size), dtype=np.float64)
+                galaxy_noiseless_bands.append(galaxy_noiseless_band)
+                blend_noisy_bands.append(np.array(blend_img.array.data, dtype=np.float64))
+
+            # Stack the bands: [nmax_blend, band, S, S] (test) or [band, S, S], for all the bands or for each instrument
+            if native_stamps:
+                galaxy_noiseless = {instrument: np.stack([galaxy_noiseless_bands[i] for i in bands], axis=-3) for instrument, bands in instrument_bands.items()}
+                blend_noisy = {instrument: np.stack([blend_noisy_bands[i] for i in bands]) for instrument, bands in instrument_bands.items()}
+            else:
+                galaxy_noiseless = np.stack(galaxy_noiseless_bands, axis=-3)
+                blend_noisy = np.stack(blend_noisy_bands)
             break
 
         except RuntimeError as e:
             print(e)
+            counter += 1
+    if counter == max_try:
+        raise RuntimeError('No image generated after {0} tries'.format(max_try))
 
 
     # For testing, return unormalized images and data
@@ -200,9 +247,22 @@ def image_generator_sim(cosmos_cat_dir,
         data['closest_x'] = np.nan
         data['closest_y'] = np.nan
     data['idx_closest_to_peak'] = idx_closest_to_peak
+    # Draw index of the galaxy saved in each slot of the stack [detected galaxy, others...] (-1 for the empty slots)
+    slot_order = [idx_closest_to_peak] + [m-1 if m<=idx_closest_to_peak else m for m in range(1,nb_blended_gal)]
+    for z in range(nmax_blend):
+        data['draw_idx_slot_'+str(z)] = draw_order[slot_order[z]] if z < nb_blended_gal else -1
     data['n_peak_detected'] = n_peak
-    data['SNR'] = utils.SNR(galaxy_noiseless, sky_level_pixel, band=6)[1]
-    data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless, sky_level_pixel, band=6)[1]
+    data['n_retries'] = counter
+    data['n_rejected_detection'] = rejections['detection']
+    data['n_rejected_sampling'] = rejections['sampling']
+    if native_stamps:
+        # r band in the LSST bands
+        lsst_bands = instrument_bands['lsst']
+        data['SNR'] = utils.SNR(galaxy_noiseless['lsst'], sky_level_pixel[lsst_bands[0]:lsst_bands[-1]+1], band=6-lsst_bands[0])[1]
+        data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless['lsst'], sky_level_pixel[lsst_bands[0]:lsst_bands[-1]+1], band=6-lsst_bands[0])[1]
+    else:
+        data['SNR'] = utils.SNR(galaxy_noiseless, sky_level_pixel, band=6)[1]
+        data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless, sky_level_pixel, band=6)[1]
     return galaxy_noiseless, blend_noisy, data, shift
 
 
@@ -224,7 +284,16 @@ def image_generator_real(cosmos_cat_dir,
                         do_peak_detection=True, 
                         center_brightest = True, 
                         max_stamp_size= 64,
-                        psf_lsst_fixed=True):
+                        psf_lsst_fixed=True,
+                        peak_detection_method='photutils',
+                        do_shape_measurement=True,
+                        real_cache_size=1024,
+                        real_native_bands=False,
+                        accuracy='default',
+                        seed=None,
+                        separate_all_neighbours=False,
+                        max_sampling_try=100,
+                        native_stamps=False):
     """
     Return numpy arrays: noiseless and noisy image of single galaxy and of blended galaxies as well as the pandaframe including data about the image and the shifts in the test sample generation configuration
     
@@ -239,28 +308,50 @@ def image_generator_real(cosmos_cat_dir,
     mag_cut: cut in magnitude to select function below this magnitude
     method_first_shift: chosen method for shifting the centered galaxy
     do_peak_detection: boolean to do the peak detection
+    peak_detection_method: peak finder used for the detection, 'photutils' or 'fast' (vectorized maximum filter)
+    do_shape_measurement: boolean to measure KSB shapes in r band during the generation (otherwise moment_sigma/e1_ksb/e2_ksb are left to NaN)
+    real_cache_size: memory budget (in MB) of the per-process cache of the HST images of the real galaxies (0 to disable it)
+    real_native_bands: boolean to draw the real galaxies with the PSF and pixel scale of each band instead of rescaling the r-band image
+    accuracy: GSParams profile used to render the galaxies and PSFs ('fast', 'default' or 'precise', see gsparams_profiles)
+    seed: seed of the random generation (drawn from the system if None)
+    separate_all_neighbours: for training and validation with peak detection, place every galaxy further than dist_cut from all the others, drawn directly
+        from the allowed region (stricter than the cut of peak_detection, which only applies to the detected galaxy, see sample_shifts)
+    max_sampling_try: maximum number of draws of the positions of a blend before the image is tried again (see sample_shifts)
+    native_stamps: draw each instrument on a stamp covering the footprint of the LSST stamps at its own pixel scale (see native_stamp_sizes).
+        The images are then returned as dictionaries {instrument: array [..., number of bands of the instrument, S, S]}. Needs real_native_bands
     """
+    np.random.seed(seed) # important for multiprocessing !
+    rng.seed(np.random.randint(1, 2**31-1) if seed is not None else 0)
     # Define PSF
-    PSF_lsst, fwhm_lsst = psf_lsst(psf_lsst_fixed=False)
+    gsparams = gsparams_profiles[accuracy]
+    PSF_lsst, fwhm_lsst = psf_lsst(psf_lsst_fixed=False, gsparams=gsparams)
+    PSF_euclid_nir, PSF_euclid_vis = psf_euclid(gsparams)
     PSF = [PSF_euclid_nir]*3 + [PSF_euclid_vis] + [PSF_lsst]*6
-    # Import the COSMOS catalog
-    cosmos_cat = galsim.COSMOSCatalog('real_galaxy_catalog_25.2.fits', dir=cosmos_cat_dir)
+    # Import the COSMOS catalog (once per process)
+    cosmos_cat = get_cosmos_catalog(cosmos_cat_dir)
     counter = 0
-    np.random.seed() # important for multiprocessing !
+    # Number of retries of the image: rejected by the peak detection (no peak or training cut) or for another error
+    # and number of blend positions drawn again by sample_shifts (no image rendered)
+    rejections = {'detection': 0, 'sampling': 0}
     
     assert training_or_test in ['training', 'validation', 'test']
     assert isolated_or_blended in ['blended', 'isolated']
+    nb_blended_range = nmax_blend
+    if np.shape(nmax_blend) != ():
+        nmax_blend = nmax_blend[1]
+    if native_stamps and not real_native_bands:
+        raise ValueError('native_stamps needs real_native_bands: the r-band image rescaled in all bands is on the LSST pixel grid')
+    stamp_sizes = native_stamp_sizes(max_stamp_size) if native_stamps else [max_stamp_size]*len(filter_names_all)
     
     while counter < max_try:
         try:
-            ud = galsim.UniformDeviate()
+            ud = galsim.UniformDeviate(rng)
             real_gal_list = []
 
-            if np.shape(nmax_blend) == ():
-                nb_blended_gal = nmax_blend
+            if np.shape(nb_blended_range) == ():
+                nb_blended_gal = nb_blended_range
             else:    
-                nb_blended_gal = np.random.randint(nmax_blend[0], nmax_blend[1])
-                nmax_blend = nmax_blend[1]
+                nb_blended_gal = np.random.randint(nb_blended_range[0], nb_blended_range[1])
             data = {}
             galaxies = []
             mag=[]
@@ -273,7 +364,7 @@ def image_generator_real(cosmos_cat_dir,
                 else:
                     idx = np.random.randint(cosmos_cat.nobject)
                 # Generate galaxy
-                gal = cosmos_cat.makeGalaxy(idx, gal_type='parametric', chromatic=True, noise_pad_size=0)
+                gal = cosmos_cat.makeGalaxy(idx, gal_type='parametric', chromatic=True, noise_pad_size=0, gsparams=gsparams)
                 # Compute the magnitude of the galaxy
                 _mag_temp = gal.calculateMagnitude(filters['r'].withZeropoint(28.13))
                 # Magnitude cut
@@ -286,138 +377,149 @@ def image_generator_real(cosmos_cat_dir,
                     
                 # Take the real galaxy image only if parametric galaxy is actually created
                 if  len(galaxies) == (len(real_gal_list)+1):
-                    bp_file = os.path.join(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/share_galsim/'), 'wfc_F814W.dat.gz')
-                    bandpass = galsim.Bandpass(bp_file, wave_type='ang').thin().withZeropoint(25.94)
-                    real_gal = cosmos_cat.makeGalaxy(idx, gal_type='real',
-                                                    noise_pad_size=max_stamp_size*pixel_scale_lsst)
+                    real_gal = get_real_galaxy(cosmos_cat_dir, idx, noise_pad_size=max_stamp_size*pixel_scale_lsst, max_memory=real_cache_size, gsparams=gsparams, rng=rng)
                     real_gal_list.append(real_gal)
 
             # Compute ellipticities and magnitude for galaxies in r band before the shifting.
-            psf_image = PSF[6].drawImage(nx=max_stamp_size, ny=max_stamp_size, scale=pixel_scale[6])
-            images = []
-            galaxies_psf = [galsim.Convolve([real_gal*coeff_exp[6], PSF[6]]) for real_gal in real_gal_list]
-            for j, gal in enumerate(galaxies_psf):
-                temp_img = galsim.ImageF(max_stamp_size, max_stamp_size, scale=pixel_scale[6])
+            if do_shape_measurement:
+                psf_image = PSF[6].drawImage(nx=max_stamp_size, ny=max_stamp_size, scale=pixel_scale[6])
+                images = []
+                galaxies_psf = [galsim.Convolve([real_gal*coeff_exp[6], PSF[6]], gsparams=gsparams) for real_gal in real_gal_list]
+                for j, gal in enumerate(galaxies_psf):
+                    temp_img = galsim.ImageF(max_stamp_size, max_stamp_size, scale=pixel_scale[6])
 
-                gal.drawImage(image=temp_img)#filters['r'], 
-                images.append(temp_img)
+                    gal.drawImage(image=temp_img)#filters['r'], 
+                    images.append(temp_img)
 
             for z in range (nb_blended_gal):
-                res, data['mag_'+str(z)] = get_data(real_gal_list[z], images[z], psf_image, param_or_real='real'), mag[z]
-                data['redshift_'+str(z)] = res[0]
+                if do_shape_measurement:
+                    res = get_data(real_gal_list[z], images[z], psf_image, param_or_real='real')
+                else:
+                    res = [np.nan, np.nan, np.nan, np.nan, np.nan]
+                data['redshift_'+str(z)] = galaxies[z].SED.redshift
                 data['moment_sigma_'+str(z)] = res[1]
-                data['e1_'+str(z)] = res[2]
-                data['e2_'+str(z)] = res[3]
+                data['e1_ksb_'+str(z)] = res[2]
+                data['e2_ksb_'+str(z)] = res[3]
+                data['mag_'+str(z)] = mag[z]
+            for z in range (nmax_blend):
+                data['e1_fit_'+str(z)], data['e2_fit_'+str(z)], data['weight_fit_'+str(z)] = get_fit_data(cosmos_cat_dir, None, param_or_real='real')
             if nb_blended_gal < nmax_blend:
                 for z in range (nb_blended_gal,nmax_blend):
                     data['redshift_'+str(z)], data['moment_sigma_'+str(z)], data['e1_ksb_'+str(z)], data['e2_ksb_'+str(z)], data['mag_'+str(z)] = 10., 10., 10., 10., 10.
 
             # Optionally, find the brightest and put it first in the list
+            # draw_order: index in the order of drawing (columns *_z of data) of each galaxy of the list
+            draw_order = list(range(nb_blended_gal))
             if center_brightest:
                 _idx = np.argmin(mag)
                 galaxies.insert(0, galaxies.pop(_idx))
                 real_gal_list.insert(0, real_gal_list.pop(_idx))
                 mag.insert(0,mag.pop(_idx))
                 mag_ir.insert(0,mag_ir.pop(_idx))
+                draw_order.insert(0, draw_order.pop(_idx))
 
-            # Shifts galaxies
-            shift = np.zeros((nmax_blend,2))
-            if center_brightest == False:
-                # Shift the lowest magnitude galaxy
-                real_gal_list[0], shift[0] = shift_gal(real_gal_list[0], method=method_first_shift, max_dx=max_dx, max_r = max_r)
-            # Shift all the other galaxies
-            for j,gal in enumerate(real_gal_list[1:]):
-                real_gal_list[j+1], shift[j+1] = shift_gal(gal, method=method_others_shift, max_dx=max_dx, max_r = max_r)
+            # Shifts galaxies. For training and validation, blends which cannot pass the separation cut are drawn again before rendering
+            shift, n_rejected = sample_shifts(nb_blended_gal, nmax_blend, method_first_shift, method_others_shift, center_first=center_brightest, max_dx=max_dx, max_r=max_r,
+                                              min_dist=dist_cut if (do_peak_detection and training_or_test != 'test') else 0., separate_all=separate_all_neighbours, max_try=max_sampling_try)
+            rejections['sampling'] += n_rejected
+            # Galaxies are kept centered on (0,0): draw_images places them at their shift in a stamp limited to their extent
             
 
             # Compute distances of the neighbour galaxies to the lowest magnitude galaxy
             if nb_blended_gal>1:
-                distances = [shift[j][0]**2+shift[j][1]**2 for j in range(1,nb_blended_gal)]
+                distances = np.sum(shift[1:nb_blended_gal]**2, axis=1)
                 idx_closest_to_peak_galaxy = np.argmin(distances)+1
             else:
                 idx_closest_to_peak_galaxy = 0
             
-            if training_or_test=='test':
-                galaxy_noiseless = np.zeros((nmax_blend, 10, max_stamp_size,max_stamp_size))
-                galaxy_noiseless_real = np.zeros((nmax_blend, 10,max_stamp_size,max_stamp_size))
-            else:
-                galaxy_noiseless = np.zeros((10, max_stamp_size,max_stamp_size))
-                galaxy_noiseless_real = np.zeros((10, max_stamp_size,max_stamp_size))
-            blend_noisy = np.zeros((10,max_stamp_size,max_stamp_size))
-            blend_noisy_real = np.zeros((10,max_stamp_size,max_stamp_size))
-
             # Realize peak detection in r-band filter if asked
             if do_peak_detection:
                 band = 6
-                galaxies_psf = [galsim.Convolve([real_gal*coeff_exp[band], PSF[band]]) for real_gal in real_gal_list]
+                galaxies_psf = [galsim.Convolve([real_gal*coeff_exp[band], PSF[band]], gsparams=gsparams) for real_gal in real_gal_list]
 
-                images, blend_img = draw_images(galaxies_psf, band, max_stamp_size*2, 'r', sky_level_pixel[band])
+                images, blend_img = draw_images(galaxies_psf, band, max_stamp_size*2, 'r', sky_level_pixel[band], real_or_param = 'real', shifts=shift)
                 blend_noisy_temp = blend_img.array.data
-                peak_detection_output = peak_detection(blend_noisy_temp, band, shift, max_stamp_size*2, 4,nb_blended_gal, training_or_test, dist_cut=0.65/2.)
+                peak_detection_output = peak_detection(blend_noisy_temp, band, shift, max_stamp_size*2, 4,nb_blended_gal, training_or_test, dist_cut=dist_cut, method=peak_detection_method)
                 if not peak_detection_output:
-                    print('No peak detected')
-                    raise RuntimeError
+                    rejections['detection'] += 1
+                    raise RuntimeError('No peak detected')
                 else:
                     idx_closest_to_peak, idx_closest_to_peak_galaxy, center_pix_x, center_pix_y, center_arc_x, center_arc_y, n_peak = peak_detection_output
 
-                # Modify galaxies and shift accordingly
-                galaxies = [gal.shift(-center_arc_x, -center_arc_y) for gal in galaxies]
+                # Center the image on the detected peak
                 shift[:nb_blended_gal] -= np.array([center_arc_x, center_arc_y])
 
+            if isolated_or_blended == 'isolated' or not do_peak_detection:
+                idx_closest_to_peak = 0
+                n_peak = 1
+            # Order of the galaxies in the saved stack: detected galaxy first
+            order = [idx_closest_to_peak] + [m-1 if m<=idx_closest_to_peak else m for m in range(1,nb_blended_gal)]
+
             # Draw real images
-            galaxies_real_psf = [galsim.Convolve([real_gal*coeff_exp[6], PSF_lsst]) for real_gal in real_gal_list]
-            images_real, _ = draw_images(galaxies_real_psf, 6, max_stamp_size, 'r', sky_level_pixel[6], real_or_param = 'real')
+            if not real_native_bands:
+                galaxies_real_psf = [galsim.Convolve([real_gal*coeff_exp[6], PSF_lsst], gsparams=gsparams) for real_gal in real_gal_list]
+                images_real, _ = draw_images(galaxies_real_psf, 6, max_stamp_size, 'r', sky_level_pixel[6], real_or_param = 'real', shifts=shift)
+                images_real_array = np.array([full_image(image_real, max_stamp_size) for image_real in images_real], dtype=np.float64)
+            param_fluxes = np.zeros((len(filter_names_all), nb_blended_gal))
+            # Images of each band [galaxy, S, S], stacked at the end
+            galaxy_noiseless_bands = []
+            images_real_bands = []
             
             # Now draw image in all bands
             for i, filter_name in enumerate(filter_names_all):
-                galaxies_psf = [galsim.Convolve([gal*coeff_exp[i], PSF[i]]) for gal in galaxies]
-                images, blend_img = draw_images(galaxies_psf, i, max_stamp_size, filter_name, sky_level_pixel[i])
-                if isolated_or_blended == 'isolated' or not do_peak_detection:
-                    idx_closest_to_peak = 0
-                    n_peak = 1
-                
-                if training_or_test=='test':
-                    if isolated_or_blended == 'blended':
-                        for m in range (1,nb_blended_gal):
-                            if m<=idx_closest_to_peak:
-                                galaxy_noiseless[m][i] = images[m-1].array.data
-                            elif m > idx_closest_to_peak:
-                                galaxy_noiseless[m][i] = images[m].array.data
-                else:
-                    galaxy_noiseless[i] = images[idx_closest_to_peak].array.data
-                blend_noisy[i] = blend_img.array.data
-
-                # Rescale real images by flux
-                images_real_array = np.zeros((len(images_real), max_stamp_size, max_stamp_size))
-                for jj, image_real in enumerate(images_real):
-                    img_temp = images[jj]
-                    image_real -= np.min(image_real.array)
-                    images_real_array[jj] = image_real.array  * np.sum(img_temp.array)/np.sum(image_real.array)
+                stamp_size = stamp_sizes[i]
+                galaxies_psf = [galsim.Convolve([gal*coeff_exp[i], PSF[i]], gsparams=gsparams) for gal in galaxies]
+                images, _ = draw_images(galaxies_psf, i, stamp_size, filter_name, sky_level_pixel[i], shifts=shift)
+                galaxy_noiseless_bands.append(np.array([full_image(images[m], stamp_size) for m in order], dtype=np.float64))
+                param_fluxes[i] = [np.sum(image.array) for image in images]
+
+                if real_native_bands:
+                    # Draw real galaxies with the PSF and pixel scale of the band, at the flux of their parametric model.
+                    # The objects of real_gal_list are the same in all bands so the deconvolution of the HST image
+                    # (Fourier transform of the HST image and inverse of the HST PSF) is computed only once per galaxy.
+                    galaxies_real_psf = [galsim.Convolve([real_gal.withFlux(flux), PSF[i]], gsparams=gsparams) for real_gal, flux in zip(real_gal_list, param_fluxes[i])]
+                    images_real, _ = draw_images(galaxies_real_psf, i, stamp_size, filter_name, sky_level_pixel[i], real_or_param = 'real', shifts=shift)
+                    images_real_bands.append(np.array([full_image(image_real, stamp_size) for image_real in images_real], dtype=np.float64))
+
+            if not real_native_bands:
+                # Rescale real images by flux in all bands at once: [band, galaxy, nx, ny]
+                images_real_bands = list(rescale_real_images(images_real_array, param_fluxes))
+
+            # Blends of the real galaxies with noise
+            blend_noisy_real_bands = []
+            for i in range (len(filter_names_all)):
+                blend_noisy_real_temp = galsim.Image(np.sum(images_real_bands[i], axis=0), dtype=np.float64)
+                poissonian_noise = galsim.PoissonNoise(rng, sky_level=sky_level_pixel[i])
+                blend_noisy_real_temp.addNoise(poissonian_noise)
+                blend_noisy_real_bands.append(blend_noisy_real_temp.array.data)
 
-                # real galaxies
+            # Noiseless galaxies of each band in the order of the stack: [nmax_blend, S, S] (test) or [S, S] (detected galaxy)
+            for i in range (len(filter_names_all)):
+                real_ordered = images_real_bands[i][order]
                 if training_or_test=='test':
-                    galaxy_noiseless_real[0][i] = images_real_array[idx_closest_to_peak].data
-                    if isolated_or_blended == 'blended':
-                        for m in range (1,nb_blended_gal):
-                            if m<=idx_closest_to_peak:
-                                galaxy_noiseless_real[m][i] = images_real_array[m-1].data
-                            elif m > idx_closest_to_peak:
-                                galaxy_noiseless_real[m][i] = images_real_array[m].data
+                    galaxy_noiseless_bands[i] = np.concatenate([galaxy_noiseless_bands[i], np.zeros((nmax_blend-nb_blended_gal,)+galaxy_noiseless_bands[i].shape[1:])])
+                    images_real_bands[i] = np.concatenate([real_ordered, np.zeros((nmax_blend-nb_blended_gal,)+real_ordered.shape[1:])])
                 else:
-                    galaxy_noiseless_real[i] = images_real_array[idx_closest_to_peak].data
-                for image_real_array in images_real_array:
-                    blend_noisy_real[i] += image_real_array
-
-                # Add noise
-                blend_noisy_real_temp = galsim.Image(blend_noisy_real[i], dtype=np.float64)
-                poissonian_noise = galsim.PoissonNoise(rng, sky_level=sky_level_pixel[i])
-                blend_noisy_real_temp.addNoise(poissonian_noise)
-                blend_noisy_real[i] = blend_noisy_real_temp.array.data
+                    galaxy_noiseless_bands[i] = galaxy_noiseless_bands[i][0]
+                    images_real_bands[i] = real_ordered[0]
+
+            # Stack the bands: [nmax_blend, band, S, S] (test) or [band, S, S], for all the bands or for each instrument
+            if native_stamps:
+                galaxy_noiseless = {instrument: np.stack([galaxy_noiseless_bands[i] for i in bands], axis=-3) for instrument, bands in instrument_bands.items()}
+                galaxy_noiseless_real = {instrument: np.stack([images_real_bands[i] for i in bands], axis=-3) for instrument, bands in instrument_bands.items()}
+                blend_noisy_real = {instrument: np.stack([blend_noisy_real_bands[i] for i in bands]) for instrument, bands in instrument_bands.items()}
+            else:
+                galaxy_noiseless = np.stack(galaxy_noiseless_bands, axis=-3)
+                galaxy_noiseless_real = np.stack(images_real_bands, axis=-3)
+                blend_noisy_real = np.stack(blend_noisy_real_bands)
 
             break
 
         except RuntimeError as e:
             print(e)
+            counter += 1
+    if counter == max_try:
+        raise RuntimeError('No image generated after {0} tries'.format(max_try))
 
     data['fwhm_lsst'] = fwhm_lsst
     data['nb_blended_gal'] = nb_blended_gal
@@ -434,7 +536,20 @@ def image_generator_real(cosmos_cat_dir,
         data['closest_x'] = np.nan
         data['closest_y'] = np.nan
     data['idx_closest_to_peak'] = idx_closest_to_peak
+    # Draw index of the galaxy saved in each slot of the stack [detected galaxy, others...] (-1 for the empty slots)
+    slot_order = [idx_closest_to_peak] + [m-1 if m<=idx_closest_to_peak else m for m in range(1,nb_blended_gal)]
+    for z in range(nmax_blend):
+        data['draw_idx_slot_'+str(z)] = draw_order[slot_order[z]] if z < nb_blended_gal else -1
     data['n_peak_detected'] = n_peak
-    data['SNR'] = utils.SNR(galaxy_noiseless, sky_level_pixel, band=6)[1]
-    data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless, sky_level_pixel, band=6)[1]
+    data['n_retries'] = counter
+    data['n_rejected_detection'] = rejections['detection']
+    data['n_rejected_sampling'] = rejections['sampling']
+    if native_stamps:
+        # r band in the LSST bands
+        lsst_bands = instrument_bands['lsst']
+        data['SNR'] = utils.SNR(galaxy_noiseless['lsst'], sky_level_pixel[lsst_bands[0]:lsst_bands[-1]+1], band=6-lsst_bands[0])[1]
+        data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless['lsst'], sky_level_pixel[lsst_bands[0]:lsst_bands[-1]+1], band=6-lsst_bands[0])[1]
+    else:
+        data['SNR'] = utils.SNR(galaxy_noiseless, sky_level_pixel, band=6)[1]
+        data['SNR_peak'] = utils.SNR_peak(galaxy_noiseless, sky_level_pixel, band=6)[1]
     return galaxy_noiseless_real, blend_noisy_real, data, shift
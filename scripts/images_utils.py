@@ -1,21 +1,212 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 import os
+import hashlib
 import galsim
-import scipy
+from collections import OrderedDict
 
 from cosmos_params import *
-from astropy.io import fits
-
-import photutils
-from photutils.centroids import centroid_com
 
 import utils 
 
 rng = galsim.BaseDeviate(None)
 
 
+############ CATALOG AND REAL GALAXIES CACHES
+# These caches live in each worker process: the catalog files are opened once per worker and the HST postage stamps
+# of the real galaxies (galaxy, PSF and noise images) are kept for later images. The noise padding of a real galaxy is
+# random, so the padded galaxy is built for each image with the seeded random generator of the image.
+# The large read-only tables (parameters of the catalog, fitted ellipticities) are saved once in .npy files of the
+# cache directory (cache_dir of cosmos_params) and memory-mapped: all the workers share the same pages of the page
+# cache instead of holding their own copy. Catalogs loaded in the main process before the pool is created (fork) are
+# inherited by the workers.
+_cosmos_catalogs = {}
+_fit_tables = {}
+_magnitude_tables = {}
+_eligible_idx = {}
+_real_galaxies = OrderedDict()
+_real_galaxies_nbytes = 0
+
+def shared_table(name, source_file, compute, depends_on=None):
+    '''
+    Return the read-only table computed from source_file, memory-mapped from the cache directory (computed and saved at
+    the first call). The table is recomputed if source_file, the GalSim version or the parameters it depends on change
+
+    Parameters:
+    ----------
+    name: name of the table
+    source_file: file from which the table is computed
+    compute: function without argument returning the table (numpy array without python objects)
+    depends_on: dictionary of the parameters used to compute the table (e.g. the magnitude cut), None if there are none
+    '''
+    stat = os.stat(source_file)
+    key = '{0} {1} {2} {3}'.format(os.path.realpath(source_file), stat.st_size, stat.st_mtime, galsim.__version__)
+    if depends_on is not None:
+        key += ' ' + repr(sorted(depends_on.items()))
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    table_file = os.path.join(cache_dir, '{0}_{1}.npy'.format(name, key))
+    if not os.path.exists(table_file):
+        table = compute()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename so that concurrent processes never read a partial file
+            tmp_file = table_file+'.{0}.tmp'.format(os.getpid())
+            with open(tmp_file, 'wb') as f:
+                np.save(f, table)
+            os.replace(tmp_file, table_file)
+        except OSError:
+            return table
+    return np.load(table_file, mmap_mode='r')
+
+
+def get_cosmos_catalog(cosmos_cat_dir):
+    '''
+    Return the COSMOS catalog of the directory, loaded only once per process, with its parameter table memory-mapped
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: directory of catalog
+    '''
+    if cosmos_cat_dir not in _cosmos_catalogs:
+        cosmos_cat = galsim.COSMOSCatalog('real_galaxy_catalog_25.2.fits', dir=cosmos_cat_dir)
+        param_cat = cosmos_cat.param_cat
+        cosmos_cat.param_cat = shared_table('param_cat', os.path.join(cosmos_cat_dir, 'real_galaxy_catalog_25.2_fits.fits'), lambda: param_cat)
+        del param_cat
+        _cosmos_catalogs[cosmos_cat_dir] = cosmos_cat
+    return _cosmos_catalogs[cosmos_cat_dir]
+
+
+def _compute_fit_table(param_cat):
+    '''
+    Return the table [n_galaxies, 3] of the ellipticities (e1_fit, e2_fit) and weight of the fit (SERSIC or BULGE+DISK) preferred for each galaxy
+    '''
+    columns = {name.lower(): name for name in param_cat.dtype.names}
+    sersicfit = np.asarray(param_cat[columns['sersicfit']], dtype=np.float64)
+    bulgefit = np.asarray(param_cat[columns['bulgefit']], dtype=np.float64)
+    meandev_sersicfit = np.asarray(param_cat[columns['fit_mad_s']], dtype=np.float64)
+    meandev_bulgefit = np.asarray(param_cat[columns['fit_mad_b']], dtype=np.float64)
+    ## Check which fit as been prefered (SERSIC or BULGE+DISK)
+    use_sersic = meandev_bulgefit >= meandev_sersicfit
+    fit = np.where(use_sersic[:,np.newaxis], sersicfit[:,:8], bulgefit[:,:8])
+    meandev = np.where(use_sersic, meandev_sersicfit, meandev_bulgefit)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e1_fit = ( (1-fit[:,3])/(1+fit[:,3]) )*np.cos(2*fit[:,7])
+        e2_fit = ( (1-fit[:,3])/(1+fit[:,3]) )*np.sin(2*fit[:,7])
+        ## Add weight as a function of deviation of the fit from real image
+        weight_fit = 1/meandev
+    return np.stack([e1_fit, e2_fit, weight_fit], axis=1)
+
+
+def get_fit_table(cosmos_cat_dir):
+    '''
+    Return the table [n_galaxies, 3] of e1_fit, e2_fit and weight_fit of the catalog, memory-mapped and loaded only once per process
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: directory of catalog
+    '''
+    if cosmos_cat_dir not in _fit_tables:
+        _fit_tables[cosmos_cat_dir] = shared_table('fit_table', os.path.join(cosmos_cat_dir, 'real_galaxy_catalog_25.2_fits.fits'),
+                                                   lambda: _compute_fit_table(get_cosmos_catalog(cosmos_cat_dir).param_cat))
+    return _fit_tables[cosmos_cat_dir]
+
+
+def _compute_magnitude_table(cosmos_cat):
+    '''
+    Return the table [n_galaxies, 2] of the magnitudes in r band and in H band of the parametric galaxies of the catalog (NaN if the galaxy cannot be built)
+    '''
+    from tqdm import trange
+    bandpass_r = filters['r'].withZeropoint(28.13)
+    bandpass_h = filters['H'].withZeropoint(24.92-22.35*coeff_noise_h)
+    table = np.full((cosmos_cat.nobjects, 2), np.nan)
+    for idx in trange(cosmos_cat.nobjects, desc='magnitude table'):
+        try:
+            gal = cosmos_cat.makeGalaxy(idx, gal_type='parametric', chromatic=True, noise_pad_size=0)
+            table[idx] = gal.calculateMagnitude(bandpass_r), gal.calculateMagnitude(bandpass_h)
+        except Exception:
+            pass
+    return table
+
+
+def get_magnitude_table(cosmos_cat_dir):
+    '''
+    Return the table [n_galaxies, 2] of the r and H magnitudes of the parametric galaxies of the catalog, memory-mapped and loaded only once per process
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: directory of catalog
+    '''
+    if cosmos_cat_dir not in _magnitude_tables:
+        _magnitude_tables[cosmos_cat_dir] = shared_table('magnitude_table', os.path.join(cosmos_cat_dir, 'real_galaxy_catalog_25.2_fits.fits'),
+                                                         lambda: _compute_magnitude_table(get_cosmos_catalog(cosmos_cat_dir)))
+    return _magnitude_tables[cosmos_cat_dir]
+
+
+def get_used_idx(cosmos_cat_dir, training_or_test, mag_cut=None):
+    '''
+    Return the indexes of the part of the catalog used for the sample (the first 5000 galaxies for the test sample, the
+    others for training and validation). If mag_cut is given, only the galaxies brighter than mag_cut in r band are kept,
+    so that the generators never draw a galaxy rejected by the magnitude cut
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: directory of catalog
+    training_or_test: 'training', 'validation' or 'test'
+    mag_cut: cut in magnitude (r band) of the galaxies, None for no cut
+    '''
+    split = 'test' if training_or_test == 'test' else 'training'
+    key = (cosmos_cat_dir, split, mag_cut)
+    if key not in _eligible_idx:
+        nobjects = get_cosmos_catalog(cosmos_cat_dir).nobjects
+        used_idx = np.arange(5000) if split == 'test' else np.arange(5000, nobjects)
+        if mag_cut is not None:
+            mag_r = get_magnitude_table(cosmos_cat_dir)[:,0]
+            used_idx = np.array(shared_table('eligible_idx', os.path.join(cosmos_cat_dir, 'real_galaxy_catalog_25.2_fits.fits'),
+                                    lambda: used_idx[mag_r[used_idx] < mag_cut], depends_on={'split': split, 'mag_cut': float(mag_cut)}))
+        _eligible_idx[key] = used_idx
+    return _eligible_idx[key]
+
+
+def _real_params_nbytes(real_params):
+    '''
+    Return the memory used by the HST images of a real galaxy (galaxy, PSF and noise images)
+    '''
+    return sum(image.array.nbytes for image in real_params[:3] if image is not None)
+
+
+def get_real_galaxy(cosmos_cat_dir, idx, noise_pad_size, max_memory=1024, gsparams=None, rng=None):
+    '''
+    Return the real galaxy idx of the COSMOS catalog, padded with noise drawn from rng. The HST images of the galaxy are
+    taken from the least recently used cache of the process if available
+
+    Parameters:
+    ----------
+    cosmos_cat_dir: directory of catalog
+    idx: index of the galaxy in the catalog
+    noise_pad_size: size (in arcsec) of the noise padding of the real galaxy image
+    max_memory: memory budget of the cache in MB (0 to disable the cache)
+    gsparams: GSParams of the galaxy
+    rng: random generator of the noise padding (galsim.BaseDeviate), the same for the same image whatever the content of the cache
+    '''
+    global _real_galaxies_nbytes
+    key = (cosmos_cat_dir, idx)
+    if key in _real_galaxies:
+        _real_galaxies.move_to_end(key)
+        real_params = _real_galaxies[key][0]
+    else:
+        # (galaxy image, PSF image, noise image, pixel scale, noise variance), as used by COSMOSCatalog.makeGalaxy
+        real_params = get_cosmos_catalog(cosmos_cat_dir).getRealParams(idx)
+        nbytes = _real_params_nbytes(real_params)
+        if nbytes <= max_memory * 1024**2:
+            _real_galaxies[key] = (real_params, nbytes)
+            _real_galaxies_nbytes += nbytes
+            # Evict the least recently used galaxies above the budget
+            while _real_galaxies_nbytes > max_memory * 1024**2:
+                _, (_, evicted_nbytes) = _real_galaxies.popitem(last=False)
+                _real_galaxies_nbytes -= evicted_nbytes
+    return galsim.RealGalaxy(real_params, noise_pad_size=noise_pad_size, rng=rng, gsparams=gsparams)
+
+
 ############ PARAMETER MEASUREMENTS
 def get_fit_data(cosmos_cat_dir,idx, param_or_real='param'):
     '''
@@ -28,23 +219,8 @@ def get_fit_data(cosmos_cat_dir,idx, param_or_real='param'):
     idx: index of the galaxy to consider
     '''
     if param_or_real == 'param':
-        ## Import catalog
-        fitted_catalog = fits.open(cosmos_cat_dir+'/real_galaxy_catalog_25.2_fits.fits')
-        ## Check which fit as been prefered (SERSIC or BULGE+DISK)
-        sersicfit = fitted_catalog[1].data['SERSICFIT'][idx]
-        bulgefit = fitted_catalog[1].data['BULGEFIT'][idx]
-        meandev_sersicfit = fitted_catalog[1].data['FIT_MAD_S'][idx]
-        meandev_bulgefit = fitted_catalog[1].data['FIT_MAD_B'][idx]
-        if meandev_bulgefit >= meandev_sersicfit :
-            ## Compute ellipticities as function of fit prefered
-            e1_fit = ( (1-sersicfit[3])/(1+sersicfit[3]) )*np.cos(2*sersicfit[7])
-            e2_fit = ( (1-sersicfit[3])/(1+sersicfit[3]) )*np.sin(2*sersicfit[7])
-            ## Add weight as a function of deviation of the fit from real image
-            weight_fit = 1/meandev_sersicfit
-        else :
-            e1_fit = ( (1-bulgefit[3])/(1+bulgefit[3]) )*np.cos(2*bulgefit[7])
-            e2_fit = ( (1-bulgefit[3])/(1+bulgefit[3]) )*np.sin(2*bulgefit[7])
-            weight_fit = 1/meandev_bulgefit
+        ## Ellipticities and weight of the fit prefered (SERSIC or BULGE+DISK), computed once for the whole catalog
+        e1_fit, e2_fit, weight_fit = get_fit_table(cosmos_cat_dir)[idx]
         return [e1_fit, e2_fit, weight_fit]
     else:
         return [np.nan, np.nan, np.nan]
@@ -77,20 +253,12 @@ def get_data(gal, gal_image, psf_image, param_or_real='param'):
 
 
 ############ SHIFTING GALAXIES
+# Methods of shifting of the galaxies (see shift_gal)
+shift_methods = ['noshift', 'uniform', 'annulus']
 
-def shift_gal(gal, method='uniform', shift_x0=0., shift_y0=0., max_dx=0.1, min_r = 0.65/2., max_r = 2.):
+def _draw_shift(method='uniform', max_dx=0.1, min_r = 0.65/2., max_r = 2.):
     """
-    Return galaxy shifted according to the chosen shifting method
-    
-    Parameters:
-    ----------
-    gal: galaxy to shift (GalSim object)
-    method: method to use for shifting
-    shift_x0: shift of centered/brightest galaxy to shift others according to its coordinates
-    shift_y0: shift of centered/brightest galaxy to shift others according to its coordinates
-    max_dx: dx maximum when using uniform shift
-    min_r: minimum radius of annulus (half the value of mean LSST PSF fwhm by default)
-    max_r: maximum radius of annulus
+    Return a shift (in arcsec) drawn with the chosen shifting method (see shift_gal)
     """
     if method == 'noshift':
         shift_x = 0.
@@ -103,22 +271,193 @@ def shift_gal(gal, method='uniform', shift_x0=0., shift_y0=0., max_dx=0.1, min_r
         theta = np.random.uniform(0., 2*np.pi)
         shift_x = r * np.cos(theta)
         shift_y = r * np.sin(theta)
-    elif method == 'uniform+betaprime':
-        r = np.clip(scipy.stats.betaprime.rvs(*beta_prime_parameters), 0., 0.6)
-        theta = np.random.uniform(0., 2*np.pi)
-        shift_x = r * np.cos(theta) + np.random.uniform(-max_dx,+max_dx)
-        shift_y = r * np.sin(theta) + np.random.uniform(-max_dx,+max_dx)
     else:
-        raise ValueError
+        raise ValueError('Unknown shifting method {0}, must be one of {1}'.format(method, shift_methods))
+    return shift_x, shift_y
+
+
+def shift_gal(gal, method='uniform', shift_x0=0., shift_y0=0., max_dx=0.1, min_r = 0.65/2., max_r = 2.):
+    """
+    Return galaxy shifted according to the chosen shifting method
+    
+    Parameters:
+    ----------
+    gal: galaxy to shift (GalSim object)
+    method: method to use for shifting
+    shift_x0: shift of centered/brightest galaxy to shift others according to its coordinates
+    shift_y0: shift of centered/brightest galaxy to shift others according to its coordinates
+    max_dx: dx maximum when using uniform shift
+    min_r: minimum radius of annulus (half the value of mean LSST PSF fwhm by default)
+    max_r: maximum radius of annulus
+    """
+    shift_x, shift_y = _draw_shift(method, max_dx=max_dx, min_r=min_r, max_r=max_r)
     shift_x += shift_x0
     shift_y += shift_y0
     return gal.shift((shift_x,shift_y)), (shift_x,shift_y)
 
 
+def _allowed_intervals(x, method, centers, min_dist, max_dx, min_r, max_r):
+    """
+    Return the intervals (y_min, y_max) of the support of the shifting method at the abscissa x, outside the discs of radius min_dist around centers
+    """
+    if method == 'uniform':
+        intervals = [(-max_dx, max_dx)] if abs(x) <= max_dx else []
+    elif method == 'annulus':
+        intervals = []
+        if abs(x) < max_r:
+            y_out = np.sqrt(max_r**2 - x**2)
+            y_in = np.sqrt(max(min_r**2 - x**2, 0.))
+            intervals = [(-y_out, -y_in), (y_in, y_out)] if y_in > 0 else [(-y_out, y_out)]
+    else:
+        raise ValueError(method)
+    for center_x, center_y in centers:
+        if abs(x - center_x) < min_dist:
+            half_chord = np.sqrt(min_dist**2 - (x - center_x)**2)
+            lo, hi = center_y - half_chord, center_y + half_chord
+            intervals = [(a, b) for a, b in intervals if b <= lo or a >= hi] + \
+                        [(a, lo) for a, b in intervals if a < lo < b] + [(hi, b) for a, b in intervals if a < hi < b]
+    return intervals
+
+
+def sample_allowed_shift(method, centers, min_dist, max_dx=0.1, min_r = 0.65/2., max_r = 2., n_grid=512):
+    """
+    Return a shift drawn directly with the shifting method restricted to the region further than min_dist from all the
+    centers (None if this region is empty). The abscissa is drawn from its marginal distribution in the allowed region,
+    computed on n_grid points, and the ordinate uniformly in the allowed intervals at this abscissa, so that no draw is rejected
+
+    Parameters:
+    ----------
+    method: method to use for shifting ('noshift', 'uniform' or 'annulus')
+    centers: positions (in arcsec) of the galaxies already placed
+    min_dist: minimum distance (in arcsec) to the centers
+    max_dx: dx maximum when using uniform shift
+    min_r: minimum radius of annulus
+    max_r: maximum radius of annulus
+    n_grid: number of abscissae on which the marginal distribution is computed
+    """
+    centers = np.reshape(centers, (-1, 2))
+    if method == 'noshift':
+        return (0., 0.) if np.all(np.hypot(centers[:,0], centers[:,1]) > min_dist) else None
+    x_max = max_dx if method == 'uniform' else max_r
+    xs = np.linspace(-x_max, x_max, n_grid)
+    lengths = np.array([sum(b - a for a, b in _allowed_intervals(x, method, centers, min_dist, max_dx, min_r, max_r)) for x in xs])
+    cdf = np.concatenate([[0.], np.cumsum((lengths[1:] + lengths[:-1])/2.)])
+    if cdf[-1] <= 0:
+        return None
+    x = np.interp(np.random.uniform(0., cdf[-1]), cdf, xs)
+    intervals = _allowed_intervals(x, method, centers, min_dist, max_dx, min_r, max_r)
+    if not intervals:
+        # Edge of the allowed region, between two abscissae of the grid: take the closest abscissa where it is not empty
+        x = xs[np.argmin(np.where(lengths > 0, np.abs(xs - x), np.inf))]
+        intervals = _allowed_intervals(x, method, centers, min_dist, max_dx, min_r, max_r)
+    widths = np.array([b - a for a, b in intervals])
+    a, b = intervals[np.random.choice(len(intervals), p=widths/np.sum(widths))]
+    return x, np.random.uniform(a, b)
+
+
+def has_isolated_galaxy(positions, min_dist):
+    """
+    Return True if at least one of the galaxies is further than min_dist from all the others (always True for a single galaxy)
+    """
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) < 2:
+        return True
+    dist = np.hypot(positions[:,np.newaxis,0]-positions[np.newaxis,:,0], positions[:,np.newaxis,1]-positions[np.newaxis,:,1])
+    np.fill_diagonal(dist, np.inf)
+    return bool(np.any(np.all(dist > min_dist, axis=1)))
+
+
+def sample_shifts(nb_blended_gal, nmax_blend, method_first_shift='uniform', method_others_shift='uniform', center_first=False, max_dx=0.1, min_r = 0.65/2., max_r = 2., min_dist=0., separate_all=False, max_try=100):
+    """
+    Return the shifts of the galaxies of a blend, with shape [nmax_blend, 2], and the number of blends whose positions were drawn again
+    The first galaxy is shifted with method_first_shift (unless center_first) and the others with method_others_shift, as with shift_gal.
+    With min_dist, the positions are drawn before any image is rendered so that the blend can pass the training separation
+    cut of peak_detection (the detected galaxy further than min_dist from all the others):
+    - by default, the positions of the blend are drawn again until at least one galaxy is further than min_dist from all
+      the others. This is necessary for the cut, which is still applied by peak_detection to the detected galaxy, so the
+      selected blends are the same as without sampling,
+    - with separate_all, each galaxy is drawn directly in the region further than min_dist from the galaxies already
+      placed (see sample_allowed_shift). Every blend passes the cut whichever galaxy is detected, but close pairs of
+      neighbours are excluded too, which the cut of peak_detection does not do.
+
+    Parameters:
+    ----------
+    nb_blended_gal: number of galaxies in the blend
+    nmax_blend: maximum number of galaxies in a blend (size of the returned array)
+    method_first_shift: method to use for shifting the first galaxy
+    method_others_shift: method to use for shifting the other galaxies
+    center_first: do not shift the first galaxy
+    max_dx: dx maximum when using uniform shift
+    min_r: minimum radius of annulus
+    max_r: maximum radius of annulus
+    min_dist: minimum distance (in arcsec) of the training separation cut (no constraint if 0)
+    separate_all: place every galaxy further than min_dist from all the others
+    max_try: maximum number of blends drawn before raising a RuntimeError
+    """
+    for n_try in range(max_try):
+        shift = np.zeros((nmax_blend,2))
+        for j in range(nb_blended_gal):
+            if j == 0 and center_first:
+                continue
+            method = method_first_shift if j == 0 else method_others_shift
+            if separate_all and min_dist > 0:
+                shift_j = sample_allowed_shift(method, shift[:j], min_dist, max_dx=max_dx, min_r=min_r, max_r=max_r)
+                if shift_j is None:
+                    # No room left for this galaxy: draw the blend again
+                    break
+                shift[j] = shift_j
+            else:
+                shift[j] = _draw_shift(method, max_dx=max_dx, min_r=min_r, max_r=max_r)
+        else:
+            if min_dist <= 0 or separate_all or has_isolated_galaxy(shift[:nb_blended_gal], min_dist):
+                return shift, n_try
+    raise RuntimeError('Could not place {0} galaxies passing the separation cut of {1} arcsec in {2} draws'.format(nb_blended_gal, min_dist, max_try))
+
+
 
 ########### PEAK DETECTION
 
-def peak_detection(denormed_img, band, shifts, img_size, npeaks, nb_blended_gal, training_or_test, dist_cut):
+def find_peaks_batch(images, threshold, npeaks=None, box_size=3):
+    '''
+    Return, for each image of the batch, an array of the detected peaks with columns (x_peak, y_peak, peak_value, x_centroid, y_centroid), sorted by decreasing peak value
+    Vectorized equivalent of photutils find_peaks with centroid_func=centroid_com: a pixel is a peak if it is the maximum of its box_size x box_size neighbourhood (zero outside the image) and above the threshold, its centroid is the center of mass of this neighbourhood.
+
+    Parameters:
+    ----------
+    images: array of images with shape [n_images, nx, ny] (or a single image [nx, ny])
+    threshold: detection threshold, scalar or one value per image
+    npeaks: maximum number of peaks to return per image (all if None)
+    box_size: size of the box used for local maximum and centroid computation
+    '''
+    import scipy.ndimage
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=float), (len(images),))
+
+    data_max = scipy.ndimage.maximum_filter(images, size=(1, box_size, box_size), mode='constant', cval=0.0)
+    peak_mask = (images == data_max) & (images > threshold[:, np.newaxis, np.newaxis])
+    n_img, y_peaks, x_peaks = np.nonzero(peak_mask)
+    peak_values = images[n_img, y_peaks, x_peaks]
+
+    # Center of mass in the box around each peak. Padding with zeros is equivalent to trimming the box at the image edges.
+    half = box_size // 2
+    padded = np.pad(images, ((0, 0), (half, half), (half, half)), mode='constant')
+    dy, dx = np.mgrid[-half:box_size-half, -half:box_size-half]
+    cutouts = padded[n_img[:, np.newaxis, np.newaxis], (y_peaks[:, np.newaxis, np.newaxis] + half + dy), (x_peaks[:, np.newaxis, np.newaxis] + half + dx)]
+    total = np.sum(cutouts, axis=(1, 2))
+    x_centroids = x_peaks + np.sum(cutouts*dx, axis=(1, 2))/total
+    y_centroids = y_peaks + np.sum(cutouts*dy, axis=(1, 2))/total
+
+    peaks = np.stack([x_peaks, y_peaks, peak_values, x_centroids, y_centroids], axis=1)
+    # Sort by image then by decreasing peak value, ties in reverse pixel order as the astropy Table sort(reverse=True) used with photutils
+    order = np.lexsort((-(y_peaks*images.shape[2] + x_peaks), -peak_values, n_img))
+    peaks, n_img = peaks[order], n_img[order]
+    splits = np.searchsorted(n_img, np.arange(1, len(images)))
+    return [p[:npeaks] for p in np.split(peaks, splits)]
+
+
+def peak_detection(denormed_img, band, shifts, img_size, npeaks, nb_blended_gal, training_or_test, dist_cut, method='photutils'):
     '''
     Return coordinates of the centroid of the closest galaxy from the center
 
@@ -132,33 +471,65 @@ def peak_detection(denormed_img, band, shifts, img_size, npeaks, nb_blended_gal,
     nb_blended_gal: number of blended galaxies in the image
     training_or_test: choice of training or test sample being generated
     dist_cut: cut in distance to check if detected galaxy is not too close from its neighbours
+    method: peak finder to use, 'photutils' (find_peaks) or 'fast' (find_peaks_batch)
     '''
     gal = denormed_img
-    df_temp = photutils.find_peaks(gal, threshold=5*np.sqrt(sky_level_pixel[band]), npeaks=npeaks, centroid_func=centroid_com)
-    if df_temp is not None:
-        df_temp['x_peak'] = (df_temp['x_centroid']-((img_size/2.)-0.5))*pixel_scale[band]
-        df_temp['y_peak'] = (df_temp['y_centroid']-((img_size/2.)-0.5))*pixel_scale[band]
+    threshold = 5*np.sqrt(sky_level_pixel[band])
+    if method == 'photutils':
+        import photutils
+        from photutils.centroids import centroid_com
+        df_temp = photutils.find_peaks(gal, threshold=threshold, npeaks=npeaks, centroid_func=centroid_com)
+        if df_temp is None:
+            return False
         df_temp.sort('peak_value', reverse=True)
-        # Distances of true centers to brightest peak
-        qq = [np.sqrt(float((shifts[j,0]-df_temp['x_peak'][0])**2+ (shifts[j,1]-df_temp['y_peak'][0])**2)) for j in range(nb_blended_gal)]
-        idx_closest = np.argmin(qq)
-        if nb_blended_gal>1:
-            # Distance from peak galaxy to others
-            qq_prime = [np.sqrt(float((shifts[idx_closest,0]-shifts[j,0])**2+ (shifts[idx_closest,1]-shifts[j,1])**2)) if j!=idx_closest else np.inf for j in range(nb_blended_gal)]
-            idx_closest_to_peak_galaxy = np.argmin(qq_prime)
-            if training_or_test != 'test':
-                if not np.all(np.array(qq_prime) > dist_cut):
-                    print('TRAINING CUT: closest is not central and others are too close')
-                    return False
-        else:
-            idx_closest_to_peak_galaxy = np.nan
-        return idx_closest, idx_closest_to_peak_galaxy, df_temp[0]['x_centroid'], df_temp[0]['y_centroid'], df_temp[0]['x_peak'], df_temp[0]['y_peak'], len(df_temp)
+        x_centroid, y_centroid = df_temp[0]['x_centroid'], df_temp[0]['y_centroid']
+        n_peak = len(df_temp)
+    elif method == 'fast':
+        peaks = find_peaks_batch(gal, threshold, npeaks=npeaks)[0]
+        if len(peaks) == 0:
+            return False
+        x_centroid, y_centroid = peaks[0, 3], peaks[0, 4]
+        n_peak = len(peaks)
+    else:
+        raise ValueError(method)
+    x_peak = (x_centroid-((img_size/2.)-0.5))*pixel_scale[band]
+    y_peak = (y_centroid-((img_size/2.)-0.5))*pixel_scale[band]
+
+    # Distances of true centers to brightest peak
+    positions = np.asarray(shifts, dtype=float)[:nb_blended_gal]
+    qq = np.hypot(positions[:,0]-x_peak, positions[:,1]-y_peak)
+    idx_closest = np.argmin(qq)
+    if nb_blended_gal>1:
+        # Distance from peak galaxy to others
+        qq_prime = np.hypot(positions[:,0]-positions[idx_closest,0], positions[:,1]-positions[idx_closest,1])
+        qq_prime[idx_closest] = np.inf
+        idx_closest_to_peak_galaxy = np.argmin(qq_prime)
+        if training_or_test != 'test':
+            if not np.all(qq_prime > dist_cut):
+                print('TRAINING CUT: closest is not central and others are too close')
+                return False
     else:
-        return False
+        idx_closest_to_peak_galaxy = np.nan
+    return idx_closest, idx_closest_to_peak_galaxy, x_centroid, y_centroid, x_peak, y_peak, n_peak
+
+########## FLUX RESCALING OF REAL IMAGES
+
+def rescale_real_images(real_images, param_fluxes):
+    '''
+    Return the real galaxy images rescaled in each band to the flux of their parametric model, with shape [n_band, n_gal, nx, ny]
+
+    Parameters:
+    ----------
+    real_images: real galaxy images with shape [n_gal, nx, ny] (the minimum of each image is set to 0 before rescaling)
+    param_fluxes: fluxes of the parametric images with shape [n_band, n_gal]
+    '''
+    real_images = real_images - np.min(real_images, axis=(1,2), keepdims=True)
+    ratios = np.asarray(param_fluxes) / np.sum(real_images, axis=(1,2))
+    return ratios[:, :, np.newaxis, np.newaxis] * real_images[np.newaxis]
 
 ########## DRAWING OF IMAGE WITH GALSIM
 
-def draw_images(galaxies_psf, band, img_size, filter_name,sky_level_pixel, real_or_param = 'param'):
+def draw_images(galaxies_psf, band, img_size, filter_name,sky_level_pixel, real_or_param = 'param', shifts=None, stamp_factor=1.5, draw_method='fft', phot_flux_per_pixel=1., noiseless_idx=None):
     '''
     Return single galaxy noiseless images as well as the blended noisy one
 
@@ -170,24 +541,139 @@ def draw_images(galaxies_psf, band, img_size, filter_name,sky_level_pixel, real_
     filter_name: name of the filter
     sky_level_pixel: sky level pixel for noise realization
     real_or_param: the galaxy generation use real image or parametric model
+    shifts: shifts (in arcsec) of the galaxies from the center of the image. If given, the galaxies must be centered on (0,0)
+            and each one is only drawn in a stamp limited to its extent: the single galaxy images are then stamps with the
+            bounds of their pixels in the blend (use full_image to get the img_size x img_size array)
+    stamp_factor: size of the stamps relative to the size chosen by GalSim for the unshifted galaxy (the default keeps the
+                  difference with the full size drawing of the shifted galaxy below 0.1 sigma of the sky noise)
+    draw_method: 'fft', 'phot' (photon shooting) or 'auto' (photon shooting for the galaxies whose flux in the band is lower
+                 than phot_flux_per_pixel times the number of pixels of their stamp, FFT otherwise). Real galaxies (deconvolved
+                 by the HST PSF) are always drawn by FFT. The galaxies drawn by photon shooting contain their Poisson noise,
+                 which is not added again to the blend
+    phot_flux_per_pixel: threshold of the 'auto' draw_method (photon shooting costs about as much per photon as the FFT per pixel)
+    noiseless_idx: indexes of the galaxies whose noiseless image is needed (all if None). They are always drawn by FFT,
+                   so that photon shooting is only used for the galaxies which only contribute to the blend. The single
+                   galaxy images of the other galaxies drawn by photon shooting are noisy
     '''
     # Create image in r bandpass filter to do the peak detection
     blend_img = galsim.ImageF(img_size, img_size, scale=pixel_scale[band])
+    # Galaxies drawn by photon shooting already contain their Poisson noise: they are added after the noise realization
+    phot_img = galsim.ImageF(img_size, img_size, scale=pixel_scale[band])
+    bandpass = filters[filter_name] if real_or_param == 'param' else None
 
     images = []
     
     for j, gal in enumerate(galaxies_psf):
-        temp_img = galsim.ImageF(img_size, img_size, scale=pixel_scale[band])
-        # Parametric image
-        if real_or_param == 'param':
-            gal.drawImage(filters[filter_name], image=temp_img)
-        # Real image
-        elif real_or_param == "real":
-            gal.drawImage(image=temp_img)
+        if shifts is not None or draw_method == 'auto':
+            stamp_size = int(good_stamp_size(gal, pixel_scale[band], bandpass)*stamp_factor)
+        method = 'auto'
+        if real_or_param == 'param' and noiseless_idx is not None and j not in noiseless_idx:
+            if draw_method == 'phot' or (draw_method == 'auto' and gal.calculateFlux(bandpass) < phot_flux_per_pixel*stamp_size**2):
+                method = 'phot'
+        target_img = phot_img if method == 'phot' else blend_img
+
+        if shifts is None:
+            temp_img = galsim.ImageF(img_size, img_size, scale=pixel_scale[band])
+            # Parametric image
+            if real_or_param == 'param':
+                gal.drawImage(filters[filter_name], image=temp_img, method=method, rng=rng if method == 'phot' else None)
+            # Real image
+            elif real_or_param == "real":
+                gal.drawImage(image=temp_img)
+            target_img += temp_img
+        else:
+            position = blend_img.true_center + galsim.PositionD(shifts[j][0]/pixel_scale[band], shifts[j][1]/pixel_scale[band])
+            bounds = galaxy_stamp_bounds(gal, blend_img, position, bandpass, stamp_size)
+            if bounds.isDefined():
+                temp_img = galsim.ImageF(bounds, scale=pixel_scale[band])
+                draw_galaxy_stamp(gal, temp_img, position, bandpass, stamp_size, method=method)
+                target_img[bounds] += temp_img
+            else:
+                # The galaxy falls outside the image
+                temp_img = galsim.ImageF(galsim.BoundsI(1,1,1,1), scale=pixel_scale[band])
         images.append(temp_img)
-        blend_img += temp_img
     # add noise
     poissonian_noise = galsim.PoissonNoise(rng, sky_level=sky_level_pixel)
     blend_img.addNoise(poissonian_noise)
+    blend_img += phot_img
 
     return images, blend_img
+
+
+def full_image(image, img_size):
+    '''
+    Return the img_size x img_size array of a single galaxy image returned by draw_images (zero outside its stamp)
+
+    Parameters:
+    ----------
+    image: single galaxy image (GalSim image) returned by draw_images
+    img_size: size of the image given to draw_images
+    '''
+    b = image.bounds
+    if b.xmin == 1 and b.ymin == 1 and b.xmax == img_size and b.ymax == img_size:
+        return image.array.data
+    full = np.zeros((img_size, img_size), dtype=image.array.dtype)
+    full[b.ymin-1:b.ymax, b.xmin-1:b.xmax] = image.array
+    return full
+
+
+def good_stamp_size(gal, pixel_scale, bandpass=None):
+    '''
+    Return the size (in pixels) of the stamp GalSim would choose to draw the galaxy
+
+    Parameters:
+    ----------
+    gal: galaxy convolved with the PSF (GalSim object, chromatic or not)
+    pixel_scale: pixel scale of the image
+    bandpass: bandpass in which a chromatic galaxy is drawn
+    '''
+    if isinstance(gal, galsim.ChromaticObject):
+        gal = gal.evaluateAtWavelength(bandpass.effective_wavelength)
+    return gal.getGoodImageSize(pixel_scale)
+
+
+def galaxy_stamp_bounds(gal, image, position, bandpass=None, stamp_size=None):
+    '''
+    Return the bounds of the stamp of image (limited to the extent of the galaxy) in which a galaxy centered at position is drawn
+
+    Parameters:
+    ----------
+    gal: galaxy convolved with the PSF (GalSim object, chromatic or not), centered on (0,0)
+    image: GalSim image in which the galaxy is drawn
+    position: position of the center of the galaxy (galsim.PositionD) in the pixel coordinates of image
+    bandpass: bandpass in which a chromatic galaxy is drawn
+    stamp_size: size of the stamp in pixels (chosen by GalSim from the profile if None)
+    '''
+    if stamp_size is None:
+        stamp_size = good_stamp_size(gal, image.scale, bandpass)
+    ix = int(np.floor(position.x+0.5))
+    iy = int(np.floor(position.y+0.5))
+    return galsim.BoundsI(ix-stamp_size//2, ix+(stamp_size-1)//2, iy-stamp_size//2, iy+(stamp_size-1)//2) & image.bounds
+
+
+def draw_galaxy_stamp(gal, image, position, bandpass=None, stamp_size=None, method='auto'):
+    '''
+    Add the galaxy, centered at position, to the pixels of image lying in a stamp limited to the extent of the galaxy
+    Return the sub-image of image in which the galaxy is drawn (None if the stamp does not overlap the image)
+
+    Parameters:
+    ----------
+    gal: galaxy convolved with the PSF (GalSim object, chromatic or not), centered on (0,0)
+    image: GalSim image in which the galaxy is added
+    position: position of the center of the galaxy (galsim.PositionD) in the pixel coordinates of image
+    bandpass: bandpass in which a chromatic galaxy is drawn
+    stamp_size: size of the stamp in pixels (chosen by GalSim from the profile if None)
+    method: drawing method of GalSim ('phot' for photon shooting, with the random generator of the module)
+    '''
+    bounds = galaxy_stamp_bounds(gal, image, position, bandpass, stamp_size)
+    if not bounds.isDefined():
+        return None
+    stamp = image[bounds]
+    # drawImage centers the profile on the true center of the stamp: offset it to the galaxy position
+    offset = position - stamp.true_center
+    draw_rng = rng if method == 'phot' else None
+    if isinstance(gal, galsim.ChromaticObject):
+        gal.drawImage(bandpass, image=stamp, add_to_image=True, offset=offset, method=method, rng=draw_rng)
+    else:
+        gal.drawImage(image=stamp, add_to_image=True, offset=offset, method=method, rng=draw_rng)
+    return stamp
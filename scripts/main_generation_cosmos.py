@@ -3,127 +3,262 @@
 import numpy as np
 import sys
 import os
+import json
+import multiprocessing
 import galsim
 import pandas as pd
 from tqdm import tqdm, trange
 
 import utils
+import dataset_io
+import cosmos_params
 
+from cosmos_params import sky_level_pixel
 from images_generator import image_generator_sim, image_generator_real
+from images_utils import get_cosmos_catalog, get_fit_table, get_used_idx, shift_methods
 
 # The script is used as, eg,
 # >> python main_generation_cosmos.py test/ training simulation isolated false 10 1000
 # to produce 10 files in the training sample with 1000 images each of isolated galaxy centered on the image with no shift.
-# Before starting the generation, you need to create a directory to store your images which is in save_dir/case/training_or_test/ (See line 47 and 54 for save_dir)
-case = str(sys.argv[1]) # directory. Examples: test/
-training_or_test = str(sys.argv[2]) # this is a directory and a case used for image_generator: training, test or validation
-gal_type = str(sys.argv[3]) # choose type of image (parametric model or real image): simulation or real
-isolated_or_blended = str(sys.argv[4]) #Image of isolated galaxy of blended galaxies: isolated or blended
-do_peak_detection = str(sys.argv[5]).lower() == 'true'
-N_files = int(sys.argv[6]) # Nb of files to generate
-N_per_file = int(sys.argv[7]) # Number of images (on image is contained of N filters) per file
-assert training_or_test in ['training', 'validation', 'test']
+# The images are stored in save_dir/case/training_or_test/ (See run for save_dir), which is created if needed.
+# The fixed parameters (default_config) can be changed without editing the script with a json file given as last argument, eg,
+# >> python main_generation_cosmos.py test/ training simulation blended true 10 1000 config.json
+# with config.json containing, eg, {"mag_cut": 26.5, "nmax_blend": [1,4], "full_or_single": "single"}. See sweep.py to run several configurations.
+# With {"append": true}, the new files are added to the dataset already in save_dir (see dataset_io.Dataset to read it).
 
 # Fixed parameters:
-max_try = 100 # maximum number of try before leaving the function (to avoir infinite loop)
-mag_cut = 27.5 # cut in magnitude to select galaxies below this magnitude
-max_stamp_size = 64 # Size of patch to generate
-nmax_blend = (1,6) # Number of galaxies on an image if integer, or interval for sampling if tuple
-center_brightest = False # Center the brightest galaxy (i.e. the galaxy with the lowest magnitude)
-# If center_brightest = False : choose with method to use to shift the brightest
-method_shift_brightest = 'uniform'
-# And then you need to choose the method to shift the other galaxies as a function of the position of the brightest on the image
-method_shift_others = 'uniform'
-max_dx = 3.2 #in arcseconds, limit to use for uniform shifting: the center of the shifted galaxy will be shifted from the center or from the brightest galaxy from a random number between [-max_dx ; max_dx] arcsecond
-max_r = 2. #in arcseconds, limit to use for annulus shifting: galaxy is shifted in an annulus around the center of the image or of the brightest galaxy which has for minimum radius fwhm_lsst/2 and for maximum radius max_r
-psf_lsst_fixed = False # Choice to have a fixed LSST PSF for each image or not
-
-# Load data_dir from environment variables
-data_dir = str(os.environ.get('IMGEN_DATA'))
-
-# Method to shift centered galaxy
-if isolated_or_blended == 'isolated':
-    # where to save images and data
-    save_dir = data_dir + case + training_or_test 
-    # what to call those files
-    root = 'galaxies_isolated_20191024_'
-    # Maximum number of galaxies on the image. Here, "isolated" so only 1 galaxy.
-    nmax_blend = 1
-elif isolated_or_blended == 'blended':
-    # where to save images and data
-    save_dir = data_dir + case + training_or_test 
-    # what to call those files
-    root = 'galaxies_blended_20191024_'
-    # Maximum number of galaxies on the image.
-    nmax_blend = nmax_blend
-else:
-    raise NotImplementedError
-# Path to the catalog
-cosmos_cat_dir = os.path.join(data_dir,'COSMOS_25.2_training_sample')
-# Loading the COSMOS catalog
-cosmos_cat = galsim.COSMOSCatalog('real_galaxy_catalog_25.2.fits', dir=cosmos_cat_dir) 
-# Select galaxies to keep for the test sample
-if training_or_test == 'test':
-    used_idx = np.arange(5000)
-# Rest of the galaxies used for training and validation
-else:
-    used_idx = np.arange(5000,cosmos_cat.nobjects)
-
-# keys for data objects
-keys = []
-if isolated_or_blended=='isolated':
-    keys = ['redshift_0', 'moment_sigma_0', 'e1_ksb_0', 'e2_ksb_0','e1_fit_0', 'e2_fit_0', 'mag_0', 'weight_fit_0']
-elif isolated_or_blended=='blended':
-    if isinstance(nmax_blend, int):
-            for i in range (nmax_blend):
-                keys = keys + ['redshift_'+str(i), 'moment_sigma_'+str(i), 'e1_ksb_'+str(i), 'e2_ksb_'+str(i),'e1_fit_'+str(i), 'e2_fit_'+str(i), 'mag_'+str(i), 'weight_fit_'+str(i)]
+default_config = {
+    'max_try': 100, # maximum number of try before leaving the function (to avoir infinite loop)
+    'mag_cut': 27.5, # cut in magnitude to select galaxies below this magnitude
+    'max_stamp_size': 64, # Size of patch to generate
+    'nmax_blend': (1,6), # Number of galaxies on an image if integer, or interval for sampling if tuple
+    'center_brightest': False, # Center the brightest galaxy (i.e. the galaxy with the lowest magnitude)
+    # If center_brightest = False : choose with method to use to shift the brightest
+    'method_shift_brightest': 'uniform',
+    # And then you need to choose the method to shift the other galaxies as a function of the position of the brightest on the image
+    'method_shift_others': 'uniform',
+    'max_dx': 3.2, #in arcseconds, limit to use for uniform shifting: the center of the shifted galaxy will be shifted from the center or from the brightest galaxy from a random number between [-max_dx ; max_dx] arcsecond
+    'max_r': 2., #in arcseconds, limit to use for annulus shifting: galaxy is shifted in an annulus around the center of the image or of the brightest galaxy which has for minimum radius fwhm_lsst/2 and for maximum radius max_r
+    'separate_all_neighbours': False, # Training and validation: place every galaxy further than the separation cut of the peak detection from all the others, drawn directly from the allowed region, so that no rendered image is rejected. Stricter than the cut, which only applies to the detected galaxy (close neighbour pairs are excluded too)
+    'max_sampling_try': 100, # Maximum number of draws of the positions of a blend (before rendering) before the image is tried again
+    'psf_lsst_fixed': False, # Choice to have a fixed LSST PSF for each image or not
+    'full_or_single': 'full', # Noise and flux of the full surveys ('full') or of a single exposure ('single'), see cosmos_params.set_exposures
+    'precompute_eligible': True, # Draw only the galaxies brighter than mag_cut, from the magnitude table of the catalog cached in cache_dir (computed once per catalog)
+    'peak_detection_method': 'photutils', # 'photutils' (find_peaks) or 'fast' (vectorized maximum filter, same peaks and centroids)
+    'do_shape_measurement': True, # Measure KSB shapes during generation. If False, run measure_shapes.py on the saved files afterwards
+    'real_cache_size': 1024, # Memory budget (in MB) of the cache of the HST images of the real galaxies kept by each process (real images only)
+    'real_native_bands': False, # Draw real galaxies with the PSF and pixel scale of each band (otherwise the r-band image is rescaled in all bands)
+    'draw_method': 'fft', # 'fft', 'phot' (photon shooting) or 'auto' (photon shooting for faint galaxies, parametric images only). The saved noiseless images stay drawn by FFT, so photon shooting only applies to the detection image and to the neighbours of the training and validation samples. See validate_draw_method.py
+    'compact_test_storage': False, # Test sample only: save the images in the compact layout of dataset_io.py (only the galaxies drawn, cropped to their bounding box) instead of _images.npy
+    'storage_codec': None, # None (np.save), 'zlib' or 'zstd' (needs zstandard): save the images in compressed chunks with dataset_io.save_chunked
+    'storage_quantization': None, # With storage_codec, quantization step in units of the sky noise of each band (e.g. 0.1), None for lossless storage
+    'task_deadline': 900, # in seconds, images not generated within this time are generated again with another seed (no limit if None)
+    'max_task_retries': 3, # Maximum number of new seeds tried for an image which fails or times out. Failures are logged in save_dir/root_i_failures.jsonl (see utils.replay_failures)
+    'maxtasksperchild': 500, # Number of images after which a worker is replaced to bound its memory growth (never if None)
+    'report_worker_memory': False, # Print the resident memory (private and shared) of each worker of the pool after each file
+    'native_stamps': False, # Needs real_native_bands for real galaxies. Draw each instrument at its own pixel scale on stamps covering the same footprint (44 pixels in NIR, 128 in VIS, 64 in LSST bands for max_stamp_size=64), saved in separate files root_i_nir, root_i_vis and root_i_lsst (see dataset_io.NativeStampImages). Not supported by generation_server.py
+    'accuracy': 'default', # GSParams profile of the rendering: 'fast' (looser FFT thresholds, e.g. for training), 'default' or 'precise'. See benchmark_gsparams.py
+    'profile_workers': 0, # Number of workers profiled with cProfile in each file (0 for no profiling). The report of each file is written in save_dir/root_i_profile.txt (see utils.profile_worker)
+    'profile_memory': False, # With profile_workers, also trace the allocations of the profiled workers with tracemalloc (slow)
+    'append': False, # Add N_files new files after the files of the dataset already in save_dir, with seeds disjoint from theirs (see dataset_io.Dataset), instead of overwriting them. Files written without manifest are kept, their images were seeded from the entropy of the system
+}
+
+# Parameters of the command line, without default value
+run_parameters = ['case', 'training_or_test', 'gal_type', 'isolated_or_blended', 'do_peak_detection', 'N_files', 'N_per_file']
+
+
+def make_config(config_file=None, **parameters):
+    '''
+    Return the configuration of a run: default_config updated with the json config file and the parameters
+
+    Parameters:
+    ----------
+    config_file: json file of parameters (None if no file)
+    parameters: parameters of the run (run_parameters) and of default_config
+    '''
+    config = dict(default_config)
+    if config_file is not None:
+        with open(config_file) as f:
+            parameters = dict(json.load(f), **parameters)
+    unknown = set(parameters) - set(default_config) - set(run_parameters)
+    if unknown:
+        raise KeyError('Unknown parameters: {0}'.format(', '.join(sorted(unknown))))
+    config.update(parameters)
+    missing = set(run_parameters) - set(config)
+    if missing:
+        raise KeyError('Missing parameters: {0}'.format(', '.join(sorted(missing))))
+    return config
+
+
+def run(config):
+    '''
+    Generate the files of images, data and shifts of the configuration
+
+    Parameters:
+    ----------
+    config: configuration of the run (see make_config)
+    '''
+    case, training_or_test, gal_type, isolated_or_blended = config['case'], config['training_or_test'], config['gal_type'], config['isolated_or_blended']
+    do_peak_detection, N_files, N_per_file = config['do_peak_detection'], config['N_files'], config['N_per_file']
+    nmax_blend = config['nmax_blend']
+    assert training_or_test in ['training', 'validation', 'test']
+
+    # Load data_dir from environment variables
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+
+    # Method to shift centered galaxy
+    if isolated_or_blended == 'isolated':
+        # where to save images and data
+        save_dir = data_dir + case + training_or_test
+        # what to call those files
+        root = 'galaxies_isolated_20191024_'
+        # Maximum number of galaxies on the image. Here, "isolated" so only 1 galaxy.
+        nmax_blend = 1
+    elif isolated_or_blended == 'blended':
+        # where to save images and data
+        save_dir = data_dir + case + training_or_test
+        # what to call those files
+        root = 'galaxies_blended_20191024_'
+        # Maximum number of galaxies on the image.
+        nmax_blend = nmax_blend
     else:
-        for i in range (nmax_blend[1]):
-            keys = keys + ['redshift_'+str(i), 'moment_sigma_'+str(i), 'e1_ksb_'+str(i), 'e2_ksb_'+str(i),'e1_fit_'+str(i), 'e2_fit_'+str(i), 'mag_'+str(i), 'weight_fit_'+str(i)]
-
-keys = keys + ['nb_blended_gal', 'SNR', 'SNR_peak', 'mag', 'mag_ir', 'closest_x', 'closest_y', 'closest_mag', 'closest_mag_ir',  'idx_closest_to_peak', 'n_peak_detected', 'fwhm_lsst']
-
-# Create directories if needed
-if not os.path.exists(data_dir+case):
-    os.mkdir(data_dir+case)
-if not os.path.exists(save_dir):
-    os.mkdir(save_dir)
-
-
-for icat in trange(N_files):
-    # Run params
-    root_i = root+str(icat)
-
-    galaxies = []
-    shifts = []
-
-    #if training_or_test == 'test':
-        # If test, create Pandas DataFrame to return properties of test galaxies
-    # Here we save data for all datasets
-    df = pd.DataFrame(index=np.arange(N_per_file), columns=keys)
-    
-    # Depending of type of galaxies you wand (simulation or real galaxies) use the correct generating function
-    if gal_type == 'simulation':
-        res = utils.apply_ntimes(image_generator_sim, N_per_file, (cosmos_cat_dir, training_or_test, isolated_or_blended, used_idx, nmax_blend, max_try, mag_cut, method_shift_brightest, method_shift_others, max_dx, max_r, do_peak_detection, center_brightest, max_stamp_size, psf_lsst_fixed))
-    elif gal_type == 'real':
-        res = utils.apply_ntimes(image_generator_real, N_per_file, (cosmos_cat_dir, training_or_test, isolated_or_blended, used_idx, nmax_blend, max_try, mag_cut, method_shift_brightest, method_shift_others, max_dx, max_r, do_peak_detection, center_brightest, max_stamp_size, psf_lsst_fixed))
-
-    
-    for i in trange(N_per_file):
-        # Save data and shifts for all training, validation and test files
-        gal_noiseless, blend_noisy, data, shift = res[i]
-        assert set(data.keys()) == set(keys)
-        df.loc[i] = [data[k] for k in keys]
-        shifts.append(shift)
-        if training_or_test == 'test':
-            galaxies.append(np.append(gal_noiseless, np.expand_dims(blend_noisy, axis=0), axis = 0))
+        raise NotImplementedError
+    for method in [config['method_shift_brightest'], config['method_shift_others']]:
+        if method not in shift_methods:
+            raise ValueError('Unknown shifting method {0}, must be one of {1}'.format(method, shift_methods))
+    if config['native_stamps'] and gal_type == 'real' and not config['real_native_bands']:
+        raise ValueError('native_stamps needs real_native_bands for real galaxies')
+    # Noise levels and fluxes of the surveys, set before the pools are created so that the workers inherit them
+    cosmos_params.set_exposures(config['full_or_single'])
+    # Path to the catalog
+    cosmos_cat_dir = os.path.join(data_dir,'COSMOS_25.2_training_sample')
+    # Loading the COSMOS catalog and the table of fitted ellipticities before creating the pools: the workers inherit them
+    # and their tables are memory-mapped from the cache directory (shared by all processes)
+    get_cosmos_catalog(cosmos_cat_dir)
+    get_fit_table(cosmos_cat_dir)
+    # Select galaxies to keep: the first 5000 galaxies for the test sample, the rest of the galaxies for training and
+    # validation. The table of the galaxies passing the magnitude cut is cached and shared by the runs with the same cut
+    used_idx = get_used_idx(cosmos_cat_dir, training_or_test, config['mag_cut'] if config['precompute_eligible'] and gal_type == 'simulation' else None)
+
+    # keys for data objects
+    keys = []
+    if isolated_or_blended=='isolated':
+        keys = ['redshift_0', 'moment_sigma_0', 'e1_ksb_0', 'e2_ksb_0','e1_fit_0', 'e2_fit_0', 'mag_0', 'weight_fit_0', 'draw_idx_slot_0']
+    elif isolated_or_blended=='blended':
+        if isinstance(nmax_blend, int):
+                for i in range (nmax_blend):
+                    keys = keys + ['redshift_'+str(i), 'moment_sigma_'+str(i), 'e1_ksb_'+str(i), 'e2_ksb_'+str(i),'e1_fit_'+str(i), 'e2_fit_'+str(i), 'mag_'+str(i), 'weight_fit_'+str(i), 'draw_idx_slot_'+str(i)]
         else:
-            galaxies.append((gal_noiseless, blend_noisy))
-
-    # Save noisy blended images and denoised single central galaxy images
-    np.save(os.path.join(save_dir, root_i+'_images.npy'), galaxies)
-    # Save data and shifts
-    df.to_csv(os.path.join(save_dir, root_i+'_data.csv'), index=False)
-    np.save(os.path.join(save_dir, root_i+'_shifts.npy'), np.array(shifts))
-    
-    del galaxies, res, shifts, df
+            for i in range (nmax_blend[1]):
+                keys = keys + ['redshift_'+str(i), 'moment_sigma_'+str(i), 'e1_ksb_'+str(i), 'e2_ksb_'+str(i),'e1_fit_'+str(i), 'e2_fit_'+str(i), 'mag_'+str(i), 'weight_fit_'+str(i), 'draw_idx_slot_'+str(i)]
+
+    keys = keys + ['nb_blended_gal', 'SNR', 'SNR_peak', 'mag', 'mag_ir', 'closest_x', 'closest_y', 'closest_mag', 'closest_mag_ir',  'idx_closest_to_peak', 'n_peak_detected', 'fwhm_lsst', 'n_retries', 'n_rejected_detection', 'n_rejected_sampling']
+
+    # Create directories if needed
+    os.makedirs(save_dir, exist_ok=True)
+
+    # Manifest of the files of the dataset. The seeds of the files are taken in consecutive blocks, starting at a random
+    # seed for a new dataset. In append mode, the new files are numbered after the existing ones and their seeds are
+    # taken after the last block recorded (0 if none is), so that they never repeat the seeds of the existing files.
+    # Files written without manifest are in the manifest with seed_block None: their images were seeded by
+    # np.random.seed() from the entropy of the system, so they cannot repeat the seeds of the blocks
+    manifest = dataset_io.read_manifest(save_dir, root, index_existing=True) if config['append'] else None
+    if manifest is None or not manifest['files']:
+        manifest = {'files': [], 'n_images': 0, 'next_seed': int(np.random.RandomState().randint(1, 2**30))}
+        # The configuration of a new dataset is kept with its files (the configuration of each append is in the manifest)
+        with open(os.path.join(save_dir, root+'config.json'), 'w') as f:
+            json.dump(config, f, indent=1)
+    else:
+        manifest['next_seed'] = max([manifest['next_seed'] or 0] + [f['seed_block'] + f['n_seeds'] for f in manifest['files'] if f['seed_block'] is not None])
+    first_file = 1 + max([int(f['name'][len(root):]) for f in manifest['files']], default=-1)
+    n_seeds = N_per_file*(config['max_task_retries']+1)
+
+    for icat in trange(first_file, first_file+N_files):
+        # Run params
+        root_i = root+str(icat)
+        seed_block = manifest['next_seed']
+
+        # Images of each instrument with native stamps, of all the bands otherwise
+        instruments = list(cosmos_params.instrument_bands) if config['native_stamps'] else [None]
+        galaxies = {instrument: [] for instrument in instruments}
+        shifts = []
+        blends = {instrument: [] for instrument in instruments}
+
+        # Depending of type of galaxies you wand (simulation or real galaxies) use the correct generating function
+        if gal_type == 'simulation':
+            generator, args, kwargs = image_generator_sim, (cosmos_cat_dir, training_or_test, isolated_or_blended, used_idx, nmax_blend, config['max_try'], config['mag_cut'], config['method_shift_brightest'], config['method_shift_others'], config['max_dx'], config['max_r'], do_peak_detection, config['center_brightest'], config['max_stamp_size'], config['psf_lsst_fixed'], config['peak_detection_method'], config['do_shape_measurement'], config['accuracy']), {'draw_method': config['draw_method'], 'native_stamps': config['native_stamps'], 'separate_all_neighbours': config['separate_all_neighbours'], 'max_sampling_try': config['max_sampling_try']}
+        elif gal_type == 'real':
+            generator, args, kwargs = image_generator_real, (cosmos_cat_dir, training_or_test, isolated_or_blended, used_idx, nmax_blend, config['max_try'], config['mag_cut'], config['method_shift_brightest'], config['method_shift_others'], config['max_dx'], config['max_r'], do_peak_detection, config['center_brightest'], config['max_stamp_size'], config['psf_lsst_fixed'], config['peak_detection_method'], config['do_shape_measurement'], config['real_cache_size'], config['real_native_bands'], config['accuracy']), {'native_stamps': config['native_stamps'], 'separate_all_neighbours': config['separate_all_neighbours'], 'max_sampling_try': config['max_sampling_try']}
+        initializer, initargs = None, ()
+        if config['profile_workers'] > 0:
+            profile_dir = os.path.join(save_dir, root_i+'_profile')
+            os.makedirs(profile_dir, exist_ok=True)
+            initializer, initargs = utils.profile_worker, (profile_dir, config['profile_workers'], multiprocessing.Value('i', 0), config['profile_memory'])
+        res, failures = utils.apply_ntimes_robust(generator, N_per_file, args, kwargs, deadline=config['task_deadline'], max_retries=config['max_task_retries'], maxtasksperchild=config['maxtasksperchild'],
+                                                  seed_block=seed_block, failure_log=os.path.join(save_dir, root_i+'_failures.jsonl'), report_memory=config['report_worker_memory'],
+                                                  initializer=initializer, initargs=initargs)
+        if config['profile_workers'] > 0:
+            utils.merge_worker_profiles(profile_dir, os.path.join(save_dir, root_i+'_profile.txt'))
+        if len(res) < N_per_file:
+            print('{0} images of {1} could not be generated'.format(N_per_file-len(res), root_i))
+        if len(res) == 0:
+            # Nothing to save: the file is not written nor added to the manifest (its failures are in root_i_failures.jsonl),
+            # but its block of seeds is used anyway
+            manifest['next_seed'] = seed_block + n_seeds
+            dataset_io.write_manifest(save_dir, root, manifest)
+            continue
+
+        #if training_or_test == 'test':
+            # If test, create Pandas DataFrame to return properties of test galaxies
+        # Here we save data for all datasets
+        df = pd.DataFrame(index=np.arange(len(res)), columns=keys)
+
+        for i in trange(len(res)):
+            # Save data and shifts for all training, validation and test files
+            gal_noiseless, blend_noisy, data, shift = res[i]
+            assert set(data.keys()) == set(keys)
+            df.loc[i] = [data[k] for k in keys]
+            shifts.append(shift)
+            for instrument in instruments:
+                gal_noiseless_i = gal_noiseless if instrument is None else gal_noiseless[instrument]
+                blend_noisy_i = blend_noisy if instrument is None else blend_noisy[instrument]
+                if training_or_test == 'test' and config['compact_test_storage']:
+                    galaxies[instrument].append(gal_noiseless_i)
+                    blends[instrument].append(blend_noisy_i)
+                elif training_or_test == 'test':
+                    galaxies[instrument].append(np.append(gal_noiseless_i, np.expand_dims(blend_noisy_i, axis=0), axis = 0))
+                else:
+                    galaxies[instrument].append((gal_noiseless_i, blend_noisy_i))
+
+        # Save noisy blended images and denoised single central galaxy images
+        for instrument in instruments:
+            root_instrument = root_i if instrument is None else root_i+'_'+instrument
+            bands = list(range(len(sky_level_pixel))) if instrument is None else cosmos_params.instrument_bands[instrument]
+            if training_or_test == 'test' and config['compact_test_storage']:
+                dataset_io.save_compact_test(os.path.join(save_dir, root_instrument+'_images_compact'), galaxies[instrument], blends[instrument], df['nb_blended_gal'].astype(int).values)
+            elif config['storage_codec'] is not None:
+                dataset_io.save_chunked(os.path.join(save_dir, root_instrument+'_images_chunked'), galaxies[instrument], codec=config['storage_codec'], quantization=config['storage_quantization'], sky_level_pixel=[sky_level_pixel[k] for k in bands])
+            else:
+                np.save(os.path.join(save_dir, root_instrument+'_images.npy'), galaxies[instrument])
+        # Save data and shifts
+        df.to_csv(os.path.join(save_dir, root_i+'_data.csv'), index=False)
+        np.save(os.path.join(save_dir, root_i+'_shifts.npy'), np.array(shifts))
+        # The new rows are visible to the readers of the dataset once the file is completely written
+        manifest['files'].append({'name': root_i, 'n_images': len(res), 'seed_block': seed_block, 'n_seeds': n_seeds, 'config': config})
+        manifest['n_images'] += len(res)
+        manifest['next_seed'] = seed_block + n_seeds
+        dataset_io.write_manifest(save_dir, root, manifest)
+
+        del galaxies, blends, res, shifts, df
+
+
+if __name__ == '__main__':
+    config = make_config(sys.argv[8] if len(sys.argv) > 8 else None,
+                         case = str(sys.argv[1]), # directory. Examples: test/
+                         training_or_test = str(sys.argv[2]), # this is a directory and a case used for image_generator: training, test or validation
+                         gal_type = str(sys.argv[3]), # choose type of image (parametric model or real image): simulation or real
+                         isolated_or_blended = str(sys.argv[4]), #Image of isolated galaxy of blended galaxies: isolated or blended
+                         do_peak_detection = str(sys.argv[5]).lower() == 'true',
+                         N_files = int(sys.argv[6]), # Nb of files to generate
+                         N_per_file = int(sys.argv[7])) # Number of images (on image is contained of N filters) per file
+    run(config)
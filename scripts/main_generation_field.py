@@ -0,0 +1,55 @@
+# Import packages
+
+import numpy as np
+import sys
+import os
+import multiprocessing
+import pandas as pd
+
+from cosmos_params import filter_names_all
+from field_generator import image_generator_field
+
+# The script is used as, eg,
+# >> python main_generation_field.py field/ test 600 5000 60
+# to produce a field of 600x600 arcsec with 5000 galaxies (before the magnitude cut) from the test part of the catalog,
+# drawn in tiles of 60x60 arcsec in parallel. The images of the field are saved in save_dir/case/training_or_test/
+case = str(sys.argv[1]) # directory. Examples: field/
+training_or_test = str(sys.argv[2]) # part of the catalog used: training, test or validation
+field_size = float(sys.argv[3]) # size of the field in arcsec
+n_gal = int(sys.argv[4]) # Number of galaxies in the field before the magnitude cut
+tile_size = float(sys.argv[5]) # size of the tiles in arcsec (multiple of 0.6 arcsec)
+assert training_or_test in ['training', 'validation', 'test']
+
+# Fixed parameters:
+mag_cut = 27.5 # cut in magnitude to select galaxies below this magnitude
+psf_lsst_fixed = False # Choice to have a fixed LSST PSF for the field or not
+bands = range(10) # Bands in which the field is drawn
+
+# Load data_dir from environment variables
+data_dir = str(os.environ.get('IMGEN_DATA'))
+save_dir = data_dir + case + training_or_test
+root = 'field_'
+# Path to the catalog
+cosmos_cat_dir = os.path.join(data_dir,'COSMOS_25.2_training_sample')
+# Same split of the catalog as main_generation_cosmos.py
+if training_or_test == 'test':
+    used_idx = np.arange(5000)
+else:
+    used_idx = None
+
+if __name__ == '__main__':
+    if not os.path.exists(data_dir+case):
+        os.mkdir(data_dir+case)
+    if not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+
+    with multiprocessing.Pool() as pool:
+        if used_idx is None:
+            from images_utils import get_cosmos_catalog
+            used_idx = np.arange(5000, get_cosmos_catalog(cosmos_cat_dir).nobjects)
+        fields, catalog = image_generator_field(cosmos_cat_dir, field_size, n_gal, tile_size, used_idx, mag_cut, psf_lsst_fixed, bands, pool=pool)
+
+    # Save one image per band (pixel scales differ between instruments) and the catalog of the galaxies
+    for band, field in fields.items():
+        np.save(os.path.join(save_dir, root+filter_names_all[band]+'.npy'), field)
+    pd.DataFrame(catalog).to_csv(os.path.join(save_dir, root+'galaxies.csv'), index=False)
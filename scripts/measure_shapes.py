@@ -0,0 +1,108 @@
+# Import packages
+
+import numpy as np
+import sys
+import os
+import galsim
+import multiprocessing
+import pandas as pd
+from tqdm import trange
+
+from cosmos_params import pixel_scale
+from dataset_io import CompactTestImages, open_images
+
+# The script is used as, eg,
+# >> python measure_shapes.py test/ training blended 10
+# to fill the moment_sigma_i, e1_ksb_i and e2_ksb_i columns of the 10 first files generated with
+# main_generation_cosmos.py in save_dir/case/training_or_test/ with do_shape_measurement = False.
+# The measurement is done on the saved noiseless r-band stamps with the LSST PSF of each image.
+# The galaxies are saved in the order of the stack [detected galaxy, others...], the columns *_i of the data file are in
+# the order of drawing: the column draw_idx_slot_z of the data file gives the column of the galaxy of slot z. In the
+# training and validation samples, only the detected galaxy is saved so only its column is filled. In the test sample,
+# all the galaxies of the saved stack (_images.npy, compact or chunked layout of dataset_io.py) are measured.
+# For files generated before draw_idx_slot_z was saved, the shapes are written in the columns moment_sigma_slot_z,
+# e1_ksb_slot_z and e2_ksb_slot_z of the slots instead.
+# Unlike the measurement done during the generation (on stamps of each galaxy centered on the stamp), the saved stamps
+# are centered on the detected peak: the galaxies are shifted and those close to the edge are clipped by the stamp,
+# which biases their moments and shapes compared to the generation-time measurement.
+
+############ KSB MEASUREMENT
+def measure_stamp(stamp, fwhm_lsst, band=6):
+    '''
+    Return moments_sigma and KSB ellipticities measured on a noiseless stamp (NaN if the measurement fails)
+
+    Parameters:
+    ----------
+    stamp: noiseless image of a single galaxy in the band
+    fwhm_lsst: FWHM of the LSST PSF used to generate the image
+    band: filter number in which the measurement is done (r-band by default)
+    '''
+    if not np.any(stamp):
+        return [np.nan, np.nan, np.nan]
+    gal_image = galsim.Image(np.ascontiguousarray(stamp, dtype=np.float32), scale=pixel_scale[band])
+    psf_image = galsim.Kolmogorov(fwhm=fwhm_lsst).drawImage(nx=stamp.shape[0], ny=stamp.shape[1], scale=pixel_scale[band])
+    res = galsim.hsm.EstimateShear(gal_image, psf_image, shear_est='KSB', strict=False)
+    if res.error_message == "":
+        return [res.moments_sigma, res.corrected_g1, res.corrected_g2]
+    else:
+        return [np.nan, np.nan, np.nan]
+
+
+def _measure_image(args):
+    stamps, fwhm_lsst = args
+    return [measure_stamp(stamp, fwhm_lsst) for stamp in stamps]
+
+
+def measure_file(save_dir, root_i, training_or_test, band=6, processes=None):
+    '''
+    Measure the shapes of the galaxies saved in a generated file and fill the corresponding columns of its data file
+    (columns of the order of drawing given by draw_idx_slot_z, or columns *_slot_z for older files)
+
+    Parameters:
+    ----------
+    save_dir: directory where the files are saved
+    root_i: root of the file names (e.g. galaxies_blended_20191024_0)
+    training_or_test: sample of the file (training, validation or test)
+    band: filter number in which the measurement is done (r-band by default)
+    processes: number of processes of the pool (all cpus by default)
+    '''
+    images = open_images(save_dir, root_i)
+    df = pd.read_csv(os.path.join(save_dir, root_i+'_data.csv'))
+
+    if training_or_test == 'test':
+        # [noiseless galaxies..., noisy blend] for each image
+        if isinstance(images, CompactTestImages):
+            tasks = [(images.galaxies(i)[:, band], df['fwhm_lsst'][i]) for i in range(len(df))]
+        else:
+            tasks = [(images[i, :int(df['nb_blended_gal'][i]), band], df['fwhm_lsst'][i]) for i in range(len(df))]
+    else:
+        # (noiseless central galaxy, noisy blend) for each image
+        tasks = [(images[i, 0, band][np.newaxis], df['fwhm_lsst'][i]) for i in range(len(df))]
+
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_measure_image, tasks, chunksize=max(1, len(tasks)//(4*(processes or os.cpu_count()))))
+
+    # Slots of the stack are mapped back to the order of drawing of the columns
+    slot_to_draw = 'draw_idx_slot_0' in df.columns
+    for i, res in enumerate(results):
+        for z, (moment_sigma, e1, e2) in enumerate(res):
+            suffix = str(int(df['draw_idx_slot_'+str(z)][i])) if slot_to_draw else 'slot_'+str(z)
+            df.loc[i, 'moment_sigma_'+suffix] = moment_sigma
+            df.loc[i, 'e1_ksb_'+suffix] = e1
+            df.loc[i, 'e2_ksb_'+suffix] = e2
+    df.to_csv(os.path.join(save_dir, root_i+'_data.csv'), index=False)
+
+
+if __name__ == '__main__':
+    case = str(sys.argv[1]) # directory. Examples: test/
+    training_or_test = str(sys.argv[2]) # training, test or validation
+    isolated_or_blended = str(sys.argv[3]) # isolated or blended
+    N_files = int(sys.argv[4]) # Nb of files to measure
+    assert training_or_test in ['training', 'validation', 'test']
+
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    save_dir = data_dir + case + training_or_test
+    root = 'galaxies_'+isolated_or_blended+'_20191024_'
+
+    for icat in trange(N_files):
+        measure_file(save_dir, root+str(icat), training_or_test)
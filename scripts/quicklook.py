@@ -0,0 +1,132 @@
+# Import packages
+
+import numpy as np
+import sys
+import os
+import multiprocessing
+import pandas as pd
+from tqdm import tqdm
+
+from cosmos_params import sky_level_pixel, pixel_scale
+from dataset_io import Dataset, CompactTestImages, open_images
+
+# The script is used as, eg,
+# >> python quicklook.py test/ training blended 16
+# to write contact sheets of the noisy blends of all the files of save_dir/case/training_or_test/ (listed in the
+# manifest, or all the files of the directory) in save_dir/case/training_or_test/quicklook/: PNG images of 16x16 stamps
+# in RGB composite of the bands [5,6,7] (g, r, i) with an arcsinh stretch, and a red cross on the center of each galaxy
+# (from the _shifts.npy files). The sheets are built with numpy only (no matplotlib figure per stamp) from the
+# memory-mapped files, in parallel on all the cpus. See plot.plot_rgb to look at one stamp in detail.
+
+bands = [5,6,7] # bands of the red, green and blue channels (as in plot.plot_rgb)
+softening = 1. # in units of the sky noise: below, the stretch is linear (noise visible), above logarithmic
+max_level = 1000. # in units of the sky noise: intensity displayed at full brightness
+gutter = 1 # pixels between the stamps
+
+def rgb_composite(blends, bands=bands, softening=softening, max_level=max_level):
+    '''
+    Return the RGB composites [N, S, S, 3] (values in [0, 1]) of the images [N, 10, S, S], in units of the sky noise of each
+    band, with the arcsinh stretch of Lupton et al. (2004) applied to the mean intensity (preserves the colors)
+
+    Parameters:
+    ----------
+    blends: noisy images [N, 10, S, S]
+    bands: bands of the red, green and blue channels
+    softening: intensity (in units of the sky noise) below which the stretch is linear
+    max_level: intensity (in units of the sky noise) displayed at full brightness
+    '''
+    sky_noise = np.sqrt(np.array(sky_level_pixel)[bands])[:, np.newaxis, np.newaxis]
+    x = np.asarray(blends)[:, bands] / sky_noise
+    intensity = np.mean(x, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(intensity > 0, np.arcsinh(intensity/softening) / np.arcsinh(max_level/softening) / intensity, 0.)
+    return np.clip(x * scale, 0., 1.).transpose(0, 2, 3, 1)
+
+
+def draw_markers(rgb, shifts, nb_blended_gal, pixel_scale, size=2):
+    '''
+    Draw in place red crosses on the centers of the galaxies of the RGB composites [N, S, S, 3]
+
+    Parameters:
+    ----------
+    rgb: RGB composites, y axis upwards (row 0 at the bottom)
+    shifts: shifts (in arcsec) of the galaxies [N, nmax_blend, 2]
+    nb_blended_gal: number of galaxies of each image
+    pixel_scale: pixel scale of the bands of the composites
+    size: half size of the crosses (in pixels)
+    '''
+    n, stamp_size = rgb.shape[0], rgb.shape[1]
+    nmax_blend = shifts.shape[1]
+    image, galaxy = np.nonzero(np.arange(nmax_blend)[np.newaxis] < np.asarray(nb_blended_gal)[:, np.newaxis])
+    # Center of an image of even size at (S-1)/2
+    x = np.round((stamp_size-1)/2. + shifts[image, galaxy, 0]/pixel_scale).astype(int)
+    y = np.round((stamp_size-1)/2. + shifts[image, galaxy, 1]/pixel_scale).astype(int)
+    for d in range(-size, size+1):
+        for xi, yi in [(x+d, y), (x, y+d)]:
+            inside = (xi >= 0) & (xi < stamp_size) & (yi >= 0) & (yi < stamp_size)
+            rgb[image[inside], yi[inside], xi[inside]] = [1., 0., 0.]
+
+
+def contact_sheet(rgb, n_columns, gutter=gutter):
+    '''
+    Return the contact sheet [rows*(S+gutter), n_columns*(S+gutter), 3] of the RGB composites [N, S, S, 3], row 0 at the top
+
+    Parameters:
+    ----------
+    rgb: RGB composites, y axis upwards
+    n_columns: number of stamps per row
+    gutter: pixels between the stamps
+    '''
+    n, stamp_size = rgb.shape[0], rgb.shape[1]
+    n_rows = (n + n_columns - 1) // n_columns
+    tiles = np.ones((n_rows*n_columns, stamp_size+gutter, stamp_size+gutter, 3))
+    # Flip the stamps so that the y axis is upwards in the image
+    tiles[:n, :stamp_size, :stamp_size] = rgb[:, ::-1]
+    return tiles.reshape(n_rows, n_columns, stamp_size+gutter, stamp_size+gutter, 3).transpose(0, 2, 1, 3, 4).reshape(n_rows*(stamp_size+gutter), n_columns*(stamp_size+gutter), 3)
+
+
+def write_sheet(task):
+    '''
+    Write the contact sheet of the images start to stop-1 of a file
+
+    Parameters:
+    ----------
+    task: (save_dir, name of the file, start, stop, number of stamps per row, path of the PNG file)
+    '''
+    import matplotlib.image
+    save_dir, name, start, stop, n_columns, out_file = task
+    images = open_images(save_dir, name)
+    if isinstance(images, CompactTestImages):
+        blends = np.array([images.blend(i) for i in range(start, stop)])
+    else:
+        # Noisy blend in the last slot of the test and training layouts
+        blends = np.asarray(images[start:stop, -1])
+    shifts = np.load(os.path.join(save_dir, name+'_shifts.npy'), mmap_mode='r')[start:stop]
+    nb_blended_gal = pd.read_csv(os.path.join(save_dir, name+'_data.csv'), usecols=['nb_blended_gal'])['nb_blended_gal'].values[start:stop]
+    rgb = rgb_composite(blends)
+    draw_markers(rgb, shifts, nb_blended_gal, pixel_scale[bands[1]])
+    matplotlib.image.imsave(out_file, contact_sheet(rgb, n_columns))
+    return out_file
+
+
+if __name__ == '__main__':
+    case = str(sys.argv[1]) # directory. Examples: test/
+    training_or_test = str(sys.argv[2]) # training, test or validation
+    isolated_or_blended = str(sys.argv[3]) # isolated or blended
+    n_columns = int(sys.argv[4]) if len(sys.argv) > 4 else 16 # Number of stamps per row (and of rows) of the sheets
+    processes = int(sys.argv[5]) if len(sys.argv) > 5 else None # Number of processes (all cpus by default)
+
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    save_dir = data_dir + case + training_or_test
+    root = 'galaxies_'+isolated_or_blended+'_20191024_'
+    out_dir = os.path.join(save_dir, 'quicklook')
+    os.makedirs(out_dir, exist_ok=True)
+
+    dataset = Dataset(save_dir, root)
+    tasks = []
+    for f in dataset.manifest['files']:
+        for k, start in enumerate(range(0, f['n_images'], n_columns**2)):
+            tasks.append((save_dir, f['name'], start, min(start+n_columns**2, f['n_images']), n_columns, os.path.join(out_dir, '{0}_sheet_{1:04d}.png'.format(f['name'], k))))
+    with multiprocessing.Pool(processes) as pool:
+        for _ in tqdm(pool.imap_unordered(write_sheet, tasks), total=len(tasks)):
+            pass
@@ -0,0 +1,50 @@
+# Import packages
+
+import sys
+import os
+import json
+import itertools
+
+from main_generation_cosmos import make_config, run
+
+# The script is used as, eg,
+# >> python sweep.py sweep.json
+# with sweep.json containing, eg,
+# {"base": {"case": "sweep_mag/", "training_or_test": "training", "gal_type": "simulation", "isolated_or_blended": "blended",
+#           "do_peak_detection": true, "N_files": 1, "N_per_file": 1000},
+#  "grid": {"mag_cut": [25.5, 26.5, 27.5], "full_or_single": ["full", "single"]}}
+# to run main_generation_cosmos.run for the 6 configurations of the grid. The images of the configuration k are saved
+# in the directory case/point_k/ and sweep.json is completed with the list of the configurations in case/sweep.json.
+# The runs are done in the same process: the catalog, the fit and magnitude tables and the tables of the galaxies
+# passing each magnitude cut (cached in cache_dir, see images_utils.get_used_idx) are computed once and shared by all
+# the configurations which depend on them.
+
+def sweep_configs(base, grid):
+    '''
+    Return the configurations of the grid: one configuration per combination of the values of the parameters of the grid
+
+    Parameters:
+    ----------
+    base: parameters common to all the configurations
+    grid: dictionary of the lists of values of the parameters of the sweep
+    '''
+    names = sorted(grid)
+    configs = []
+    for k, values in enumerate(itertools.product(*[grid[name] for name in names])):
+        parameters = dict(base, **dict(zip(names, values)))
+        parameters['case'] = os.path.join(base['case'], 'point_{0}/'.format(k))
+        configs.append(make_config(**parameters))
+    return configs
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        sweep = json.load(f)
+    configs = sweep_configs(sweep['base'], sweep.get('grid', {}))
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    os.makedirs(data_dir + sweep['base']['case'], exist_ok=True)
+    with open(os.path.join(data_dir + sweep['base']['case'], 'sweep.json'), 'w') as f:
+        json.dump(dict(sweep, configs=configs), f, indent=1)
+    for k, config in enumerate(configs):
+        print('Configuration {0}/{1}: {2}'.format(k+1, len(configs), {name: config[name] for name in sweep.get('grid', {})}))
+        run(config)
@@ -1,17 +1,17 @@
 # Import packages
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 import os
 import galsim
 import multiprocessing
 import time
+import json
+import traceback
+from collections import deque
 from tqdm import tqdm, trange
 import pathlib
 from pathlib import Path
 
-import plot
-
 def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
 
@@ -124,6 +124,7 @@ def compute_blendedness_aperture(img_central, img_others, radius):
     else :
         ic = img_central
         io = img_others
+    import plot
     h, w = ic.shape
     mask = plot.createCircularMask(h, w, center=None, radius=radius)
     flux_central = np.sum(ic*mask.astype(float))
@@ -133,7 +134,26 @@ def compute_blendedness_aperture(img_central, img_others, radius):
 
 
 ##############   MULTIPROCESSING    ############
-def apply_ntimes(func, n, args, verbose=True, timeout=None):
+def process_memory():
+    """
+    Return the resident memory (in MB) of the current process: total (VmRSS), private (RssAnon), file-backed (RssFile,
+    e.g. memory-mapped tables shared with other processes), shared memory (RssShmem) and peak (VmHWM). Empty on systems without /proc.
+    """
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key = line.split(':')[0]
+                if key in ['VmRSS', 'RssAnon', 'RssFile', 'RssShmem', 'VmHWM']:
+                    memory[key] = int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return memory
+
+def _apply_with_memory(func, args):
+    return func(*args), os.getpid(), process_memory()
+
+def apply_ntimes(func, n, args, verbose=True, timeout=None, report_memory=False):
     """
     Applies `n` times the function `func` on `args` (useful if, eg, `func` is partly random).
     Parameters
@@ -144,6 +164,8 @@ def apply_ntimes(func, n, args, verbose=True, timeout=None):
     args : any
     timeout : int or float
         If given, the computation is cancelled if it hasn't returned a result before `timeout` seconds.
+    report_memory : bool
+        If True, print the maximum resident memory of each worker (total, private and shared) measured after its tasks.
     Returns
     -------
     type
@@ -151,9 +173,271 @@ def apply_ntimes(func, n, args, verbose=True, timeout=None):
     """
     pool = multiprocessing.Pool()
 
-    multiple_results = [pool.apply_async(func, args) for _ in range(n)]
+    if report_memory:
+        multiple_results = [pool.apply_async(_apply_with_memory, (func, args)) for _ in range(n)]
+    else:
+        multiple_results = [pool.apply_async(func, args) for _ in range(n)]
 
     pool.close()
     
-    return [res.get(timeout) for res in tqdm(multiple_results, desc='# castor.parallel.apply_ntimes', disable = True)]
+    results = [res.get(timeout) for res in tqdm(multiple_results, desc='# castor.parallel.apply_ntimes', disable = True)]
+    if not report_memory:
+        return results
+
+    memory = {}
+    for _, pid, mem in results:
+        memory[pid] = {key: max(value, memory.get(pid, {}).get(key, 0.)) for key, value in mem.items()}
+    print_memory(memory)
+    return [res for res, _, _ in results]
+
+def print_memory(memory):
+    """
+    Print the table of the resident memory of the workers (dictionary pid: process_memory()).
+    """
+    print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}'.format('worker', 'RSS (MB)', 'private', 'file', 'shmem'))
+    for pid, mem in sorted(memory.items()):
+        print('{0:>8} {1:>12.1f} {2:>12.1f} {3:>12.1f} {4:>12.1f}'.format(pid, mem.get('VmRSS', np.nan), mem.get('RssAnon', np.nan), mem.get('RssFile', np.nan), mem.get('RssShmem', np.nan)))
+    print('{0:>8} {1:>12.1f} {2:>12.1f}'.format('total', sum(mem.get('VmRSS', np.nan) for mem in memory.values()), sum(mem.get('RssAnon', np.nan) for mem in memory.values())))
+
+
+def _failure_record(func, i, seed, attempt, error):
+    return {'function': func.__name__, 'task': int(i), 'seed': int(seed), 'attempt': int(attempt), 'error': error, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def _call_with_traceback(func, args, kwargs):
+    # Exceptions are returned with their traceback, which is lost when they are pickled back to the main process
+    try:
+        return True, func(*args, **kwargs), os.getpid(), process_memory()
+    except Exception:
+        return False, traceback.format_exc(), os.getpid(), process_memory()
+
+def apply_ntimes_robust(func, n, args, kwargs=None, processes=None, deadline=None, max_retries=2, maxtasksperchild=None, seed=None, seed_block=None, failure_log=None, verbose=True, report_memory=False, initializer=None, initargs=()):
+    """
+    Applies `n` times the function `func` on `args` with a different seed for each task (passed as the keyword argument
+    `seed` of func), like apply_ntimes but robust to failing and hanging tasks:
+    - a task which raises an exception or does not return before `deadline` seconds is reissued with a new seed,
+      at most `max_retries` times,
+    - workers are replaced after `maxtasksperchild` tasks to bound the growth of their memory,
+    - the workers stuck in hung tasks cannot be stopped individually: when half of them are stuck, the pool is
+      restarted and the tasks in progress are reissued with the same seed,
+    - the failures are recorded with their seed (in `failure_log`, one json per line, if given) to replay them with replay_failures.
+    Parameters
+    ----------
+    func : function
+        func must be pickable and accept a `seed` keyword argument.
+    n : int
+    args : any
+    kwargs : dict
+        Other keyword arguments of func.
+    processes : int
+        Number of workers (number of cpus by default).
+    deadline : int or float
+        Maximum duration (in seconds) of a task. No limit if None.
+    max_retries : int
+        Maximum number of times a task is reissued.
+    maxtasksperchild : int
+        Number of tasks after which a worker is replaced (never if None).
+    seed : int
+        Seed of the seeds of the tasks.
+    seed_block : int
+        If given, the seeds are taken in the block [seed_block, seed_block + n*(max_retries+1)) instead of being drawn
+        randomly: the attempt a of the task i uses the seed seed_block + a*n + i, so that calls with disjoint blocks
+        never use the same seed.
+    failure_log : str
+        Path of the file where the failures are appended.
+    report_memory : bool
+        If True, print the maximum resident memory of each worker (total, private and shared) measured after its tasks.
+    initializer, initargs :
+        Function called with initargs when each worker starts (e.g. profile_worker). If no worker is hung at the end,
+        the workers exit normally so that the finalizers they registered (multiprocessing.util.Finalize) are run.
+    Returns
+    -------
+    type
+        Results of the tasks which succeeded (n results if none failed more than max_retries times) and list of the failures.
+    """
+    kwargs = kwargs or {}
+    processes = processes or os.cpu_count()
+    seeds = np.random.RandomState(seed)
+    def new_seed(i, attempt):
+        return int(seeds.randint(1, 2**31-1)) if seed_block is None else seed_block + attempt*n + i
+    pending = deque((i, new_seed(i, 0), 0) for i in range(n))
+    results = [None]*n
+    failures = []
+    running = {}
+    memory = {}
+    hung = 0
+    pool = multiprocessing.Pool(processes, initializer, initargs, maxtasksperchild)
+
+    def fail(i, task_seed, attempt, error):
+        failures.append(_failure_record(func, i, task_seed, attempt, error))
+        if failure_log is not None:
+            with open(failure_log, 'a') as f:
+                f.write(json.dumps(failures[-1])+'\n')
+        if verbose:
+            print('Task {0} (seed {1}, attempt {2}) failed: {3}'.format(i, task_seed, attempt, error.strip().split('\n')[-1]))
+        if attempt < max_retries:
+            pending.append((i, new_seed(i, attempt+1), attempt+1))
+
+    try:
+        while pending or running:
+            # Keep at most one task per available worker so that the deadline counts from the start of the task
+            while pending and len(running) < processes - hung:
+                i, task_seed, attempt = pending.popleft()
+                res = pool.apply_async(_call_with_traceback, (func, args, dict(kwargs, seed=task_seed)))
+                running[res] = (i, task_seed, attempt, time.monotonic())
 
+            for res, (i, task_seed, attempt, start) in list(running.items()):
+                if res.ready():
+                    del running[res]
+                    try:
+                        ok, value, pid, mem = res.get()
+                        memory[pid] = {key: max(v, memory.get(pid, {}).get(key, 0.)) for key, v in mem.items()}
+                    except Exception as e:
+                        ok, value = False, repr(e)
+                    if ok:
+                        results[i] = value
+                    else:
+                        fail(i, task_seed, attempt, value)
+                elif deadline is not None and time.monotonic() - start > deadline:
+                    del running[res]
+                    hung += 1
+                    fail(i, task_seed, attempt, 'Timeout after {0} s'.format(deadline))
+
+            if hung > 0 and hung >= max(1, processes // 2):
+                if verbose:
+                    print('{0} workers hung: restarting the pool'.format(hung))
+                pool.terminate()
+                pool.join()
+                for i, task_seed, attempt, _ in running.values():
+                    pending.appendleft((i, task_seed, attempt))
+                running = {}
+                hung = 0
+                pool = multiprocessing.Pool(processes, initializer, initargs, maxtasksperchild)
+            time.sleep(0.01)
+    finally:
+        if not pending and not running and hung == 0:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+    if report_memory:
+        print_memory(memory)
+    return [res for res in results if res is not None], failures
+
+############## PROFILING OF THE WORKERS ############
+# Opt-in profiling of a subset of the workers of a pool: profile_worker is used as the initializer of the pool, starts
+# cProfile (deterministic profiler of the standard library) and optionally tracemalloc in the first n_workers workers
+# started, and registers a finalizer which saves, when the worker exits, in profile_dir:
+#   - pid.prof: profile of the worker (pstats format)
+#   - pid_memory.json: peak resident memory and, with tracemalloc, peak traced memory and top allocating lines
+# merge_worker_profiles merges the files of all the workers in one text report.
+
+def profile_worker(profile_dir, n_workers, counter, trace_memory=False, n_top=25):
+    """
+    Initializer of a pool: profile the worker if less than n_workers workers are already profiled.
+    Parameters
+    ----------
+    profile_dir : str
+        Directory where the profiles are saved.
+    n_workers : int
+        Number of workers profiled.
+    counter : multiprocessing.Value
+        Number of workers already profiled (shared by the workers of the pool, e.g. multiprocessing.Value('i', 0)).
+    trace_memory : bool
+        If True, also trace the memory allocations with tracemalloc (slows down the worker much more than cProfile).
+    n_top : int
+        Number of top allocating lines saved.
+    """
+    with counter.get_lock():
+        if counter.value >= n_workers:
+            return
+        counter.value += 1
+    import cProfile
+    import tracemalloc
+    from multiprocessing.util import Finalize
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    Finalize(None, _save_worker_profile, args=(profiler, profile_dir, trace_memory, n_top), exitpriority=10)
+
+def _save_worker_profile(profiler, profile_dir, trace_memory, n_top):
+    import tracemalloc
+    profiler.disable()
+    pid = os.getpid()
+    profiler.dump_stats(os.path.join(profile_dir, '{0}.prof'.format(pid)))
+    memory = {'pid': pid, 'memory': process_memory()}
+    if trace_memory:
+        snapshot = tracemalloc.take_snapshot()
+        memory['traced_current'], memory['traced_peak'] = [m / 1024.**2 for m in tracemalloc.get_traced_memory()]
+        memory['top_allocations'] = [[str(stat.traceback[0]), stat.size / 1024.**2, stat.count] for stat in snapshot.statistics('lineno')[:n_top]]
+        tracemalloc.stop()
+    with open(os.path.join(profile_dir, '{0}_memory.json'.format(pid)), 'w') as f:
+        json.dump(memory, f)
+
+def merge_worker_profiles(profile_dir, report_file, n_top=30):
+    """
+    Write the report of the profiles of the workers saved in profile_dir: functions with the largest cumulative and own
+    time (all workers together), peak resident memory of each worker and top allocating lines (summed over the workers).
+    Parameters
+    ----------
+    profile_dir : str
+        Directory of the profiles of the workers (see profile_worker).
+    report_file : str
+        Path of the report.
+    n_top : int
+        Number of functions and lines in the tables.
+    """
+    import pstats
+    profiles = sorted(f for f in os.listdir(profile_dir) if f.endswith('.prof'))
+    memories = []
+    for f in sorted(os.listdir(profile_dir)):
+        if f.endswith('_memory.json'):
+            with open(os.path.join(profile_dir, f)) as fp:
+                memories.append(json.load(fp))
+    with open(report_file, 'w') as report:
+        report.write('Profiles of {0} workers\n\n'.format(len(profiles)))
+        if profiles:
+            stats = pstats.Stats(*[os.path.join(profile_dir, f) for f in profiles], stream=report)
+            stats.strip_dirs()
+            stats.sort_stats('cumulative').print_stats(n_top)
+            stats.sort_stats('tottime').print_stats(n_top)
+
+        report.write('{0:>8} {1:>14} {2:>12} {3:>12} {4:>16}\n'.format('worker', 'peak RSS (MB)', 'RSS', 'private', 'traced peak'))
+        allocations = {}
+        for memory in memories:
+            mem = memory['memory']
+            report.write('{0:>8} {1:>14.1f} {2:>12.1f} {3:>12.1f} {4:>16.1f}\n'.format(memory['pid'], mem.get('VmHWM', np.nan), mem.get('VmRSS', np.nan), mem.get('RssAnon', np.nan), memory.get('traced_peak', np.nan)))
+            for line, size, count in memory.get('top_allocations', []):
+                allocations[line] = [allocations.get(line, [0., 0])[0] + size, allocations.get(line, [0., 0])[1] + count]
+        if allocations:
+            report.write('\nTop allocations still alive at the end of the workers (all workers)\n')
+            report.write('{0:>12} {1:>10}  {2}\n'.format('size (MB)', 'blocks', 'line'))
+            for line, (size, count) in sorted(allocations.items(), key=lambda item: -item[1][0])[:n_top]:
+                report.write('{0:>12.2f} {1:>10}  {2}\n'.format(size, count, line))
+
+def replay_failures(func, args, failure_log, kwargs=None):
+    """
+    Run again, in the current process, the tasks recorded in `failure_log` by apply_ntimes_robust (useful to debug them).
+    Parameters
+    ----------
+    func : function
+    args : any
+        Same arguments as in the call of apply_ntimes_robust.
+    failure_log : str
+    kwargs : dict
+    Returns
+    -------
+    type
+        List of (seed, result or exception) for each failure recorded.
+    """
+    kwargs = kwargs or {}
+    replays = []
+    with open(failure_log) as f:
+        failures = [json.loads(line) for line in f if line.strip()]
+    for failure in failures:
+        try:
+            replays.append((failure['seed'], func(*args, **dict(kwargs, seed=failure['seed']))))
+        except Exception as e:
+            replays.append((failure['seed'], e))
+    return replays
@@ -0,0 +1,61 @@
+# Import packages
+
+import sys
+import os
+import time
+import numpy as np
+from scipy import stats
+
+import utils
+from images_generator import image_generator_sim
+
+# The script is used as, eg,
+# >> python validate_draw_method.py 200 auto
+# to generate the same 200 blends (seeds 0 to 199) of the test part of the catalog by FFT and with the draw method 'auto'
+# (or 'phot'), and compare the distributions of the SNR and of the blendedness of the central galaxy in r band
+# with a two-sample Kolmogorov-Smirnov test. Small p-values indicate that the drawing method changes the distributions.
+
+# Parameters of the generation, as in main_generation_cosmos.py
+nmax_blend = (1,5)
+max_try = 100
+mag_cut = 27.5
+max_stamp_size = 64
+
+def generate(draw_method, seeds):
+    '''
+    Return the SNR and blendedness (in r band) of the central galaxy of the blends generated with the draw method, and the time needed
+
+    Parameters:
+    ----------
+    draw_method: 'fft', 'phot' or 'auto'
+    seeds: seeds of the blends
+    '''
+    used_idx = np.arange(5000)
+    snr, blendedness = [], []
+    t0 = time.perf_counter()
+    for seed in seeds:
+        galaxy_noiseless, _, data, _ = image_generator_sim(cosmos_cat_dir, 'test', 'blended', used_idx, nmax_blend, max_try, mag_cut,
+                                                           'uniform', 'uniform', 3.2, 2., False, False, max_stamp_size, False,
+                                                           do_shape_measurement=False, seed=seed, draw_method=draw_method)
+        snr.append(data['SNR'])
+        n = data['nb_blended_gal']
+        blendedness.append(utils.compute_blendedness_total(galaxy_noiseless[0,6], np.sum(galaxy_noiseless[1:n,6], axis=0)) if n > 1 else 0.)
+    return np.array(snr), np.array(blendedness), time.perf_counter()-t0
+
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    draw_method = str(sys.argv[2]) if len(sys.argv) > 2 else 'auto'
+    assert draw_method in ['phot', 'auto']
+    data_dir = str(os.environ.get('IMGEN_DATA'))
+    cosmos_cat_dir = os.path.join(data_dir, 'COSMOS_25.2_training_sample')
+
+    snr_fft, blendedness_fft, t_fft = generate('fft', range(n_images))
+    snr_test, blendedness_test, t_test = generate(draw_method, range(n_images))
+
+    print('{0:<8} {1:>10} {2:>12} {3:>18}'.format('method', 'images/s', 'median SNR', 'median blendedness'))
+    print('{0:<8} {1:>10.2f} {2:>12.1f} {3:>18.3f}'.format('fft', n_images/t_fft, np.median(snr_fft), np.median(blendedness_fft)))
+    print('{0:<8} {1:>10.2f} {2:>12.1f} {3:>18.3f}'.format(draw_method, n_images/t_test, np.median(snr_test), np.median(blendedness_test)))
+    print('KS test SNR: statistic {0:.3f}, p-value {1:.3f}'.format(*stats.ks_2samp(snr_fft, snr_test)))
+    blended_fft, blended_test = blendedness_fft[blendedness_fft > 0], blendedness_test[blendedness_test > 0]
+    print('KS test blendedness: statistic {0:.3f}, p-value {1:.3f}'.format(*stats.ks_2samp(blended_fft, blended_test)))
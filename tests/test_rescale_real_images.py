@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('galsim')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../scripts'))
+
+from images_utils import rescale_real_images
+
+
+def rescale_loop(real_images, param_fluxes):
+    '''
+    Per-band rescaling of image_generator_real before rescale_real_images: in each band, the minimum of each real image
+    is subtracted in place, then the image is scaled to the flux of its parametric model
+    '''
+    real_images = [np.array(image) for image in real_images]
+    out = np.zeros((len(param_fluxes),)+np.shape(real_images))
+    for i, fluxes in enumerate(param_fluxes):
+        for jj, image_real in enumerate(real_images):
+            image_real -= np.min(image_real)
+            out[i, jj] = image_real * fluxes[jj]/np.sum(image_real)
+    return out
+
+
+@pytest.fixture
+def real_images_and_fluxes():
+    random_state = np.random.RandomState(0)
+    # Real images with a noisy background going below 0, as drawn from the noise padded HST images
+    real_images = random_state.normal(0., 1., size=(3, 16, 16))
+    real_images[:, 6:10, 6:10] += 50.
+    param_fluxes = random_state.uniform(10., 1000., size=(10, 3))
+    return real_images, param_fluxes
+
+
+def test_matches_per_band_loop(real_images_and_fluxes):
+    real_images, param_fluxes = real_images_and_fluxes
+    np.testing.assert_allclose(rescale_real_images(real_images, param_fluxes), rescale_loop(real_images, param_fluxes), rtol=1e-12)
+
+
+def test_minimum_subtracted_once(real_images_and_fluxes):
+    real_images, param_fluxes = real_images_and_fluxes
+    rescaled = rescale_real_images(real_images, param_fluxes)
+    # The subtraction does not compound across bands: every band is the same image, minimum subtracted once, up to its flux
+    shifted = real_images - np.min(real_images, axis=(1,2), keepdims=True)
+    expected = shifted[np.newaxis] * (param_fluxes / np.sum(shifted, axis=(1,2)))[:, :, np.newaxis, np.newaxis]
+    np.testing.assert_allclose(rescaled, expected, rtol=1e-12)
+    np.testing.assert_allclose(np.min(rescaled, axis=(2,3)), 0., atol=1e-12)
+    np.testing.assert_allclose(np.sum(rescaled, axis=(2,3)), param_fluxes, rtol=1e-12)
+
+
+def test_input_not_modified(real_images_and_fluxes):
+    real_images, param_fluxes = real_images_and_fluxes
+    copy = real_images.copy()
+    rescale_real_images(real_images, param_fluxes)
+    np.testing.assert_array_equal(real_images, copy)